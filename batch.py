@@ -0,0 +1,305 @@
+"""Headless batch processing: annotated videos from a manifest, without the web interface.
+
+    python batch.py manifest.jsonl
+    python batch.py manifest.csv --inference-concurrency 8 --upload-concurrency 4
+
+Every item runs through the same inference, compositing and upload stages
+as a job from the page, on a job manager with its own worker and per-stage
+limits. Finished items are appended to a checkpoint file, by default
+<manifest>.checkpoint.jsonl, which also holds their results. Running the
+same command again skips the items done there and retries the rest, so an
+interrupted batch resumes where it stopped; the SAM2 results and the
+downloaded videos of items cut off halfway are still in their caches.
+
+A JSONL manifest holds one /save_annotations request per line:
+    {"url": "https://...", "points": [{"x": 320, "y": 240, "label": 1, "frame": 0}]}
+with the same optional fields (objects, frame_interval, target_fps,
+output_mode, bypass_cache), or "coordinates" of positive clicks, and an
+optional "id". A CSV manifest holds one click per row, in columns url, x, y
+and optionally label, object, frame, policy and id; rows of the same id, or
+of the same url without ids, are one item, whose frame_interval,
+target_fps and output_mode columns are read from its first row.
+"""
+import argparse
+import csv
+import hashlib
+import json
+import os
+import shutil
+import sys
+import threading
+import time
+
+import jobs
+import run
+from jobs import DONE, FAILED
+
+CSV_ITEM_FIELDS = ('frame_interval', 'target_fps', 'output_mode')
+CSV_REQUIRED_COLUMNS = ('url', 'x', 'y')
+
+
+def read_jsonl_manifest(path):
+    """Yield (line number, request, error) of a JSONL manifest; error is None for valid lines."""
+    with open(path, encoding='utf-8') as f:
+        for number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line)
+            except ValueError as e:
+                yield number, None, f"not JSON: {e}"
+                continue
+            if not isinstance(request, dict):
+                yield number, None, "not a JSON object"
+                continue
+            yield number, request, None
+
+
+def read_csv_manifest(path):
+    """Yield (line number, request, error) of a CSV manifest, grouping the clicks of each item.
+
+    Items are numbered by their first line; invalid rows are yielded as
+    errors of their own line.
+    """
+    items = {}
+    with open(path, newline='', encoding='utf-8') as f:
+        reader = csv.DictReader(f)
+        columns = [name.strip() for name in reader.fieldnames or []]
+        missing = [name for name in CSV_REQUIRED_COLUMNS if name not in columns]
+        if missing:
+            yield 1, None, f"missing columns: {', '.join(missing)}"
+            return
+        for row in reader:
+            number = reader.line_num
+            row = {name.strip(): (value or '').strip() for name, value in row.items() if name}
+            empty = [name for name in CSV_REQUIRED_COLUMNS if not row.get(name)]
+            if empty:
+                yield number, None, f"empty {', '.join(empty)}"
+                continue
+            key = row.get('id') or row['url']
+            if key not in items:
+                request = {'url': row['url'], 'points': [], 'objects': {}}
+                if row.get('id'):
+                    request['id'] = row['id']
+                for name in CSV_ITEM_FIELDS:
+                    if row.get(name):
+                        request[name] = row[name]
+                items[key] = (number, request)
+            request = items[key][1]
+            point = {'x': row['x'], 'y': row['y']}
+            for name in ('label', 'object', 'frame'):
+                if row.get(name):
+                    point[name] = row[name]
+            request['points'].append(point)
+            if row.get('policy'):
+                request['objects'][point.get('object', 'mask_1')] = row['policy']
+    for number, request in items.values():
+        if not request['objects']:
+            del request['objects']
+        yield number, request, None
+
+
+def read_manifest(path):
+    """Return the items of a manifest as (item id, job input) pairs.
+
+    Items without an id are identified by their job input, so that a
+    resumed batch recognizes them even if lines were added or reordered.
+    Raises ValueError listing every invalid line, before anything runs.
+    """
+    rows = read_csv_manifest(path) if path.lower().endswith('.csv') else read_jsonl_manifest(path)
+    items = []
+    errors = []
+    seen = set()
+    for number, request, error in rows:
+        if error:
+            errors.append(f"line {number}: {error}")
+            continue
+        try:
+            job_input = run.annotation_job_input(request)
+        except (KeyError, TypeError, ValueError) as e:
+            errors.append(f"line {number}: {e!r}")
+            continue
+        item_id = str(request.get('id') or hashlib.sha1(
+            json.dumps(job_input, sort_keys=True).encode()).hexdigest()[:16])
+        if item_id in seen:
+            errors.append(f"line {number}: duplicate item {item_id}")
+            continue
+        seen.add(item_id)
+        items.append((item_id, job_input))
+    if errors:
+        raise ValueError(f"Invalid manifest {path}:\n  " + '\n  '.join(errors))
+    return items
+
+
+class Checkpoint:
+    """Append-only JSONL record of finished items, flushed to disk as each finishes."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def done(self):
+        """Return the ids of the items recorded as done.
+
+        A line cut off by an interrupted write is ignored, so its item runs again.
+        """
+        done = set()
+        if not os.path.exists(self.path):
+            return done
+        with open(self.path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if record.get('status') == DONE:
+                    done.add(record['id'])
+        return done
+
+    def record(self, item_id, job):
+        with self._lock, open(self.path, 'a+', encoding='utf-8') as f:
+            if f.tell():
+                f.seek(f.tell() - 1)
+                if f.read(1) != '\n':
+                    # Start after a line cut off by an interrupted write
+                    f.write('\n')
+            f.write(json.dumps({
+                'id': item_id,
+                'url': job.input['url'],
+                'status': job.status,
+                'greenscreen_url': job.result.get('greenscreen_url'),
+                'error': job.error,
+                'timings': job.timings,
+                'finished': job.updated,
+            }) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))] if values else 0.0
+
+
+def print_summary(jobs, skipped, seconds, workers, limits):
+    """Throughput of the batch, and how busy each stage was against its limit."""
+    done = [job for job in jobs if job.status == DONE]
+    failed = [job for job in jobs if job.status == FAILED]
+    print(f"\n{len(done)} done, {len(failed)} failed, {skipped} skipped as already done, "
+          f"in {seconds:.1f}s with {workers} workers")
+    if done:
+        print(f"Throughput: {len(done) / seconds * 60:.2f} items/min")
+    latencies = [sum(job.timings.values()) for job in done]
+    if latencies:
+        print(f"Item time: median {percentile(latencies, 0.5):.1f}s, p95 {percentile(latencies, 0.95):.1f}s")
+    # A stage near 100% of its limit is the one to give more concurrency
+    for name, _ in run.JOB_STAGES:
+        timings = [job.timings[name] for job in jobs if name in job.timings]
+        if not timings:
+            continue
+        busy = sum(timings) / (seconds * limits[name]) * 100
+        print(f"  {name:<12} mean {sum(timings) / len(timings):7.2f}s  "
+              f"max {max(timings):7.2f}s  {busy:5.1f}% of {limits[name]} slots")
+    for job in failed:
+        print(f"Failed: {job.input['url']}: {job.error}")
+
+
+def process(items, checkpoint, workers=None, stage_concurrency=None, keep_output=False):
+    """Run items through the job stages, recording each in checkpoint as it finishes.
+
+    At most workers items are submitted at a time, so on Ctrl+C the batch
+    stops taking new items and waits for the running ones to be recorded;
+    a second Ctrl+C exits at once. Each item holds a worker through all its
+    stages, so workers defaults to at least the largest stage limit.
+    Returns the jobs that finished.
+    """
+    limits = dict(jobs.STAGE_CONCURRENCY, **(stage_concurrency or {}))
+    if workers is None:
+        workers = max(jobs.JOB_WORKERS, *limits.values())
+    elif workers < max(limits.values()):
+        print(f"Warning: {workers} workers cannot fill stage limits above {workers}: "
+              + ', '.join(f'{name} {limit}' for name, limit in limits.items() if limit > workers))
+    job_manager = run.setup(job_backend='memory', workers=workers, stage_concurrency=stage_concurrency)
+    pending = list(reversed(items))
+    running = {}
+    finished = []
+    stopping = False
+    while pending or running:
+        try:
+            while pending and len(running) < workers and not stopping:
+                item_id, job_input = pending.pop()
+                running[item_id] = job_manager.submit(job_input)
+            for item_id, job in list(running.items()):
+                if not job.finished:
+                    continue
+                del running[item_id]
+                if job.status == DONE and not job.result.get('greenscreen_url'):
+                    job.status = FAILED
+                    job.error = 'Upload failed'
+                checkpoint.record(item_id, job)
+                finished.append(job)
+                if job.status == DONE and not keep_output and job.result.get('local_path'):
+                    # The upload has it; the server keeps outputs for /output, a batch has no use for them.
+                    # An HLS output is the directory of its segments
+                    local_path = job.result['local_path']
+                    if os.path.isdir(local_path):
+                        shutil.rmtree(local_path, ignore_errors=True)
+                    elif os.path.exists(local_path):
+                        os.remove(local_path)
+                print(f"[{len(finished)}/{len(finished) + len(running) + len(pending)}] "
+                      f"{job.status}: {job.input['url']} {job.result.get('greenscreen_url') or job.error}")
+            if stopping and not running:
+                break
+            time.sleep(0.2)
+        except KeyboardInterrupt:
+            if stopping:
+                print("Stopped; unfinished items run again when the batch is resumed")
+                os._exit(130)
+            stopping = True
+            print(f"\nInterrupted: finishing {len(running)} running items, Ctrl+C again to stop now")
+    job_manager.shutdown()
+    return finished
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('manifest', help='JSONL or CSV file of annotated videos')
+    parser.add_argument('--checkpoint', help='Results of finished items, default <manifest>.checkpoint.jsonl')
+    parser.add_argument('--workers', type=int,
+                        help='Items processed at once (default JOB_WORKERS, or the largest stage limit if higher)')
+    parser.add_argument('--inference-concurrency', type=int, help='Default INFERENCE_CONCURRENCY')
+    parser.add_argument('--composite-concurrency', type=int, help='Default COMPOSITE_CONCURRENCY')
+    parser.add_argument('--upload-concurrency', type=int, help='Default UPLOAD_CONCURRENCY')
+    parser.add_argument('--keep-output', action='store_true', help='Keep composited videos in OUTPUT_DIR after upload')
+    args = parser.parse_args(argv)
+    # Before the manifest, whose items are checked against the settings
+    run.load_settings()
+
+    try:
+        items = read_manifest(args.manifest)
+    except (OSError, ValueError) as e:
+        print(e)
+        return 1
+    checkpoint = Checkpoint(args.checkpoint or args.manifest + '.checkpoint.jsonl')
+    done = checkpoint.done()
+    todo = [(item_id, job_input) for item_id, job_input in items if item_id not in done]
+    skipped = len(items) - len(todo)
+    print(f"{len(items)} items in {args.manifest}, {skipped} already done, {len(todo)} to process")
+
+    stage_concurrency = {name: value for name, value in (
+        ('inference', args.inference_concurrency),
+        ('compositing', args.composite_concurrency),
+        ('uploading', args.upload_concurrency),
+    ) if value}
+    start = time.perf_counter()
+    finished = process(todo, checkpoint, args.workers, stage_concurrency, args.keep_output)
+    seconds = time.perf_counter() - start
+
+    job_manager = run.job_manager
+    print_summary(finished, skipped, seconds, job_manager.workers, job_manager.limits)
+    print(f"Results in {checkpoint.path}")
+    return 0 if all(job.status == DONE for job in finished) and len(finished) == len(todo) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,1218 @@
+"""Performance benchmarks for the video pipeline.
+
+Usage:
+    python benchmark.py compositing [--frames N]
+    python benchmark.py segments [--frames N] [--workers N] [--segment-frames N]
+    python benchmark.py downloads [--size-mb N] [--rate-mb N]
+    python benchmark.py uploads [--files N] [--size-mb N] [--rate-mb N]
+    python benchmark.py encoders [--frames N] [--resolution 720p|1080p|4k]
+    python benchmark.py subsampling [--frames N] [--intervals N,N,...]
+    python benchmark.py upscaling [--frames N] [--resolution 720p|1080p|4k]
+    python benchmark.py chunking [--frames N] [--chunk-frames N] [--ms-per-frame N]
+    python benchmark.py roi [--frames N] [--resolution 720p|1080p|4k]
+    python benchmark.py archive [--frames N] [--resolution 720p|1080p|4k]
+    python benchmark.py backgrounds [--frames N] [--resolution 720p|1080p|4k] [--feather N]
+    python benchmark.py e2e [--resolutions R,R] [--frames N,N] [--coverages C,C] [--flows F,F]
+                            [--model-seconds S] [--output PATH] [--baseline PATH]
+    python benchmark.py serve [--workers N,N] [--jobs N] [--clients N] [--model-seconds S]
+    python benchmark.py importtime [--runs N] [--top N]
+    python benchmark.py batch [--items N] [--inference-concurrency N,N] [--model-seconds S]
+"""
+import argparse
+import contextlib
+import functools
+import hashlib
+import importlib.util
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import cv2
+import numpy as np
+import requests
+
+import downloads
+import serve
+from chunking import predict_chunks, split_video
+from compositing import Compositor, GREEN_BGR, MaskUpscaler
+from encoders import make_encoder
+from fakes import FakePredictor, LocalHTTPServer
+from mask_archive import MaskArchive, convert_masks
+from media import find_ffmpeg, frame_count
+from object_storage import LocalStorage, set_storage
+from pipeline import composite_video, seek
+from proxy import proxy_size
+from temporal import MaskInterpolator, model_frames
+
+RESOLUTIONS = {
+    '720p': (1280, 720),
+    '1080p': (1920, 1080),
+    '4k': (3840, 2160),
+}
+
+
+def synthetic_frames(width, height, seed=0):
+    """Return a random original frame and a mask frame with a black background."""
+    rng = np.random.default_rng(seed)
+    frame = rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+    mask = np.zeros((height, width, 3), dtype=np.uint8)
+    # Subject in the middle third of the frame, noisy like a decoded mask video
+    mask[height // 4:3 * height // 4, width // 3:2 * width // 3] = 255
+    mask = np.clip(mask.astype(np.int16) + rng.integers(-8, 9, mask.shape), 0, 255).astype(np.uint8)
+    return frame, mask
+
+
+def write_synthetic_videos(directory, width, height, frames, fps=25):
+    """Write an original and a mask video with a moving subject.
+
+    Returns the paths of the original and mask videos.
+    """
+    original_path = os.path.join(directory, 'original.mp4')
+    mask_path = os.path.join(directory, 'mask.mp4')
+    fourcc = cv2.VideoWriter_fourcc(*'mp4v')
+    original = cv2.VideoWriter(original_path, fourcc, fps, (width, height))
+    mask = cv2.VideoWriter(mask_path, fourcc, fps, (width, height))
+    rng = np.random.default_rng(0)
+    texture = rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+    radius = height // 4
+    for index in range(frames):
+        center = (width // 4 + (index * 7) % (width // 2), height // 2)
+        frame = np.roll(texture, index * 3, axis=1)
+        cv2.putText(frame, str(index), (20, 60), cv2.FONT_HERSHEY_SIMPLEX, 2, (0, 0, 255), 4)
+        original.write(frame)
+        mask_frame = np.zeros((height, width, 3), dtype=np.uint8)
+        cv2.circle(mask_frame, center, radius, (255, 255, 255), -1)
+        mask.write(mask_frame)
+    original.release()
+    mask.release()
+    return original_path, mask_path
+
+
+def read_frames(path):
+    cap = cv2.VideoCapture(path)
+    frames = []
+    while True:
+        ret, frame = cap.read()
+        if not ret:
+            break
+        frames.append(frame)
+    cap.release()
+    return frames
+
+
+def open_lossless_writer(path, fps, width, height, audio_source=None):
+    """FFV1 writer, so decoded output frames can be compared exactly."""
+    return cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'FFV1'), fps, (width, height))
+
+
+def legacy_composite(frame, mask_frame):
+    """The per-frame compositing code that run.py used before Compositor."""
+    mask_gray = cv2.cvtColor(mask_frame, cv2.COLOR_BGR2GRAY)
+    mask = mask_gray < 10
+    output_frame = frame.copy()
+    output_frame[mask] = [0, 255, 0]
+    return output_frame
+
+
+def measure_fps(fn, frames):
+    start = time.perf_counter()
+    for _ in range(frames):
+        fn()
+    return frames / (time.perf_counter() - start)
+
+
+def bench_compositing(args):
+    print(f"{'resolution':<12}{'legacy fps':>12}{'compositor fps':>16}{'speedup':>10}")
+    for name, (width, height) in RESOLUTIONS.items():
+        frame, mask = synthetic_frames(width, height)
+        compositor = Compositor(width, height, GREEN_BGR)
+
+        # Both paths must produce the same pixels
+        if not np.array_equal(legacy_composite(frame, mask), compositor.composite(frame, mask)):
+            raise AssertionError(f"Compositor output differs from legacy output at {name}")
+
+        legacy_fps = measure_fps(lambda: legacy_composite(frame, mask), args.frames)
+        new_fps = measure_fps(lambda: compositor.composite(frame, mask), args.frames)
+        print(f"{name:<12}{legacy_fps:>12.1f}{new_fps:>16.1f}{new_fps / legacy_fps:>9.2f}x")
+
+
+def bench_segments(args):
+    """Check that segment mode matches the serial pipeline and compare speed."""
+    directory = tempfile.mkdtemp(prefix='bench_segments_')
+    try:
+        original_path, mask_path = write_synthetic_videos(directory, 1280, 720, args.frames)
+        serial_path = os.path.join(directory, 'serial.avi')
+        parallel_path = os.path.join(directory, 'parallel.avi')
+
+        serial = composite_video(original_path, mask_path, serial_path, parallel=False,
+                                 writer_factory=open_lossless_writer, report_timings=False)
+        parallel = composite_video(original_path, mask_path, parallel_path, parallel=True,
+                                   writer_factory=open_lossless_writer, workers=args.workers,
+                                   segment_frames=args.segment_frames)
+
+        serial_frames = read_frames(serial_path)
+        parallel_frames = read_frames(parallel_path)
+        if len(serial_frames) != len(parallel_frames):
+            raise AssertionError(f"Frame count differs: {len(serial_frames)} serial, "
+                                 f"{len(parallel_frames)} parallel")
+        for index, (a, b) in enumerate(zip(serial_frames, parallel_frames)):
+            if not np.array_equal(a, b):
+                raise AssertionError(f"Frame {index} differs between serial and parallel output")
+        print(f"Segment output is frame-identical to serial output ({len(serial_frames)} frames)")
+        print(f"serial   {serial['frames'] / serial['seconds']:8.1f} fps")
+        print(f"parallel {parallel['frames'] / parallel['seconds']:8.1f} fps")
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def file_digest(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def legacy_download(url, path):
+    """The single-stream download that run.py used before the download subsystem."""
+    response = requests.get(url)
+    with open(path, 'wb') as f:
+        f.write(response.content)
+
+
+def bench_downloads(args):
+    """Compare single-stream and ranged downloads from a throttled local server."""
+    directory = tempfile.mkdtemp(prefix='bench_downloads_')
+    try:
+        source = os.path.join(directory, 'video.bin')
+        with open(source, 'wb') as f:
+            f.write(os.urandom(args.size_mb * 1024 * 1024))
+        expected = file_digest(source)
+        rate = args.rate_mb * 1024 * 1024 if args.rate_mb else None
+
+        with LocalHTTPServer(directory, bytes_per_second=rate) as server:
+            url = server.url('video.bin')
+            for name, fn in (('single stream', legacy_download), ('download_to_file', downloads.download_to_file)):
+                target = os.path.join(directory, 'download.bin')
+                start = time.perf_counter()
+                fn(url, target)
+                seconds = time.perf_counter() - start
+                if file_digest(target) != expected:
+                    raise AssertionError(f"{name} produced a corrupt download")
+                os.unlink(target)
+                print(f"{name:<18}{args.size_mb / seconds:8.1f} MB/s")
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def bench_uploads(args):
+    """Compare sequential and background uploads through the local storage stand-in."""
+    directory = tempfile.mkdtemp(prefix='bench_uploads_')
+    try:
+        paths = []
+        for index in range(args.files):
+            path = os.path.join(directory, f'output_{index}.mp4')
+            with open(path, 'wb') as f:
+                f.write(os.urandom(args.size_mb * 1024 * 1024))
+            paths.append(path)
+        rate = args.rate_mb * 1024 * 1024 if args.rate_mb else None
+        total_mb = args.files * args.size_mb
+
+        storage = LocalStorage(os.path.join(directory, 'sequential'), bytes_per_second=rate)
+        start = time.perf_counter()
+        for path in paths:
+            storage.upload(path, os.path.basename(path))
+        sequential = time.perf_counter() - start
+
+        storage = LocalStorage(os.path.join(directory, 'background'), bytes_per_second=rate)
+        start = time.perf_counter()
+        futures = [storage.upload_async(path, os.path.basename(path)) for path in paths]
+        for future in futures:
+            future.result()
+        background = time.perf_counter() - start
+
+        print(f"sequential {total_mb / sequential:8.1f} MB/s")
+        print(f"background {total_mb / background:8.1f} MB/s")
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def add_test_tone(ffmpeg, video_path, output_path):
+    """Copy video_path to output_path with a sine wave as its audio track."""
+    subprocess.run(
+        [ffmpeg, '-y', '-loglevel', 'error', '-i', video_path,
+         '-f', 'lavfi', '-i', 'sine=frequency=440', '-shortest',
+         '-c:v', 'copy', '-c:a', 'aac', output_path],
+        check=True,
+    )
+
+
+def has_audio(ffmpeg, path):
+    result = subprocess.run([ffmpeg, '-hide_banner', '-i', path], capture_output=True, text=True)
+    return 'Audio:' in result.stderr
+
+
+def bench_encoders(args):
+    """Compare encode speed and output size of the mp4v and ffmpeg encoders."""
+    ffmpeg = find_ffmpeg()
+    if not ffmpeg:
+        raise SystemExit("The encoder benchmark requires ffmpeg")
+    width, height = RESOLUTIONS[args.resolution]
+    directory = tempfile.mkdtemp(prefix='bench_encoders_')
+    try:
+        # NTSC frame rate, which an integer fps would round to 29
+        fps = 30000 / 1001
+        original_path, mask_path = write_synthetic_videos(directory, width, height, args.frames, fps)
+        with_audio = os.path.join(directory, 'original_audio.mp4')
+        add_test_tone(ffmpeg, original_path, with_audio)
+
+        print(f"{'encoder':<10}{'fps':>10}{'size MB':>10}{'output fps':>12}{'audio':>8}")
+        for backend in ('opencv', 'ffmpeg'):
+            output_path = os.path.join(directory, f'{backend}.mp4')
+            stats = composite_video(with_audio, mask_path, output_path, parallel=False,
+                                    writer_factory=functools.partial(make_encoder, backend=backend),
+                                    audio_source=with_audio, report_timings=False)
+            cap = cv2.VideoCapture(output_path)
+            output_fps = cap.get(cv2.CAP_PROP_FPS)
+            cap.release()
+            size_mb = os.path.getsize(output_path) / (1024 * 1024)
+            print(f"{backend:<10}{stats['frames'] / stats['seconds']:>10.1f}{size_mb:>10.2f}"
+                  f"{output_fps:>12.3f}{'yes' if has_audio(ffmpeg, output_path) else 'no':>8}")
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def moving_subject(width, height, frames):
+    """Yield (frame, mask) pairs of a textured disc moving over a still background.
+
+    Unlike write_synthetic_videos, the subject's pixels move with its mask, as
+    in real footage, so optical flow can follow it.
+    """
+    rng = np.random.default_rng(0)
+    background = cv2.GaussianBlur(rng.integers(0, 256, (height, width, 3), dtype=np.uint8), (9, 9), 0)
+    subject = cv2.GaussianBlur(rng.integers(0, 256, (height, width, 3), dtype=np.uint8), (5, 5), 0)
+    radius = height // 5
+    for index in range(frames):
+        # Speeds up and changes direction, so a held mask falls behind
+        t = index / max(frames - 1, 1)
+        center_x = int(width / 2 + width / 3 * np.sin(2 * np.pi * t))
+        center_y = int(height / 2 + height / 6 * np.sin(4 * np.pi * t))
+        mask = np.zeros((height, width), dtype=np.uint8)
+        cv2.circle(mask, (center_x, center_y), radius, 255, -1)
+        shifted = np.roll(subject, (center_y - height // 2, center_x - width // 2), axis=(0, 1))
+        frame = background.copy()
+        cv2.copyTo(shifted, mask, frame)
+        yield frame, mask
+
+
+def iou(a, b):
+    union = np.count_nonzero(a | b)
+    return np.count_nonzero(a & b) / union if union else 1.0
+
+
+def bench_subsampling(args):
+    """Mask quality and model cost of sub-sampled inference with hold and flow fill."""
+    width, height = RESOLUTIONS[args.resolution]
+    scenes = list(moving_subject(width, height, args.frames))
+    intervals = [int(value) for value in args.intervals.split(',')]
+
+    print(f"{'interval':>8}{'model frames':>14}{'fill':>6}{'mean IoU':>10}{'min IoU':>9}{'fill fps':>10}")
+    for interval in intervals:
+        cost = model_frames(len(scenes), interval)
+        for method in ('hold', 'flow'):
+            interpolator = MaskInterpolator(width, height, method)
+            scores = []
+            start = time.perf_counter()
+            for index, (frame, truth) in enumerate(scenes):
+                if index % interval == 0:
+                    mask = interpolator.key(frame, truth)
+                else:
+                    mask = interpolator.fill(frame)
+                scores.append(iou(mask >= 128, truth >= 128))
+            fps = len(scenes) / (time.perf_counter() - start)
+            print(f"{interval:>8}{cost:>7} ({cost / len(scenes):>4.0%}){method:>6}"
+                  f"{np.mean(scores):>10.3f}{min(scores):>9.3f}{fps:>10.1f}")
+            if interval == 1:
+                break
+
+
+def bench_upscaling(args):
+    """Mask quality of proxy inference: full-resolution masks scaled down and back up."""
+    width, height = RESOLUTIONS[args.resolution]
+    scenes = list(moving_subject(width, height, args.frames))
+
+    print(f"{'proxy':>10}{'pixels':>8}{'upscale':>9}{'mean IoU':>10}{'fps':>9}")
+    for max_dim in (1280, 854, 640, 480):
+        size = proxy_size(width, height, max_dim)
+        if size is None:
+            continue
+        small_masks = [cv2.resize(truth, size, interpolation=cv2.INTER_AREA) for _, truth in scenes]
+        for method in ('linear', 'guided'):
+            upscaler = MaskUpscaler(width, height, method)
+            scores = []
+            start = time.perf_counter()
+            for (frame, truth), small in zip(scenes, small_masks):
+                scores.append(iou(upscaler.upscale(small, frame) > 0, truth > 0))
+            fps = len(scenes) / (time.perf_counter() - start)
+            pixels = size[0] * size[1] / (width * height)
+            print(f"{size[0]:>5}x{size[1]:<4}{pixels:>8.0%}{method:>9}{np.mean(scores):>10.4f}{fps:>9.1f}")
+
+
+def talking_head(width, height, frames, hold=1, scale=1.0):
+    """Yield (frame, mask) pairs of a head-and-shoulders subject on a fixed camera.
+
+    The subject sways a little and its mask is updated every hold frames
+    (0 never moves it). scale sets the subject size. Masks are noisy BGR
+    frames, like decoded mask videos.
+    """
+    rng = np.random.default_rng(0)
+    frame = rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+    noise = rng.integers(-8, 9, (height, width, 3)).astype(np.int16)
+    head = (int(width / 12 * scale), int(height / 6 * scale))
+    body = (int(width / 5 * scale), int(height * 2 / 5 * scale))
+    # Masks repeat as the subject sways back and forth, share them to save memory
+    masks = {}
+    for index in range(frames):
+        sway = int(width / 40 * np.sin(index // hold / 10)) if hold else 0
+        if sway not in masks:
+            mask = np.zeros((height, width, 3), dtype=np.uint8)
+            cv2.ellipse(mask, (width // 2 + sway, height - body[1] - head[1] // 2), head, 0, 0, 360,
+                        (255, 255, 255), -1)
+            cv2.ellipse(mask, (width // 2 + sway, height), body, 0, 180, 360, (255, 255, 255), -1)
+            masks[sway] = np.clip(mask + noise, 0, 255).astype(np.uint8)
+        yield frame, masks[sway]
+
+
+def bench_roi(args):
+    """Whole-frame vs bounding-box compositing of talking-head footage.
+
+    Output buffers cycle through a pool, as in the pipeline, and both modes
+    must produce the same pixels.
+    """
+    width, height = RESOLUTIONS[args.resolution]
+    print(f"{'footage':<24}{'coverage':>10}{'full fps':>10}{'roi fps':>10}{'speedup':>10}")
+    footage = (
+        ('talking head', 1, 1.0),
+        ('small subject', 1, 0.5),
+        ('held masks (interval 3)', 3, 1.0),
+        ('static camera', 0, 1.0),
+    )
+    for name, hold, scale in footage:
+        pairs = list(talking_head(width, height, args.frames, hold, scale))
+        coverage = np.count_nonzero(pairs[0][1][..., 0] >= 10) / (width * height)
+        pools = {roi: [np.empty((height, width, 3), dtype=np.uint8) for _ in range(6)]
+                 for roi in (False, True)}
+        compositors = {roi: Compositor(width, height, GREEN_BGR, roi=roi) for roi in (False, True)}
+        for index, (frame, mask) in enumerate(pairs):
+            full, roi = (compositors[roi].composite(frame, mask, pools[roi][index % 6])
+                         for roi in (False, True))
+            if not np.array_equal(full, roi):
+                raise AssertionError(f"ROI output differs at frame {index} of {name}")
+
+        fps = {}
+        for roi in (False, True):
+            compositor = Compositor(width, height, GREEN_BGR, roi=roi)
+            start = time.perf_counter()
+            for index, (frame, mask) in enumerate(pairs):
+                compositor.composite(frame, mask, pools[roi][index % 6])
+            fps[roi] = len(pairs) / (time.perf_counter() - start)
+        print(f"{name:<24}{coverage:>9.0%}{fps[False]:>10.1f}{fps[True]:>10.1f}"
+              f"{fps[True] / fps[False]:>9.2f}x")
+
+
+def bench_archive(args):
+    """Mask video vs mask archive: size, sequential reads and random access."""
+    width, height = RESOLUTIONS[args.resolution]
+    directory = tempfile.mkdtemp(prefix='bench_archive_')
+    try:
+        video_path = os.path.join(directory, 'mask.mp4')
+        writer = make_encoder(video_path, 25, width, height)
+        for _, mask in moving_subject(width, height, args.frames):
+            writer.write(cv2.cvtColor(mask, cv2.COLOR_GRAY2BGR))
+        writer.release()
+
+        archive_path = os.path.join(directory, 'mask.masks')
+        start = time.perf_counter()
+        convert_masks([video_path], archive_path)
+        convert_seconds = time.perf_counter() - start
+        decoded_bytes = width * height * 3 * args.frames
+        print(f"converted {args.frames} frames in {convert_seconds:.2f}s")
+        print(f"{'size':<24}{'mp4':>12}{'archive':>12}{'decoded':>14}")
+        print(f"{'':<24}{os.path.getsize(video_path):>12,}{os.path.getsize(archive_path):>12,}"
+              f"{decoded_bytes:>14,}")
+
+        # What the compositor does with each: threshold decoded frames, or read masks
+        compositor = Compositor(width, height)
+        cap = cv2.VideoCapture(video_path)
+        frame = np.empty((height, width, 3), dtype=np.uint8)
+        video_masks = []
+        start = time.perf_counter()
+        while cap.read(frame)[0]:
+            video_masks.append(compositor.foreground_mask(frame).copy())
+        video_fps = len(video_masks) / (time.perf_counter() - start)
+        cap.release()
+
+        archive = MaskArchive(archive_path)
+        mask = np.empty((height, width), dtype=np.uint8)
+        start = time.perf_counter()
+        for index in range(len(archive)):
+            archive.frame(index, mask)
+            if not np.array_equal(compositor.foreground_mask(mask), video_masks[index]):
+                raise AssertionError(f"Archive mask {index} differs from the thresholded video frame")
+        archive_fps = len(archive) / (time.perf_counter() - start)
+        print(f"{'sequential reads (fps)':<24}{video_fps:>12.1f}{archive_fps:>12.1f}")
+
+        # Jump to the middle, as a segment worker or a single-frame preview does
+        target = args.frames // 2
+        start = time.perf_counter()
+        cap = cv2.VideoCapture(video_path)
+        seek(cap, target)
+        cap.read(frame)
+        cap.release()
+        video_ms = (time.perf_counter() - start) * 1000
+        start = time.perf_counter()
+        MaskArchive(archive_path).frame(target, mask)
+        archive_ms = (time.perf_counter() - start) * 1000
+        print(f"{f'read frame {target} (ms)':<24}{video_ms:>12.1f}{archive_ms:>12.1f}")
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def bench_chunking(args):
+    """One long prediction vs concurrent chunk predictions with a fake model.
+
+    The fake takes ms_per_frame for every frame of its input, like a model
+    whose run time grows with video length. Also checks that the clicks
+    carried into each chunk still land on the subject.
+    """
+    width, height = RESOLUTIONS['720p']
+    directory = tempfile.mkdtemp(prefix='bench_chunking_')
+    try:
+        video_path = os.path.join(directory, 'video.mp4')
+        writer = make_encoder(video_path, 30, width, height)
+        truths = []
+        for frame, truth in moving_subject(width, height, args.frames):
+            writer.write(frame)
+            truths.append(truth)
+        writer.release()
+        ys, xs = np.nonzero(truths[0])
+        click = [int(xs.mean()), int(ys.mean())]
+
+        frames_of = {}
+        predictor = FakePredictor('mask.mp4', delay=lambda input: frames_of[input['input_video']] * args.ms_per_frame / 1000)
+
+        def predict(path, points):
+            frames_of[path] = frame_count(path)
+            return predictor('sam2', {'input_video': path, 'click_coordinates': points})
+
+        frames_of[video_path] = args.frames
+        start = time.perf_counter()
+        predictor('sam2', {'input_video': video_path})
+        print(f"{'single prediction':<24}{time.perf_counter() - start:8.2f}s")
+
+        start = time.perf_counter()
+        chunks = split_video(video_path, directory, args.chunk_frames, [click])
+        split_seconds = time.perf_counter() - start
+        inside = sum(truths[index * args.chunk_frames][y, x] > 0 for index, (_, [[x, y]]) in enumerate(chunks))
+        print(f"split into {len(chunks)} chunks     {split_seconds:8.2f}s  "
+              f"(carried click on subject in {inside}/{len(chunks)} chunks)")
+        for concurrency in (1, 2, 4, 8):
+            start = time.perf_counter()
+            predict_chunks(chunks, predict, concurrency)
+            seconds = time.perf_counter() - start + split_seconds
+            print(f"{f'chunked, concurrency {concurrency}':<24}{seconds:8.2f}s")
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def full_frame_feather(frame, mask, background, feather):
+    """Soft edges the straightforward way: blend every pixel in float."""
+    size = 2 * feather + 1
+    alpha = cv2.blur(mask, (size, size), borderType=cv2.BORDER_REPLICATE).astype(np.float32)[..., None] / 255
+    background = background.astype(np.float32)
+    return (background + (frame.astype(np.float32) - background) * alpha + 0.5).astype(np.uint8)
+
+
+def bench_backgrounds(args):
+    """Hard vs feathered edges, and still vs video backgrounds.
+
+    Feathered output must match a full-frame float blend exactly.
+    """
+    width, height = RESOLUTIONS[args.resolution]
+    pairs = list(talking_head(width, height, args.frames))
+    pool = [np.empty((height, width, 3), dtype=np.uint8) for _ in range(6)]
+    background = np.empty((height, width, 3), dtype=np.uint8)
+    background[:] = (255, 0, 0)
+
+    compositor = Compositor(width, height, '#0000ff', feather=args.feather)
+    mask = np.empty((height, width), dtype=np.uint8)
+    start = time.perf_counter()
+    for index, (frame, mask_frame) in enumerate(pairs):
+        np.copyto(mask, compositor.foreground_mask(mask_frame))
+        expected = full_frame_feather(frame, mask, background, args.feather)
+        if not np.array_equal(compositor.composite(frame, mask_frame, pool[index % 6]), expected):
+            raise AssertionError(f"Feathered output differs from a full-frame blend at frame {index}")
+    reference_fps = len(pairs) / (time.perf_counter() - start)
+
+    directory = tempfile.mkdtemp(prefix='bench_backgrounds_')
+    try:
+        # A half-size clip of a drifting gradient, stretched to the video size
+        video_path = os.path.join(directory, 'background.mp4')
+        writer = make_encoder(video_path, 25, width // 2, height // 2)
+        ramp = np.linspace(0, 255, width // 2, dtype=np.float32)
+        for index in range(50):
+            row = ((ramp + index * 5) % 256).astype(np.uint8)
+            writer.write(cv2.merge([np.tile(row, (height // 2, 1))] * 3))
+        writer.release()
+
+        print(f"{'edges':<30}{'fps':>10}")
+        print(f"{'full-frame float blend':<30}{reference_fps:>10.1f}  (includes the compositor)")
+        runs = (
+            ('hard, color', '#0000ff', 0),
+            (f'feather {args.feather}, color', '#0000ff', args.feather),
+            ('hard, video', video_path, 0),
+            (f'feather {args.feather}, video', video_path, args.feather),
+        )
+        for name, spec, feather in runs:
+            compositor = Compositor(width, height, spec, feather=feather)
+            start = time.perf_counter()
+            for index, (frame, mask_frame) in enumerate(pairs):
+                compositor.composite(frame, mask_frame, pool[index % 6])
+            print(f"{name:<30}{len(pairs) / (time.perf_counter() - start):>10.1f}")
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+E2E_FLOWS = ('mask', 'greenscreen', 'annotations')
+
+
+def write_e2e_videos(directory, width, height, frames, coverage, fps=25):
+    """Write the videos of one end-to-end case.
+
+    original.mp4 is textured footage, mask.mp4 the SAM2 mask of a subject
+    covering about coverage of the frame, and output.mp4 what SAM2 returns
+    when it composites for us: the subject over black.
+    """
+    os.makedirs(directory, exist_ok=True)
+    writers = {name: make_encoder(os.path.join(directory, f'{name}.mp4'), fps, width, height)
+               for name in ('original', 'mask', 'output')}
+    rng = np.random.default_rng(0)
+    texture = cv2.GaussianBlur(rng.integers(0, 256, (height, width, 3), dtype=np.uint8), (5, 5), 0)
+    # An ellipse of the frame's proportions with the requested area
+    axes = (int(width * np.sqrt(coverage / np.pi)), int(height * np.sqrt(coverage / np.pi)))
+    mask = np.empty((height, width, 3), dtype=np.uint8)
+    output = np.empty((height, width, 3), dtype=np.uint8)
+    try:
+        for index in range(frames):
+            frame = np.roll(texture, index * 3, axis=1)
+            center = (int(width / 2 + width / 20 * np.sin(index / 10)), height // 2)
+            mask.fill(0)
+            cv2.ellipse(mask, center, axes, 0, 0, 360, (255, 255, 255), -1)
+            output.fill(0)
+            cv2.copyTo(frame, mask, output)
+            writers['original'].write(frame)
+            writers['mask'].write(mask)
+            writers['output'].write(output)
+    finally:
+        for writer in writers.values():
+            writer.release()
+    return center
+
+
+def peak_rss():
+    """Peak resident memory of this process and of its finished children, in bytes."""
+    try:
+        import resource
+    except ImportError:
+        return None, None
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    unit = 1 if sys.platform == 'darwin' else 1024
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * unit,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * unit)
+
+
+def directory_bytes(path):
+    total = 0
+    for root, _, names in os.walk(path):
+        for name in names:
+            with contextlib.suppress(OSError):
+                total += os.path.getsize(os.path.join(root, name))
+    return total
+
+
+def run_e2e_case(case, base_url, directory):
+    """Run one flow of one case and return its measurements.
+
+    Runs in a fresh process, so peak memory belongs to this case alone.
+    The caller sets up its environment (see e2e_environment), since modules
+    read their configuration when imported. SAM2 is a FakePredictor and
+    uploads go to LocalStorage.
+    """
+    os.chdir(directory)
+    # Imported here, after the environment is set up
+    import run
+
+    case_url = f"{base_url}/{case['name']}"
+    set_storage(LocalStorage(os.path.join(directory, 'uploads')))
+    run.predictor = FakePredictor(f'{case_url}/mask.mp4', delay=case['model_seconds'])
+
+    # Wall time of each stage, from wrappers around what run.py calls
+    stages = {}
+    pipeline_stages = {}
+
+    def add(name, start):
+        stages[name] = stages.get(name, 0.0) + time.perf_counter() - start
+
+    def timed(name, function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                add(name, start)
+        return wrapper
+
+    video_inputs = run.video_inputs
+
+    @contextlib.contextmanager
+    def timed_inputs(*urls, **kwargs):
+        start = time.perf_counter()
+        with video_inputs(*urls, **kwargs) as sources:
+            add('download', start)
+            yield sources
+
+    composite_video = run.composite_video
+
+    def timed_composite(*args, **kwargs):
+        start = time.perf_counter()
+        result = composite_video(*args, **kwargs)
+        add('composite', start)
+        for name, timing in result.get('stages', {}).items():
+            pipeline_stages[name] = timing['busy']
+        return result
+
+    run.video_inputs = timed_inputs
+    run.composite_video = timed_composite
+    run.acquire_mask_archives = timed('mask_archives', run.acquire_mask_archives)
+    run.upload_to_gcp = timed('upload', run.upload_to_gcp)
+
+    baseline_rss, _ = peak_rss()
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        start = time.perf_counter()
+        if case['flow'] == 'mask':
+            if run.process_video_with_mask(f'{case_url}/original.mp4', f'{case_url}/mask.mp4') is None:
+                raise RuntimeError('process_video_with_mask failed')
+        elif case['flow'] == 'greenscreen':
+            output_path = run.process_video_with_green_screen(f'{case_url}/output.mp4')
+            if output_path is None:
+                raise RuntimeError('process_video_with_green_screen failed')
+            os.replace(output_path, os.path.join(directory, 'greenscreen.mp4'))
+        else:
+            client = run.create_app().test_client()
+            x, y = case['click']
+            response = client.post('/save_annotations', json={
+                'url': f'{case_url}/original.mp4', 'bypass_cache': True, 'output_mode': 'mp4',
+                'points': [{'x': x, 'y': y, 'label': 1, 'object': 'mask_1'}]})
+            job_id = response.get_json()['job_id']
+            while True:
+                job = client.get(f'/jobs/{job_id}').get_json()
+                if job['status'] in ('done', 'failed'):
+                    break
+                time.sleep(0.01)
+            if job['status'] == 'failed':
+                raise RuntimeError(f"Job failed: {job['error']}")
+            for name, seconds in job['timings'].items():
+                stages[f'job_{name}'] = seconds
+        seconds = time.perf_counter() - start
+    rss, child_rss = peak_rss()
+
+    written = {name: directory_bytes(os.path.join(directory, name))
+               for name in ('output', 'uploads', 'video_cache', 'mask_archives')}
+    if case['flow'] == 'greenscreen':
+        written['output'] += os.path.getsize(os.path.join(directory, 'greenscreen.mp4'))
+    return dict(
+        {key: value for key, value in case.items() if key not in ('name', 'click')},
+        seconds=seconds,
+        fps=case['frames'] / seconds,
+        baseline_rss_bytes=baseline_rss,
+        peak_rss_bytes=rss,
+        peak_child_rss_bytes=child_rss,
+        bytes_written=sum(written.values()),
+        written=written,
+        stages=stages,
+        pipeline_busy=pipeline_stages,
+    )
+
+
+def e2e_environment(directory):
+    """Environment of a run: every cache and output directory lives in directory."""
+    return {
+        'REPLICATE_API_TOKEN': 'offline',
+        'VIDEO_CACHE_DIR': os.path.join(directory, 'video_cache'),
+        'MASK_ARCHIVE_DIR': os.path.join(directory, 'mask_archives'),
+        'RESULT_CACHE_PATH': os.path.join(directory, 'results.sqlite3'),
+        'RENDER_CACHE_DIR': os.path.join(directory, 'renders'),
+        'STATE_BACKEND': 'memory',
+        'PIPELINE_REPORT_TIMINGS': '0',
+    }
+
+
+@contextlib.contextmanager
+def patched_environ(values):
+    saved = {name: os.environ.get(name) for name in values}
+    os.environ.update(values)
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+
+def e2e_key(result):
+    return (result['flow'], result['resolution'], result['frames'], result['coverage'])
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def bench_e2e(args):
+    """Whole flows of run.py on synthetic videos, without network access or billing.
+
+    Videos are served from a local HTTP server, SAM2 is answered by a
+    FakePredictor and uploads go to LocalStorage. Each run is a separate
+    process. Results are written as JSON to --output; with --baseline, the
+    speed and memory of each run are compared to an earlier results file.
+    """
+    flows = args.flows.split(',')
+    for flow in flows:
+        if flow not in E2E_FLOWS:
+            raise SystemExit(f"Unknown flow {flow}, choose from {', '.join(E2E_FLOWS)}")
+    directory = tempfile.mkdtemp(prefix='bench_e2e_')
+    results = []
+    try:
+        cases = []
+        for resolution in args.resolutions.split(','):
+            width, height = RESOLUTIONS[resolution]
+            for frames in map(int, args.frames.split(',')):
+                for coverage in map(float, args.coverages.split(',')):
+                    name = f'{resolution}_{frames}_{coverage}'
+                    click = write_e2e_videos(os.path.join(directory, 'videos', name), width, height,
+                                             frames, coverage)
+                    for flow in flows:
+                        cases.append({'flow': flow, 'resolution': resolution, 'frames': frames,
+                                      'coverage': coverage, 'model_seconds': args.model_seconds,
+                                      'name': name, 'click': click})
+
+        print(f"{'flow':<13}{'resolution':>11}{'frames':>8}{'coverage':>10}{'fps':>9}"
+              f"{'peak MB':>9}{'written MB':>12}  stages (s)")
+        context = multiprocessing.get_context('spawn')
+        with LocalHTTPServer(os.path.join(directory, 'videos')) as server:
+            for index, case in enumerate(cases):
+                run_directory = os.path.join(directory, 'runs', str(index))
+                os.makedirs(run_directory)
+                # Spawned processes start with the environment of this one
+                with patched_environ(e2e_environment(run_directory)), \
+                        ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                    result = executor.submit(run_e2e_case, case, server.base_url, run_directory).result()
+                results.append(result)
+                stages = '  '.join(f'{name} {seconds:.2f}' for name, seconds in result['stages'].items())
+                peak = (result['peak_rss_bytes'] or 0) / 1024 ** 2
+                print(f"{result['flow']:<13}{result['resolution']:>11}{result['frames']:>8}"
+                      f"{result['coverage']:>10.0%}{result['fps']:>9.1f}{peak:>9.0f}"
+                      f"{result['bytes_written'] / 1024 ** 2:>12.1f}  {stages}")
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    report = {
+        'commit': git_commit(),
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'platform': {'python': platform.python_version(), 'system': platform.platform(),
+                     'cpus': os.cpu_count(), 'opencv': cv2.__version__},
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Wrote {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        previous = {e2e_key(result): result for result in baseline['results']}
+        print(f"Compared to {args.baseline} ({(baseline.get('commit') or 'unknown')[:12]}):")
+        print(f"{'flow':<13}{'resolution':>11}{'frames':>8}{'coverage':>10}{'fps':>10}{'peak RSS':>10}")
+        for result in results:
+            before = previous.get(e2e_key(result))
+            if before is None:
+                continue
+            rss_ratio = (result['peak_rss_bytes'] / before['peak_rss_bytes']
+                         if result['peak_rss_bytes'] and before['peak_rss_bytes'] else float('nan'))
+            print(f"{result['flow']:<13}{result['resolution']:>11}{result['frames']:>8}"
+                  f"{result['coverage']:>10.0%}{result['fps'] / before['fps']:>9.2f}x{rss_ratio:>9.2f}x")
+
+
+def install_fakes(mask_url, model_seconds, directory, run, app):
+    """Answer SAM2 with FakePredictor and upload to LocalStorage in a server worker."""
+    run.predictor = FakePredictor(mask_url, delay=model_seconds)
+    set_storage(LocalStorage(os.path.join(directory, 'uploads')))
+
+
+def run_load_server(directory, bind, workers, setup):
+    """Serve from directory with gunicorn, logging to server.log there."""
+    os.chdir(directory)
+    log = os.open(os.path.join(directory, 'server.log'), os.O_WRONLY | os.O_CREAT | os.O_APPEND)
+    os.dup2(log, 1)
+    os.dup2(log, 2)
+    serve.serve(bind=bind, workers=workers, threads=8, backend='gunicorn', setup=setup)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def annotate(base_url, video_url, click):
+    """Submit one annotation and wait for its job; returns (seconds, status polls, errors)."""
+    session = requests.Session()
+    start = time.perf_counter()
+    response = session.post(f'{base_url}/save_annotations', json={
+        'url': video_url, 'bypass_cache': True, 'output_mode': 'mp4',
+        'points': [{'x': click[0], 'y': click[1], 'label': 1, 'object': 'mask_1'}]})
+    job_id = response.json()['job_id']
+    polls = errors = 0
+    while True:
+        time.sleep(0.05)
+        response = session.get(f'{base_url}/jobs/{job_id}')
+        polls += 1
+        if response.status_code != 200:
+            # Another worker that cannot see the job answered
+            errors += 1
+            continue
+        job = response.json()
+        if job['status'] == 'failed':
+            raise RuntimeError(f"Job failed: {job['error']}")
+        if job['status'] == 'done':
+            return time.perf_counter() - start, polls, errors
+
+
+def bench_serve(args):
+    """Concurrent annotations against serve.py with 1, 2, 4... gunicorn workers.
+
+    Every job runs fake inference, composites a short 720p video and uploads
+    it to LocalStorage. Status polls go to whichever worker accepts them,
+    so they only succeed when the workers share their job store.
+    """
+    if not importlib.util.find_spec('gunicorn'):
+        raise SystemExit("The serve benchmark needs gunicorn: pip install gunicorn")
+    width, height = RESOLUTIONS['720p']
+    directory = tempfile.mkdtemp(prefix='bench_serve_')
+    context = multiprocessing.get_context('spawn')
+    try:
+        videos = os.path.join(directory, 'videos')
+        click = write_e2e_videos(videos, width, height, args.frames, 0.3)
+        print(f"{args.jobs} annotations from {args.clients} clients, fake SAM2 taking {args.model_seconds}s")
+        print(f"{'workers':<10}{'jobs/s':>10}{'p50 s':>10}{'p95 s':>10}{'polls':>8}{'misses':>8}")
+        with LocalHTTPServer(videos) as videos_server:
+            for workers in map(int, args.workers.split(',')):
+                run_directory = os.path.join(directory, f'workers_{workers}')
+                os.makedirs(run_directory)
+                port = free_port()
+                base_url = f'http://127.0.0.1:{port}'
+                setup = functools.partial(install_fakes, videos_server.url('mask.mp4'), args.model_seconds,
+                                          run_directory)
+                environment = dict(e2e_environment(run_directory),
+                                   STATE_PATH=os.path.join(run_directory, 'state.sqlite3'),
+                                   JOB_STORE_PATH=os.path.join(run_directory, 'jobs.sqlite3'))
+                with patched_environ(environment):
+                    server = context.Process(target=run_load_server,
+                                             args=(run_directory, f'127.0.0.1:{port}', workers, setup))
+                    server.start()
+                try:
+                    deadline = time.time() + 60
+                    while True:
+                        try:
+                            if requests.get(base_url, timeout=1).status_code == 200:
+                                break
+                        except requests.ConnectionError:
+                            pass
+                        if time.time() > deadline or not server.is_alive():
+                            raise RuntimeError(f"Server did not start, see {run_directory}/server.log")
+                        time.sleep(0.2)
+
+                    start = time.perf_counter()
+                    with ThreadPoolExecutor(max_workers=args.clients) as executor:
+                        results = list(executor.map(
+                            lambda _: annotate(base_url, videos_server.url('original.mp4'), click),
+                            range(args.jobs)))
+                    seconds = time.perf_counter() - start
+                finally:
+                    server.terminate()
+                    server.join(30)
+                latencies = sorted(latency for latency, _, _ in results)
+                print(f"{workers:<10}{args.jobs / seconds:>10.2f}{latencies[len(latencies) // 2]:>10.2f}"
+                      f"{latencies[int(len(latencies) * 0.95)]:>10.2f}{sum(r[1] for r in results):>8}"
+                      f"{sum(r[2] for r in results):>8}")
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def run_batch_case(directory, manifest, mask_url, model_seconds, workers, inference_concurrency):
+    """Run a manifest through batch.py twice in a fresh process; the second pass must skip every item."""
+    os.chdir(directory)
+    # Imported here, after the environment is set up
+    import batch
+
+    set_storage(LocalStorage(os.path.join(directory, 'uploads')))
+    batch.run.predictor = FakePredictor(mask_url, delay=model_seconds)
+    items = batch.read_manifest(manifest)
+    checkpoint = batch.Checkpoint(os.path.join(directory, 'checkpoint.jsonl'))
+    start = time.perf_counter()
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        jobs = batch.process(items, checkpoint, workers, {'inference': inference_concurrency})
+        seconds = time.perf_counter() - start
+        # Resume as batch.main() does: only items missing from the checkpoint run again
+        done = checkpoint.done()
+        calls = len(batch.run.predictor.calls)
+        resumed = batch.process([item for item in items if item[0] not in done], checkpoint, workers,
+                                {'inference': inference_concurrency})
+    assert not resumed, f"{len(resumed)} items ran again after resuming"
+    assert len(batch.run.predictor.calls) == calls, "Resuming ran SAM2 again"
+    return {
+        'seconds': seconds,
+        'done': sum(job.status == 'done' for job in jobs),
+        'inference': sum(job.timings.get('inference', 0) for job in jobs) / max(len(jobs), 1),
+        'compositing': sum(job.timings.get('compositing', 0) for job in jobs) / max(len(jobs), 1),
+        'resumed': len(resumed),
+    }
+
+
+def bench_batch(args):
+    """Throughput of batch.py over a manifest of short 720p videos, by inference concurrency.
+
+    SAM2 is a FakePredictor taking --model-seconds, so the inference limit
+    decides how many predictions wait at once while compositing keeps its
+    own limit. Each run starts with empty caches; 'resumed' counts the
+    items a second run would process again, which must be 0.
+    """
+    width, height = RESOLUTIONS['720p']
+    directory = tempfile.mkdtemp(prefix='bench_batch_')
+    context = multiprocessing.get_context('spawn')
+    try:
+        videos = os.path.join(directory, 'videos')
+        click = write_e2e_videos(videos, width, height, args.frames, 0.3)
+        print(f"{args.items} items of {args.frames} frames, {args.workers} workers, "
+              f"fake SAM2 taking {args.model_seconds}s")
+        print(f"{'inference':<10}{'items/min':>10}{'infer s':>10}{'comp s':>10}{'done':>6}{'resumed':>9}")
+        with LocalHTTPServer(videos) as server:
+            manifest = os.path.join(directory, 'manifest.jsonl')
+            with open(manifest, 'w') as f:
+                for index in range(args.items):
+                    f.write(json.dumps({'id': f'item_{index}', 'url': server.url('original.mp4'),
+                                        'points': [{'x': click[0] + index, 'y': click[1]}]}) + '\n')
+            for concurrency in map(int, args.inference_concurrency.split(',')):
+                run_directory = os.path.join(directory, f'inference_{concurrency}')
+                os.makedirs(run_directory)
+                with patched_environ(e2e_environment(run_directory)):
+                    with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                        result = executor.submit(run_batch_case, run_directory, manifest, server.url('mask.mp4'),
+                                                 args.model_seconds, args.workers, concurrency).result()
+                print(f"{concurrency:<10}{args.items / result['seconds'] * 60:>10.1f}{result['inference']:>10.2f}"
+                      f"{result['compositing']:>10.2f}{result['done']:>6}{result['resumed']:>9}")
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+# Modules the server must not load just by being imported
+LAZY_MODULES = ('tkinter', 'PIL', 'asyncio', 'replicate', 'google.cloud.storage')
+
+IMPORT_PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import run
+imported = time.perf_counter()
+run.create_app()
+built = time.perf_counter()
+print(json.dumps({'import': imported - start, 'create_app': built - imported,
+                  'loaded': [name for name in %r if name in sys.modules]}))
+"""
+
+
+def direct_imports(report, parent):
+    """(cumulative microseconds, name) of the modules parent imports itself, from -X importtime output.
+
+    The report lists every module after the modules it imports, which are
+    indented one level deeper, so parent's imports are the lines above it
+    down to the previous module of its own level.
+    """
+    entries = []
+    for line in report.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        entries.append((len(name) - len(name.lstrip()), int(cumulative), name.strip()))
+    index = next((index for index, (_, _, name) in enumerate(entries) if name == parent), None)
+    if index is None:
+        return []
+    depth = entries[index][0]
+    modules = []
+    for indent, cumulative, name in reversed(entries[:index]):
+        if indent <= depth:
+            break
+        if indent == depth + 2:
+            modules.append((cumulative, name))
+    return modules
+
+
+def bench_importtime(args):
+    """Cold import of run.py and building the app, in fresh interpreters.
+
+    Runs without credentials or .env, from an empty directory, and lists
+    the heaviest modules run.py pulls in according to python -X importtime.
+    """
+    root = os.path.dirname(os.path.abspath(__file__))
+    directory = tempfile.mkdtemp(prefix='bench_importtime_')
+    environment = {name: value for name, value in os.environ.items()
+                   if name not in ('REPLICATE_API_TOKEN', 'GCP_CREDENTIALS_PATH')}
+    environment['PYTHONPATH'] = root
+    probe = IMPORT_PROBE % (LAZY_MODULES,)
+    try:
+        runs = []
+        for _ in range(args.runs):
+            result = subprocess.run([sys.executable, '-X', 'importtime', '-c', probe], cwd=directory,
+                                    env=environment, capture_output=True, text=True)
+            if result.returncode != 0:
+                raise RuntimeError(f"Importing run.py failed:\n{result.stderr[-2000:]}")
+            runs.append((json.loads(result.stdout.strip().splitlines()[-1]), result.stderr))
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    imports = sorted(timing['import'] for timing, _ in runs)
+    builds = sorted(timing['create_app'] for timing, _ in runs)
+    print(f"import run     {imports[len(imports) // 2] * 1000:8.1f} ms  (median of {args.runs})")
+    print(f"create_app()   {builds[len(builds) // 2] * 1000:8.1f} ms")
+    loaded = runs[0][0]['loaded']
+    print(f"lazy modules loaded: {', '.join(loaded) if loaded else 'none'}")
+
+    # Direct imports of run, by cumulative microseconds, from the last run
+    modules = direct_imports(runs[-1][1], 'run')
+    print("heaviest imports of run.py:")
+    for cumulative, name in sorted(modules, reverse=True)[:args.top]:
+        print(f"  {name:<24}{cumulative / 1000:8.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    compositing = subparsers.add_parser('compositing', help='Frame compositing kernel')
+    compositing.add_argument('--frames', type=int, default=50)
+    compositing.set_defaults(func=bench_compositing)
+
+    segments = subparsers.add_parser('segments', help='Segment-parallel compositing')
+    segments.add_argument('--frames', type=int, default=300)
+    segments.add_argument('--workers', type=int, default=None)
+    segments.add_argument('--segment-frames', type=int, default=64)
+    segments.set_defaults(func=bench_segments)
+
+    download = subparsers.add_parser('downloads', help='Single-stream vs ranged downloads')
+    download.add_argument('--size-mb', type=int, default=64)
+    download.add_argument('--rate-mb', type=float, default=20,
+                          help='Per-connection server rate limit in MB/s (0 for none)')
+    download.set_defaults(func=bench_downloads)
+
+    upload = subparsers.add_parser('uploads', help='Sequential vs background uploads')
+    upload.add_argument('--files', type=int, default=4)
+    upload.add_argument('--size-mb', type=int, default=16)
+    upload.add_argument('--rate-mb', type=float, default=50,
+                        help='Per-upload rate limit in MB/s (0 for none)')
+    upload.set_defaults(func=bench_uploads)
+
+    encoder = subparsers.add_parser('encoders', help='mp4v vs ffmpeg encoder speed and size')
+    encoder.add_argument('--frames', type=int, default=150)
+    encoder.add_argument('--resolution', choices=sorted(RESOLUTIONS), default='1080p')
+    encoder.set_defaults(func=bench_encoders)
+
+    subsampling = subparsers.add_parser('subsampling', help='Quality vs cost of sub-sampled inference')
+    subsampling.add_argument('--frames', type=int, default=120)
+    subsampling.add_argument('--intervals', default='1,2,3,5,10')
+    subsampling.add_argument('--resolution', choices=sorted(RESOLUTIONS), default='720p')
+    subsampling.set_defaults(func=bench_subsampling)
+
+    upscaling = subparsers.add_parser('upscaling', help='Mask quality of proxy inference')
+    upscaling.add_argument('--frames', type=int, default=30)
+    upscaling.add_argument('--resolution', choices=sorted(RESOLUTIONS), default='1080p')
+    upscaling.set_defaults(func=bench_upscaling)
+
+    chunking = subparsers.add_parser('chunking', help='Single vs chunked concurrent inference')
+    chunking.add_argument('--frames', type=int, default=300)
+    chunking.add_argument('--chunk-frames', type=int, default=60)
+    chunking.add_argument('--ms-per-frame', type=float, default=100)
+    chunking.set_defaults(func=bench_chunking)
+
+    roi = subparsers.add_parser('roi', help='Whole-frame vs bounding-box compositing')
+    roi.add_argument('--frames', type=int, default=200)
+    roi.add_argument('--resolution', choices=RESOLUTIONS, default='1080p')
+    roi.set_defaults(func=bench_roi)
+
+    archive = subparsers.add_parser('archive', help='Mask video vs mask archive size and read speed')
+    archive.add_argument('--frames', type=int, default=250)
+    archive.add_argument('--resolution', choices=RESOLUTIONS, default='1080p')
+    archive.set_defaults(func=bench_archive)
+
+    backgrounds = subparsers.add_parser('backgrounds', help='Hard vs feathered edges, still vs video backgrounds')
+    backgrounds.add_argument('--frames', type=int, default=100)
+    backgrounds.add_argument('--resolution', choices=RESOLUTIONS, default='1080p')
+    backgrounds.add_argument('--feather', type=int, default=2)
+    backgrounds.set_defaults(func=bench_backgrounds)
+
+    e2e = subparsers.add_parser('e2e', help='Whole flows of run.py with local stand-ins for SAM2 and storage')
+    e2e.add_argument('--resolutions', default='720p,1080p')
+    e2e.add_argument('--frames', default='150', help='Comma-separated video lengths in frames')
+    e2e.add_argument('--coverages', default='0.1,0.5', help='Comma-separated fractions of the frame the subject covers')
+    e2e.add_argument('--flows', default=','.join(E2E_FLOWS))
+    e2e.add_argument('--model-seconds', type=float, default=0.0, help='Time the fake SAM2 takes per prediction')
+    e2e.add_argument('--output', default='benchmark_e2e.json')
+    e2e.add_argument('--baseline', default=None, help='Earlier results file to compare against')
+    e2e.set_defaults(func=bench_e2e)
+
+    load = subparsers.add_parser('serve', help='Concurrent annotation throughput vs gunicorn workers')
+    load.add_argument('--workers', default='1,2,4')
+    load.add_argument('--jobs', type=int, default=24)
+    load.add_argument('--clients', type=int, default=8)
+    load.add_argument('--frames', type=int, default=60)
+    load.add_argument('--model-seconds', type=float, default=1.0)
+    load.set_defaults(func=bench_serve)
+
+    importtime = subparsers.add_parser('importtime', help='Cold import and app factory time of run.py')
+    importtime.add_argument('--runs', type=int, default=5)
+    importtime.add_argument('--top', type=int, default=10)
+    importtime.set_defaults(func=bench_importtime)
+
+    batch = subparsers.add_parser('batch', help='Throughput of the batch CLI vs inference concurrency')
+    batch.add_argument('--items', type=int, default=12)
+    batch.add_argument('--frames', type=int, default=60)
+    batch.add_argument('--workers', type=int, default=8)
+    batch.add_argument('--inference-concurrency', default='1,4,8')
+    batch.add_argument('--model-seconds', type=float, default=2.0, help='Time the fake SAM2 takes per prediction')
+    batch.set_defaults(func=bench_batch)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+from encoders import make_encoder
+
+
+def configure():
+    """Read the chunking settings from the environment."""
+    global CHUNK_MIN_FRAMES, CHUNK_FRAMES, CHUNK_CONCURRENCY
+    # Videos with at least CHUNK_MIN_FRAMES frames are split into chunks of
+    # CHUNK_FRAMES frames that are segmented as separate, concurrent predictions
+    # (0 sends every video as one prediction)
+    CHUNK_MIN_FRAMES = int(os.getenv("CHUNK_MIN_FRAMES", "0"))
+    CHUNK_FRAMES = int(os.getenv("CHUNK_FRAMES", "900"))
+    # Predictions of one video running at the same time
+    CHUNK_CONCURRENCY = int(os.getenv("CHUNK_CONCURRENCY", "4"))
+
+
+configure()
+
+
+# Lucas-Kanade settings for following clicks into later chunks
+_LK_PARAMS = dict(winSize=(21, 21), maxLevel=3,
+                  criteria=(cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 30, 0.01))
+
+
+def chunk_length(chunk_frames=None, interval=1):
+    """Chunk length rounded to a multiple of the mask frame interval.
+
+    Chunks then start on frames that have a model mask, so the stitched mask
+    video lines up with the original as a single prediction would.
+    """
+    chunk_frames = chunk_frames or CHUNK_FRAMES
+    interval = max(1, int(interval or 1))
+    return max(1, round(chunk_frames / interval)) * interval
+
+
+def split_video(source, directory, chunk_frames, points):
+    """Cut source into chunks of chunk_frames frames and carry clicks into each.
+
+    points are [x, y] clicks on the first frame. They are followed through
+    the video with pyramidal Lucas-Kanade optical flow, so every chunk gets
+    the clicks where the subject is at its first frame and all chunks can
+    be segmented at the same time. Points that cannot be followed stay where
+    they were last seen. Returns (chunk_path, points) pairs; the video is
+    decoded once.
+    """
+    cap = cv2.VideoCapture(source)
+    width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+    height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    tracked = np.array(points, dtype=np.float32).reshape(-1, 1, 2)
+    chunks = []
+    writer = None
+    previous = None
+    index = 0
+    try:
+        while True:
+            ret, frame = cap.read()
+            if not ret:
+                break
+            gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+            if previous is not None and len(tracked):
+                moved, status, _ = cv2.calcOpticalFlowPyrLK(previous, gray, tracked, None, **_LK_PARAMS)
+                found = status.reshape(-1) == 1
+                tracked[found] = moved[found]
+                np.clip(tracked[..., 0], 0, width - 1, out=tracked[..., 0])
+                np.clip(tracked[..., 1], 0, height - 1, out=tracked[..., 1])
+
+            if index % chunk_frames == 0:
+                if writer is not None:
+                    writer.release()
+                path = os.path.join(directory, f'chunk_{len(chunks):05d}.mp4')
+                writer = make_encoder(path, fps, width, height)
+                chunks.append((path, [[int(round(x)), int(round(y))] for x, y in tracked.reshape(-1, 2)]))
+            writer.write(frame)
+            previous = gray
+            index += 1
+    finally:
+        cap.release()
+        if writer is not None:
+            writer.release()
+    return chunks
+
+
+def predict_chunks(chunks, predict_chunk, concurrency=None):
+    """Run predict_chunk(path, points) for every chunk, at most concurrency at a time.
+
+    Returns the outputs in chunk order.
+    """
+    workers = max(1, min(concurrency or CHUNK_CONCURRENCY, len(chunks)))
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='chunk') as executor:
+        return list(executor.map(lambda chunk: predict_chunk(*chunk), chunks))
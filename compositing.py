@@ -0,0 +1,421 @@
+import os
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+
+# Mask pixels darker than this are treated as background.
+# Threshold value of 10 to account for compression artifacts
+MASK_THRESHOLD = 10
+
+
+def configure():
+    """Read the compositing settings from the environment."""
+    global MASK_UPSCALE, GUIDED_FILTER_RADIUS, GUIDED_FILTER_EPS, GUIDED_FILTER_FIT_DIM, COMPOSITE_ROI
+    global MASK_FEATHER
+    # How masks smaller than the video (e.g. from proxy inference) are scaled up:
+    # 'guided' snaps their edges to the full-resolution frame, 'linear' does not
+    MASK_UPSCALE = os.getenv("MASK_UPSCALE", "guided")
+    # Guided filter window radius and regularization. The filter is fitted on
+    # images of at most GUIDED_FILTER_FIT_DIM pixels on their longest side, and
+    # the radius is in those pixels.
+    GUIDED_FILTER_RADIUS = int(os.getenv("GUIDED_FILTER_RADIUS", "2"))
+    GUIDED_FILTER_EPS = float(os.getenv("GUIDED_FILTER_EPS", "0.001"))
+    GUIDED_FILTER_FIT_DIM = int(os.getenv("GUIDED_FILTER_FIT_DIM", "480"))
+
+    # Composite only inside the bounding box of the mask, and skip restoring the
+    # background of output buffers whose last mask is unchanged (0 processes
+    # whole frames)
+    COMPOSITE_ROI = os.getenv("COMPOSITE_ROI", "1") == "1"
+
+    # Width in pixels of the soft edge blended between subject and background
+    # on each side of the mask outline (0 keeps hard edges)
+    MASK_FEATHER = int(os.getenv("MASK_FEATHER", "0"))
+
+
+configure()
+
+# Output buffers whose state the compositor remembers (pipelines cycle
+# through a small pool of them)
+_TRACKED_BUFFERS = 16
+# Looking for the box and for unchanged masks costs about what it saves when
+# every mask differs from the last and covers much of the frame. After this
+# many such masks in a row, whole frames are processed for a while before
+# looking again, twice as long each time up to _MAX_WHOLE_FRAMES.
+_CHANGED_STREAK = 4
+_MAX_WHOLE_FRAMES = 64
+
+# Green screen color (BGR)
+GREEN_BGR = (0, 255, 0)
+
+# What happens to an object's pixels: 'keep' shows them over the background,
+# 'replace' covers them with the background
+LAYER_POLICIES = ('keep', 'replace')
+
+
+def parse_color(value):
+    """Parse a '#rrggbb' string or a BGR sequence into a BGR tuple."""
+    if isinstance(value, str):
+        value = value.strip().lstrip('#')
+        if len(value) != 6:
+            raise ValueError(f"Invalid color: #{value}")
+        r, g, b = (int(value[i:i + 2], 16) for i in (0, 2, 4))
+        return (b, g, r)
+    color = tuple(int(c) for c in value)
+    if len(color) != 3:
+        raise ValueError(f"Invalid color: {value}")
+    return color
+
+
+class SolidBackground:
+    """Fills the background with a single color."""
+
+    def __init__(self, color=GREEN_BGR):
+        self.color = parse_color(color)
+
+    def prepare(self, width, height):
+        frame = np.empty((height, width, 3), dtype=np.uint8)
+        frame[:] = self.color
+        return frame
+
+
+class ImageBackground:
+    """Fills the background with a still image, stretched to the video size."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def prepare(self, width, height):
+        image = cv2.imread(self.path, cv2.IMREAD_COLOR)
+        if image is None:
+            raise ValueError(f"Could not read background image: {self.path}")
+        if image.shape[1] != width or image.shape[0] != height:
+            image = cv2.resize(image, (width, height), interpolation=cv2.INTER_AREA)
+        return np.ascontiguousarray(image)
+
+
+class VideoBackground:
+    """Plays a video behind the subject, looped and stretched to the video size.
+
+    Unlike still backgrounds it changes every frame: read() moves it to the
+    next frame and seek() to a frame of the composited video.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._cap = None
+        self._size = None
+
+    def prepare(self, width, height):
+        self._cap = cv2.VideoCapture(self.path)
+        if not self._cap.isOpened():
+            raise ValueError(f"Could not read background video: {self.path}")
+        self._size = (width, height)
+        self._frames = int(self._cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        frame = np.empty((height, width, 3), dtype=np.uint8)
+        self.read(frame)
+        self.seek(0)
+        return frame
+
+    def seek(self, frame_index):
+        self._cap.set(cv2.CAP_PROP_POS_FRAMES, frame_index % self._frames if self._frames else 0)
+
+    def read(self, out):
+        """Write the next background frame into out, starting over at the end."""
+        ret, frame = self._cap.read()
+        if not ret:
+            self.seek(0)
+            ret, frame = self._cap.read()
+            if not ret:
+                raise ValueError(f"Could not read background video: {self.path}")
+        if frame.shape[:2] == out.shape[:2]:
+            np.copyto(out, frame)
+        else:
+            cv2.resize(frame, self._size, dst=out, interpolation=cv2.INTER_AREA)
+        return out
+
+
+def make_background(spec=None):
+    """Build a background from a spec.
+
+    The spec can be None (green screen), a background object, a '#rrggbb'
+    color, a BGR sequence or a path to an image or video file.
+    """
+    if spec is None:
+        return SolidBackground()
+    if hasattr(spec, 'prepare'):
+        return spec
+    if isinstance(spec, str) and not spec.startswith('#'):
+        # Images are recognized by their content, anything else is played as video
+        if os.path.isfile(spec) and not cv2.haveImageReader(spec):
+            return VideoBackground(spec)
+        return ImageBackground(spec)
+    return SolidBackground(spec)
+
+
+class MaskUpscaler:
+    """Scales masks up to the video size and binarizes them.
+
+    The 'guided' method is the fast guided filter: the filter coefficients are
+    fitted at low resolution against a scaled-down copy of the frame, then
+    scaled up and applied to the full-resolution frame. Mask edges follow
+    edges in the picture instead of the blocky outline of the small mask.
+    Full-size buffers are allocated once per video.
+    """
+
+    def __init__(self, width, height, method=None, radius=None, eps=None, threshold=MASK_THRESHOLD):
+        self.method = method or MASK_UPSCALE
+        if self.method not in ('guided', 'linear'):
+            raise ValueError(f"Unknown mask upscale method: {self.method}")
+        self.width = width
+        self.height = height
+        self.radius = GUIDED_FILTER_RADIUS if radius is None else radius
+        self.eps = GUIDED_FILTER_EPS if eps is None else eps
+        self.threshold = threshold
+        self._output = np.empty((height, width), dtype=np.uint8)
+        self._scaled = np.empty((height, width), dtype=np.float32)
+        if self.method == 'guided':
+            self._gray = np.empty((height, width), dtype=np.uint8)
+            self._a = np.empty((height, width), dtype=np.float32)
+
+    def _box(self, image):
+        size = 2 * self.radius + 1
+        return cv2.boxFilter(image, cv2.CV_32F, (size, size), borderType=cv2.BORDER_REFLECT)
+
+    def upscale(self, mask_gray, frame=None):
+        """Return a full-size uint8 mask, 255 where the subject is.
+
+        frame is the full-resolution BGR frame that guides the edges.
+        """
+        size = (self.width, self.height)
+        # Clean up compression noise before scaling: 1.0 subject, 0.0 background
+        p = (mask_gray >= self.threshold).astype(np.float32)
+        if self.method == 'linear' or frame is None:
+            cv2.resize(p, size, dst=self._scaled, interpolation=cv2.INTER_LINEAR)
+        else:
+            cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY, dst=self._gray)
+            fit_scale = min(1.0, GUIDED_FILTER_FIT_DIM / max(mask_gray.shape))
+            fit_size = (max(1, round(mask_gray.shape[1] * fit_scale)),
+                        max(1, round(mask_gray.shape[0] * fit_scale)))
+            if fit_scale < 1.0:
+                p = cv2.resize(p, fit_size, interpolation=cv2.INTER_AREA)
+            guide = cv2.resize(self._gray, fit_size, interpolation=cv2.INTER_AREA).astype(np.float32)
+            guide *= 1 / 255
+
+            mean_i = self._box(guide)
+            mean_p = self._box(p)
+            var_i = self._box(guide * guide) - mean_i * mean_i
+            cov_ip = self._box(guide * p) - mean_i * mean_p
+            a = cov_ip / (var_i + self.eps)
+            b = mean_p - a * mean_i
+
+            # q = mean(a) * I + mean(b), with the coefficients scaled up
+            cv2.resize(self._box(a), size, dst=self._a, interpolation=cv2.INTER_LINEAR)
+            cv2.resize(self._box(b), size, dst=self._scaled, interpolation=cv2.INTER_LINEAR)
+            cv2.multiply(self._a, self._gray, dst=self._a, scale=1 / 255, dtype=cv2.CV_32F)
+            cv2.add(self._scaled, self._a, dst=self._scaled)
+        cv2.compare(self._scaled, 0.5, cv2.CMP_GE, dst=self._output)
+        return self._output
+
+
+class Compositor:
+    """Replaces the background of video frames using a mask.
+
+    All intermediate buffers are allocated once per video, so compositing a
+    frame does not allocate any full-frame arrays. Masks smaller than the
+    video are scaled up with a MaskUpscaler.
+
+    With roi, only the bounding box of the mask is composited. The compositor
+    remembers which box of each output buffer it last drew into and under
+    which mask, so the background is only restored where it was covered, and
+    not at all when the mask has not changed since that buffer was last used.
+    Output buffers must therefore not be modified between calls. While masks
+    keep changing from frame to frame, and behind video backgrounds, whole
+    frames are processed instead.
+
+    With feather, the subject's outline is blended into the background over
+    feather pixels on each side. Only pixels on that edge are blended, the
+    rest are copied as with hard edges. A video background starts at
+    start_frame, the first frame to be composited.
+    """
+
+    def __init__(self, width, height, background=None, threshold=MASK_THRESHOLD, mask_upscale=None,
+                 roi=None, feather=None, start_frame=0):
+        self.width = width
+        self.height = height
+        self.threshold = threshold
+        self.feather = MASK_FEATHER if feather is None else feather
+        self.upscaler = MaskUpscaler(width, height, mask_upscale, threshold=threshold)
+        self.background = make_background(background)
+        self._background_frame = self.background.prepare(width, height)
+        self.animated = hasattr(self.background, 'read')
+        if self.animated:
+            self.background.seek(start_frame)
+        self.roi = (COMPOSITE_ROI if roi is None else roi) and not self.animated
+        self._gray = np.empty((height, width), dtype=np.uint8)
+        self._mask = np.empty((height, width), dtype=np.uint8)
+        self._keep = np.empty((height, width), dtype=np.uint8)
+        self._replace = np.empty((height, width), dtype=np.uint8)
+        self._output = np.empty((height, width, 3), dtype=np.uint8)
+        # Last distinct mask, its bounding box and a counter bumped when it changes
+        self._last_mask = np.empty((height, width), dtype=np.uint8)
+        self._last_rect = None
+        self._last_total = 0
+        self._generation = 0
+        self._changed = 0
+        self._whole_frames = 0
+        self._backoff = _CHANGED_STREAK
+        # id(out) -> (out, generation, rect) of the last paste into each buffer.
+        # Holding out keeps its id from being reused by another array.
+        self._buffers = OrderedDict()
+
+    def foreground_mask(self, mask_frame, frame=None):
+        """Return a uint8 mask that is 255 where the subject should be kept.
+
+        frame guides the upscaling of masks smaller than the video.
+        """
+        full_size = mask_frame.shape[:2] == (self.height, self.width)
+        if mask_frame.ndim == 3:
+            gray = cv2.cvtColor(mask_frame, cv2.COLOR_BGR2GRAY, dst=self._gray if full_size else None)
+        else:
+            gray = mask_frame
+        if not full_size:
+            return self.upscaler.upscale(gray, frame)
+        # Pixels above threshold - 1 (i.e. not black) belong to the subject
+        cv2.threshold(gray, self.threshold - 1, 255, cv2.THRESH_BINARY, dst=self._mask)
+        return self._mask
+
+    def composite(self, frame, mask_frame, out=None):
+        """Composite frame over the background where mask_frame is not black.
+
+        The result is written into out (or an internal buffer that is reused
+        on the next call) and returned.
+        """
+        if out is None:
+            out = self._output
+        return self._paste(frame, self.foreground_mask(mask_frame, frame), out)
+
+    def composite_layers(self, frame, layers, out=None):
+        """Composite frame using several object masks, each with its own policy.
+
+        layers holds (mask_frame, policy) pairs, see LAYER_POLICIES. Pixels
+        inside any 'keep' mask show the frame unless a 'replace' mask covers
+        them. Without 'keep' layers the whole frame is kept except the
+        replaced objects.
+        """
+        if out is None:
+            out = self._output
+        self._keep.fill(0)
+        self._replace.fill(0)
+        has_keep = False
+        for mask_frame, policy in layers:
+            if policy not in LAYER_POLICIES:
+                raise ValueError(f"Unknown layer policy: {policy}")
+            target = self._keep if policy == 'keep' else self._replace
+            cv2.bitwise_or(target, self.foreground_mask(mask_frame, frame), dst=target)
+            has_keep = has_keep or policy == 'keep'
+        if not has_keep:
+            self._keep.fill(255)
+        # Saturating subtraction clears the replaced pixels from the kept ones
+        cv2.subtract(self._keep, self._replace, dst=self._keep)
+        return self._paste(frame, self._keep, out)
+
+    def _same_as_last(self, mask):
+        """Compare mask with the last distinct mask, remembering its box if it differs.
+
+        Row and column sums of the binary mask give both its pixel count and
+        bounding box in two fast passes. A mask with the same count that
+        matches the last one inside its box matches everywhere.
+        """
+        rows = cv2.reduce(mask, 1, cv2.REDUCE_SUM, dtype=cv2.CV_32S).ravel()
+        total = int(rows.sum())
+        if self._last_rect is not None and total == self._last_total:
+            x, y, w, h = self._last_rect
+            if not w or cv2.norm(mask[y:y + h, x:x + w], self._last_mask[y:y + h, x:x + w],
+                                 cv2.NORM_INF) == 0:
+                return True
+        self._last_total = total
+        if not total:
+            self._last_rect = (0, 0, 0, 0)
+            return False
+        columns = np.flatnonzero(cv2.reduce(mask, 0, cv2.REDUCE_SUM, dtype=cv2.CV_32S))
+        rows = np.flatnonzero(rows)
+        self._last_rect = (int(columns[0]), int(rows[0]),
+                           int(columns[-1] - columns[0] + 1), int(rows[-1] - rows[0] + 1))
+        return False
+
+    def _paste(self, frame, mask, out):
+        """Write the background and the masked frame into out."""
+        if self.animated:
+            self.background.read(self._background_frame)
+        if self._whole_frames:
+            self._whole_frames -= 1
+        if not self.roi or self._whole_frames:
+            self._buffers.pop(id(out), None)
+            np.copyto(out, self._background_frame)
+            cv2.copyTo(frame, mask, out)
+            if self.feather:
+                self._feather(frame, mask, out, cv2.boundingRect(mask))
+            return out
+
+        if self._same_as_last(mask):
+            self._changed = 0
+            self._backoff = _CHANGED_STREAK
+        else:
+            self._generation += 1
+            x, y, w, h = self._last_rect
+            np.copyto(self._last_mask[y:y + h, x:x + w], mask[y:y + h, x:x + w])
+            if 4 * w * h > self.width * self.height:
+                self._changed += 1
+            else:
+                self._changed = 0
+                self._backoff = _CHANGED_STREAK
+            if self._changed >= _CHANGED_STREAK:
+                self._whole_frames = self._backoff
+                self._backoff = min(2 * self._backoff, _MAX_WHOLE_FRAMES)
+
+        state = self._buffers.pop(id(out), None)
+        if state is None or state[0] is not out:
+            state = (out, None, (0, 0, self.width, self.height))
+        _, generation, (x, y, w, h) = state
+        if generation != self._generation:
+            # Outside its last box the buffer already shows the background
+            np.copyto(out[y:y + h, x:x + w], self._background_frame[y:y + h, x:x + w])
+        x, y, w, h = self._last_rect
+        if w and h:
+            cv2.copyTo(frame[y:y + h, x:x + w], mask[y:y + h, x:x + w], out[y:y + h, x:x + w])
+        rect = self._last_rect
+        if self.feather:
+            rect = self._feather(frame, mask, out, rect)
+
+        self._buffers[id(out)] = (out, self._generation, rect)
+        if len(self._buffers) > _TRACKED_BUFFERS:
+            self._buffers.popitem(last=False)
+        return out
+
+    def _feather(self, frame, mask, out, rect):
+        """Blend frame and background across the outline of mask in out.
+
+        rect is the bounding box of mask. Returns the box that was written,
+        which is rect grown by the feather width.
+        """
+        x, y, w, h = rect
+        if not w or not h:
+            return rect
+        r = self.feather
+        x0, y0 = max(x - r, 0), max(y - r, 0)
+        x1, y1 = min(x + w + r, self.width), min(y + h + r, self.height)
+        # A box filter turns the hard outline into a linear ramp of alpha
+        size = 2 * r + 1
+        alpha = cv2.blur(mask[y0:y1, x0:x1], (size, size), borderType=cv2.BORDER_REPLICATE)
+        points = cv2.findNonZero(cv2.inRange(alpha, 1, 254))
+        if points is None:
+            return (x0, y0, x1 - x0, y1 - y0)
+        points = points.reshape(-1, 2)
+        edge = (points[:, 1], points[:, 0])
+        weight = alpha[edge].astype(np.float32)[:, None] * (1 / 255)
+        background = self._background_frame[y0:y1, x0:x1][edge]
+        foreground = frame[y0:y1, x0:x1][edge]
+        blended = background + (foreground.astype(np.float32) - background) * weight
+        out[y0:y1, x0:x1][edge] = blended + 0.5
+        return (x0, y0, x1 - x0, y1 - y0)
@@ -0,0 +1,266 @@
+import contextlib
+import os
+import tempfile
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+from file_cache import FileCache
+
+
+def configure():
+    """Read the download settings from the environment."""
+    global DOWNLOAD_CHUNK_SIZE, DOWNLOAD_TIMEOUT, DOWNLOAD_POOL_SIZE, DOWNLOAD_RETRIES, DOWNLOAD_BACKOFF
+    global RANGED_MIN_SIZE, RANGED_PART_SIZE, RANGED_CONNECTIONS, STREAM_INPUTS, VIDEO_CACHE_DIR
+    global VIDEO_CACHE_MAX_BYTES
+    # Bytes read from the network per write to disk. This bounds the memory a
+    # download holds regardless of the size of the video.
+    DOWNLOAD_CHUNK_SIZE = int(os.getenv("DOWNLOAD_CHUNK_SIZE", str(1024 * 1024)))
+    DOWNLOAD_TIMEOUT = float(os.getenv("DOWNLOAD_TIMEOUT", "60"))
+
+    # Connections kept open per host by the shared session
+    DOWNLOAD_POOL_SIZE = int(os.getenv("DOWNLOAD_POOL_SIZE", "16"))
+    # Attempts for a failed request, waiting DOWNLOAD_BACKOFF * 2^n seconds between them
+    DOWNLOAD_RETRIES = int(os.getenv("DOWNLOAD_RETRIES", "3"))
+    DOWNLOAD_BACKOFF = float(os.getenv("DOWNLOAD_BACKOFF", "0.5"))
+
+    # Objects at least this large are fetched as parallel byte ranges when the
+    # host advertises Accept-Ranges
+    RANGED_MIN_SIZE = int(os.getenv("RANGED_MIN_SIZE", str(16 * 1024 * 1024)))
+    RANGED_PART_SIZE = int(os.getenv("RANGED_PART_SIZE", str(8 * 1024 * 1024)))
+    RANGED_CONNECTIONS = int(os.getenv("RANGED_CONNECTIONS", "8"))
+
+    # Let the decoder read input videos straight from their URLs, so compositing
+    # starts while the rest of the file is still arriving. Only works for
+    # containers that can be played progressively (MP4 with the moov atom first).
+    STREAM_INPUTS = os.getenv("STREAM_INPUTS", "0") == "1"
+
+    # Downloaded videos are kept in a shared on-disk cache, keyed by URL and the
+    # ETag or Last-Modified header, so each video is fetched once per version;
+    # empty or unset keeps it in the temp directory
+    VIDEO_CACHE_DIR = os.getenv("VIDEO_CACHE_DIR") or os.path.join(tempfile.gettempdir(), "video_cache")
+    VIDEO_CACHE_MAX_BYTES = int(os.getenv("VIDEO_CACHE_MAX_BYTES", str(5 * 1024 ** 3)))
+
+
+configure()
+
+# Responses worth asking again for
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+RemoteInfo = namedtuple('RemoteInfo', ['size', 'accepts_ranges', 'validator'])
+
+_session = None
+_session_lock = threading.Lock()
+_video_cache = None
+
+
+def get_session():
+    """Return the process-wide HTTP session, which reuses pooled connections."""
+    global _session
+    with _session_lock:
+        if _session is None:
+            # No retries here: _with_retries is the only retry layer
+            adapter = HTTPAdapter(pool_connections=DOWNLOAD_POOL_SIZE,
+                                  pool_maxsize=DOWNLOAD_POOL_SIZE, max_retries=0)
+            session = requests.Session()
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _session = session
+        return _session
+
+
+def _retryable(error):
+    if isinstance(error, requests.HTTPError):
+        return error.response is not None and error.response.status_code in RETRY_STATUSES
+    return isinstance(error, (requests.ConnectionError, requests.Timeout,
+                              requests.exceptions.ChunkedEncodingError))
+
+
+def _with_retries(fn, *args):
+    """Call fn, retrying with backoff on connection errors, transfers that
+    break mid-stream and RETRY_STATUSES responses.
+
+    This is the only retry layer: the session's adapter does not retry, so a
+    request is attempted at most DOWNLOAD_RETRIES + 1 times.
+    """
+    for attempt in range(DOWNLOAD_RETRIES + 1):
+        try:
+            return fn(*args)
+        except requests.RequestException as e:
+            if attempt == DOWNLOAD_RETRIES or not _retryable(e):
+                raise
+            delay = DOWNLOAD_BACKOFF * 2 ** attempt
+            print(f"Download failed ({e}), retrying in {delay:.1f}s")
+            time.sleep(delay)
+
+
+def probe(url):
+    """Return the size, range support and version validator of url.
+
+    Fields are None/False when the host does not answer HEAD requests.
+    """
+    try:
+        response = _with_retries(_head, url)
+    except requests.RequestException:
+        return RemoteInfo(None, False, None)
+    headers = response.headers
+    size = headers.get('Content-Length')
+    return RemoteInfo(
+        size=int(size) if size else None,
+        accepts_ranges=headers.get('Accept-Ranges', '').lower() == 'bytes',
+        validator=headers.get('ETag') or headers.get('Last-Modified'),
+    )
+
+
+def _head(url):
+    response = get_session().head(url, allow_redirects=True, timeout=DOWNLOAD_TIMEOUT)
+    response.raise_for_status()
+    return response
+
+
+def _download_stream(url, path, chunk_size):
+    with get_session().get(url, stream=True, timeout=DOWNLOAD_TIMEOUT) as response:
+        response.raise_for_status()
+        with open(path, 'wb') as f:
+            for chunk in response.iter_content(chunk_size):
+                f.write(chunk)
+
+
+def _download_range(url, path, start, end, chunk_size):
+    headers = {'Range': f'bytes={start}-{end}'}
+    with get_session().get(url, headers=headers, stream=True, timeout=DOWNLOAD_TIMEOUT) as response:
+        response.raise_for_status()
+        if response.status_code != 206:
+            raise requests.HTTPError(f"Server ignored range request for {url}")
+        with open(path, 'r+b') as f:
+            f.seek(start)
+            for chunk in response.iter_content(chunk_size):
+                f.write(chunk)
+
+
+def _download_ranged(url, path, size, chunk_size):
+    # Size the file up front so every part can write at its own offset
+    with open(path, 'wb') as f:
+        f.truncate(size)
+    parts = [(start, min(start + RANGED_PART_SIZE, size) - 1) for start in range(0, size, RANGED_PART_SIZE)]
+    with ThreadPoolExecutor(max_workers=min(RANGED_CONNECTIONS, len(parts))) as executor:
+        futures = [executor.submit(_with_retries, _download_range, url, path, start, end, chunk_size)
+                   for start, end in parts]
+        for future in futures:
+            future.result()
+
+
+def download_to_file(url, path, chunk_size=None, info=None):
+    """Download url to path.
+
+    Large objects on hosts that accept byte ranges are fetched over several
+    connections at once; everything else is streamed in fixed-size chunks.
+    """
+    chunk_size = chunk_size or DOWNLOAD_CHUNK_SIZE
+    with metrics.stage('download'):
+        info = info or probe(url)
+        if info.accepts_ranges and info.size and info.size >= RANGED_MIN_SIZE and RANGED_CONNECTIONS > 1:
+            try:
+                _download_ranged(url, path, info.size, chunk_size)
+                metrics.STAGE_BYTES.observe(os.path.getsize(path), stage='download')
+                return path
+            except requests.HTTPError as e:
+                print(f"Ranged download failed ({e}), falling back to a single stream")
+        _with_retries(_download_stream, url, path, chunk_size)
+    metrics.STAGE_BYTES.observe(os.path.getsize(path), stage='download')
+    return path
+
+
+def get_video_cache():
+    """Return the process-wide cache of downloaded videos."""
+    global _video_cache
+    with _session_lock:
+        if _video_cache is None:
+            _video_cache = FileCache(VIDEO_CACHE_DIR, VIDEO_CACHE_MAX_BYTES, suffix='.mp4')
+        return _video_cache
+
+
+metrics.register_cache('video', lambda: get_video_cache().stats())
+
+
+def video_cache_key(url, info):
+    return f"{url}\n{info.validator or ''}"
+
+
+def acquire_video(url, info=None):
+    """Return a local path for url, downloading it only if it is not cached.
+
+    The path stays valid until it is passed to release_video().
+    """
+    info = info or probe(url)
+    return get_video_cache().acquire(video_cache_key(url, info),
+                                     lambda path: download_to_file(url, path, info=info))
+
+
+def release_video(path):
+    get_video_cache().release(path)
+
+
+@contextlib.contextmanager
+def cached_video(url):
+    """Context manager form of acquire_video() and release_video()."""
+    path = acquire_video(url)
+    try:
+        yield path
+    finally:
+        release_video(path)
+
+
+def acquire_all(urls):
+    """Acquire urls concurrently and return their local paths."""
+    with ThreadPoolExecutor(max_workers=max(len(urls), 1)) as executor:
+        futures = [executor.submit(acquire_video, url) for url in urls]
+        paths, error = [], None
+        for future in futures:
+            try:
+                paths.append(future.result())
+            except Exception as e:
+                error = error or e
+    if error is not None:
+        # Do not leave the downloads that did succeed pinned
+        for path in paths:
+            release_video(path)
+        raise error
+    return paths
+
+
+def can_stream(url):
+    """Check whether the decoder can open url without downloading it first."""
+    cap = cv2.VideoCapture(url)
+    try:
+        return cap.isOpened() and cap.grab()
+    finally:
+        cap.release()
+
+
+@contextlib.contextmanager
+def video_inputs(*urls, stream=None):
+    """Make videos available to the decoder for the duration of the block.
+
+    Yields one source per URL: the URL itself when it can be streamed,
+    otherwise the path of a local copy from the video cache. Missing copies
+    are downloaded concurrently, and all copies are released to the cache
+    when the block exits, however it exits.
+    """
+    stream = STREAM_INPUTS if stream is None else stream
+    sources = list(urls)
+    pending = [index for index, url in enumerate(urls) if not (stream and can_stream(url))]
+    paths = acquire_all([urls[index] for index in pending]) if pending else []
+    try:
+        for index, path in zip(pending, paths):
+            sources[index] = path
+        yield sources
+    finally:
+        for path in paths:
+            release_video(path)
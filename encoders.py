@@ -0,0 +1,116 @@
+import os
+import subprocess
+from fractions import Fraction
+
+import cv2
+
+from media import find_ffmpeg
+
+
+def configure():
+    """Read the encoder settings from the environment."""
+    global ENCODER, ENCODER_CODEC, ENCODER_PRESET, ENCODER_CRF, ENCODER_THREADS, ENCODER_AUDIO_CODEC
+    # Encoder for composited videos: 'ffmpeg', 'opencv' (mp4v through
+    # cv2.VideoWriter) or 'auto' to use ffmpeg when it is installed
+    ENCODER = os.getenv("ENCODER", "auto")
+
+    # Settings of the ffmpeg encoder
+    ENCODER_CODEC = os.getenv("ENCODER_CODEC", "libx264")
+    ENCODER_PRESET = os.getenv("ENCODER_PRESET", "veryfast")
+    ENCODER_CRF = int(os.getenv("ENCODER_CRF", "23"))
+    # 0 lets the codec pick the number of threads
+    ENCODER_THREADS = int(os.getenv("ENCODER_THREADS", "0"))
+    # How the source audio is carried over: 'copy' or an audio codec such as 'aac'
+    ENCODER_AUDIO_CODEC = os.getenv("ENCODER_AUDIO_CODEC", "copy")
+
+
+configure()
+
+# Largest difference in frames per second between a reported rate and the
+# NTSC rate it is taken for
+NTSC_TOLERANCE = 0.005
+
+
+def frame_rate(fps):
+    """Exact frame rate for ffmpeg, e.g. 29.97 becomes '30000/1001' and 25.0 '25/1'.
+
+    Rates within NTSC_TOLERANCE of N * 1000/1001 are NTSC rates (23.976,
+    29.97, 59.94, ...), which containers only report rounded.
+    """
+    if not fps > 0:
+        raise ValueError(f"Invalid frame rate: {fps}")
+    base = round(fps * 1001 / 1000)
+    if base != fps and abs(fps - base * 1000 / 1001) < NTSC_TOLERANCE:
+        return f"{base * 1000}/1001"
+    rate = Fraction(fps).limit_denominator(1001)
+    return f"{rate.numerator}/{rate.denominator}"
+
+
+class OpenCVEncoder:
+    """mp4v through cv2.VideoWriter. Large files, no audio."""
+
+    def __init__(self, path, fps, width, height, audio_source=None):
+        fourcc = cv2.VideoWriter_fourcc(*'mp4v')
+        self._writer = cv2.VideoWriter(path, fourcc, fps, (width, height))
+
+    def write(self, frame):
+        self._writer.write(frame)
+
+    def release(self):
+        self._writer.release()
+
+
+class FFmpegEncoder:
+    """Encodes raw BGR frames piped to an ffmpeg subprocess.
+
+    The audio of audio_source, if it has any, is muxed into the output.
+    output_args replace the default MP4 muxer options, e.g. to write HLS.
+    """
+
+    def __init__(self, path, fps, width, height, audio_source=None, codec=None, preset=None,
+                 crf=None, threads=None, output_args=None, extra_video_args=()):
+        ffmpeg = find_ffmpeg()
+        if not ffmpeg:
+            raise RuntimeError("The ffmpeg encoder requires ffmpeg")
+        command = [
+            ffmpeg, '-y', '-loglevel', 'error',
+            '-f', 'rawvideo', '-pix_fmt', 'bgr24', '-s', f'{width}x{height}',
+            '-r', frame_rate(fps), '-i', '-',
+        ]
+        if audio_source:
+            command += ['-i', audio_source, '-map', '0:v:0', '-map', '1:a:0?',
+                        '-c:a', ENCODER_AUDIO_CODEC, '-shortest']
+        command += [
+            '-c:v', codec or ENCODER_CODEC,
+            '-preset', preset or ENCODER_PRESET,
+            '-crf', str(ENCODER_CRF if crf is None else crf),
+            '-threads', str(ENCODER_THREADS if threads is None else threads),
+            '-pix_fmt', 'yuv420p',
+            *extra_video_args,
+        ]
+        # Put the index first so players can start before the whole file arrives
+        command += ['-movflags', '+faststart'] if output_args is None else list(output_args)
+        command.append(path)
+        self._process = subprocess.Popen(command, stdin=subprocess.PIPE)
+
+    def write(self, frame):
+        # Hand the buffer to the pipe without copying it when possible
+        self._process.stdin.write(frame.data if frame.flags.c_contiguous else frame.tobytes())
+
+    def release(self):
+        self._process.stdin.close()
+        returncode = self._process.wait()
+        if returncode != 0:
+            raise RuntimeError(f"ffmpeg exited with status {returncode}")
+
+
+def make_encoder(path, fps, width, height, audio_source=None, backend=None):
+    """Open the encoder selected by ENCODER for a video of the given size and rate."""
+    backend = backend or ENCODER
+    if backend == 'auto':
+        backend = 'ffmpeg' if find_ffmpeg() else 'opencv'
+    if backend == 'ffmpeg':
+        return FFmpegEncoder(path, fps, width, height, audio_source=audio_source)
+    if backend == 'opencv':
+        return OpenCVEncoder(path, fps, width, height)
+    raise ValueError(f"Unknown encoder: {backend}")
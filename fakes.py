@@ -0,0 +1,150 @@
+"""Local stand-ins for the network services the pipeline talks to.
+
+These let the benchmarks exercise downloads and the full pipeline without
+network access or billing.
+"""
+import email.utils
+import hashlib
+import os
+import threading
+import time
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+
+class RangeRequestHandler(SimpleHTTPRequestHandler):
+    """Serves files with Range, ETag and Last-Modified support, like GCS does.
+
+    bytes_per_second limits the rate of each connection, to mimic hosts
+    that cap per-connection throughput.
+    """
+
+    bytes_per_second = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _file_headers(self, path, size):
+        stat = os.stat(path)
+        etag = hashlib.md5(f"{path}:{stat.st_mtime_ns}:{size}".encode()).hexdigest()
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Type', self.guess_type(path))
+        self.send_header('ETag', f'"{etag}"')
+        self.send_header('Last-Modified', email.utils.formatdate(stat.st_mtime, usegmt=True))
+
+    def _parse_range(self, size):
+        header = self.headers.get('Range')
+        if not header or not header.startswith('bytes='):
+            return None
+        start, _, end = header[len('bytes='):].partition('-')
+        if not start:
+            # Suffix range: the last N bytes
+            return max(size - int(end), 0), size - 1
+        return int(start), min(int(end), size - 1) if end else size - 1
+
+    def _send(self, include_body):
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return
+        size = os.path.getsize(path)
+        byte_range = self._parse_range(size)
+        if byte_range and byte_range[0] >= size:
+            self.send_response(416)
+            self.send_header('Content-Range', f'bytes */{size}')
+            self.end_headers()
+            return
+        start, end = byte_range or (0, size - 1)
+        self.send_response(206 if byte_range else 200)
+        self._file_headers(path, size)
+        if byte_range:
+            self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+        if not include_body:
+            return
+
+        with open(path, 'rb') as f:
+            f.seek(start)
+            remaining = end - start + 1
+            chunk_size = 64 * 1024
+            started = time.perf_counter()
+            sent = 0
+            while remaining > 0:
+                chunk = f.read(min(chunk_size, remaining))
+                if not chunk:
+                    break
+                try:
+                    self.wfile.write(chunk)
+                except (BrokenPipeError, ConnectionResetError):
+                    return
+                remaining -= len(chunk)
+                sent += len(chunk)
+                if self.bytes_per_second:
+                    ahead = sent / self.bytes_per_second - (time.perf_counter() - started)
+                    if ahead > 0:
+                        time.sleep(ahead)
+
+    def do_GET(self):
+        self._send(include_body=True)
+
+    def do_HEAD(self):
+        self._send(include_body=False)
+
+
+class LocalHTTPServer:
+    """Serve a directory over HTTP on a background thread.
+
+    Use as a context manager; url(name) returns the URL of a file.
+    """
+
+    def __init__(self, directory, bytes_per_second=None, port=0):
+        handler = type('Handler', (RangeRequestHandler,), {'bytes_per_second': bytes_per_second})
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), partial(handler, directory=directory))
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def base_url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def url(self, name):
+        return f"{self.base_url}/{name}"
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+class FakePredictor:
+    """Stand-in for replicate.run that answers every SAM2 prediction with a fixed mask video.
+
+    mask_url is either a URL or a function of the model input returning one;
+    a list of URLs stands for one mask video per object. delay simulates the
+    time a prediction takes, and can also be a function of the model input.
+    """
+
+    def __init__(self, mask_url, delay=0.0):
+        self.mask_url = mask_url
+        self.delay = delay
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def __call__(self, model, input):
+        with self._lock:
+            self.calls.append((model, input))
+        delay = self.delay(input) if callable(self.delay) else self.delay
+        if delay:
+            time.sleep(delay)
+        mask_url = self.mask_url(input) if callable(self.mask_url) else self.mask_url
+        return list(mask_url) if isinstance(mask_url, (list, tuple)) else [mask_url]
@@ -0,0 +1,252 @@
+import contextlib
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+try:
+    import fcntl
+except ImportError:
+    # Windows: processes may fill the same key twice, which only costs time
+    fcntl = None
+
+INDEX_NAME = '.index.sqlite3'
+
+
+def _process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        # Exists, but belongs to someone else
+        return True
+    return True
+
+
+class FileCache:
+    """Files on disk keyed by string, evicted least recently used beyond a byte budget.
+
+    Files handed out by acquire() are pinned and never evicted until they are
+    released. Concurrent requests for the same missing key wait for a single
+    fill instead of each producing the file. Files are written under a
+    temporary name and renamed into place.
+
+    Sizes, last use and pins are kept in a SQLite index in the directory, so
+    every process sharing it (server workers, batch runs) evicts against the
+    same budget and never removes a file another process has pinned. Pins
+    of processes that died are dropped. Fills of the same key by several
+    processes are serialized with a lock file per key where flock exists.
+    Hit, miss and eviction counts are per process.
+    """
+
+    def __init__(self, directory, max_bytes, suffix=''):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.suffix = suffix
+        os.makedirs(directory, exist_ok=True)
+        self._index_path = os.path.join(directory, INDEX_NAME)
+
+        self._lock = threading.Lock()
+        self._filling = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        with self._transaction() as db:
+            db.execute('CREATE TABLE IF NOT EXISTS entries ('
+                       'name TEXT PRIMARY KEY, size INTEGER NOT NULL, used REAL NOT NULL)')
+            db.execute('CREATE TABLE IF NOT EXISTS pins ('
+                       'name TEXT NOT NULL, pid INTEGER NOT NULL, count INTEGER NOT NULL, '
+                       'PRIMARY KEY (name, pid))')
+            self._load_existing(db)
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        """A connection holding the index's write lock until the block ends."""
+        db = sqlite3.connect(self._index_path, timeout=60, isolation_level=None)
+        try:
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                yield db
+            except BaseException:
+                db.execute('ROLLBACK')
+                raise
+            db.execute('COMMIT')
+        finally:
+            db.close()
+
+    def _load_existing(self, db):
+        # Files added or removed without the index, e.g. by an older version;
+        # new files take their modification time as last use
+        on_disk = {}
+        for entry in os.scandir(self.directory):
+            if (entry.is_file() and entry.name.endswith(self.suffix) and not entry.name.startswith('.')
+                    and not entry.name.endswith('.part')):
+                stat = entry.stat()
+                on_disk[entry.name] = (stat.st_size, stat.st_mtime)
+        indexed = {name for name, in db.execute('SELECT name FROM entries')}
+        for name in indexed - set(on_disk):
+            db.execute('DELETE FROM entries WHERE name = ?', (name,))
+        for name in set(on_disk) - indexed:
+            db.execute('INSERT INTO entries (name, size, used) VALUES (?, ?, ?)', (name, *on_disk[name]))
+        self._evict(db)
+
+    def _name(self, key):
+        return hashlib.sha256(key.encode('utf-8')).hexdigest() + self.suffix
+
+    def path(self, key):
+        return os.path.join(self.directory, self._name(key))
+
+    def _pin(self, db, name):
+        db.execute('INSERT INTO pins (name, pid, count) VALUES (?, ?, 1) '
+                   'ON CONFLICT (name, pid) DO UPDATE SET count = count + 1', (name, os.getpid()))
+        db.execute('UPDATE entries SET used = ? WHERE name = ?', (time.time(), name))
+
+    def _add(self, db, name, path):
+        db.execute('INSERT OR REPLACE INTO entries (name, size, used) VALUES (?, ?, ?)',
+                   (name, os.path.getsize(path), time.time()))
+
+    def _evict(self, db):
+        total, = db.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()
+        if total <= self.max_bytes:
+            return
+        for pid, in db.execute('SELECT DISTINCT pid FROM pins').fetchall():
+            if not _process_alive(pid):
+                db.execute('DELETE FROM pins WHERE pid = ?', (pid,))
+        candidates = db.execute('SELECT name, size FROM entries WHERE name NOT IN '
+                                '(SELECT name FROM pins) ORDER BY used').fetchall()
+        for name, size in candidates:
+            if total <= self.max_bytes:
+                break
+            db.execute('DELETE FROM entries WHERE name = ?', (name,))
+            total -= size
+            self.evictions += 1
+            for path in (os.path.join(self.directory, name), self._lock_path(name)):
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+
+    def _lock_path(self, name):
+        return os.path.join(self.directory, f'.{name}.lock')
+
+    @contextlib.contextmanager
+    def _fill_lock(self, name):
+        """Hold the key's lock file, so one process at a time fills it."""
+        if fcntl is None:
+            yield
+            return
+        with open(self._lock_path(name), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _try_pin(self, name, path):
+        """Pin name if its file is cached, in the index or filled by another process."""
+        with self._transaction() as db:
+            indexed = db.execute('SELECT 1 FROM entries WHERE name = ?', (name,)).fetchone()
+            exists = os.path.exists(path)
+            if indexed and not exists:
+                # Removed behind our back
+                db.execute('DELETE FROM entries WHERE name = ?', (name,))
+                return False
+            if not exists:
+                return False
+            if not indexed:
+                # Renamed into place by a process that has not indexed it yet
+                self._add(db, name, path)
+            self._pin(db, name)
+            return True
+
+    def lookup(self, key):
+        """Return the pinned path for key if it is cached, else None."""
+        name = self._name(key)
+        path = os.path.join(self.directory, name)
+        if self._try_pin(name, path):
+            with self._lock:
+                self.hits += 1
+            return path
+        return None
+
+    def acquire(self, key, fill):
+        """Return the path of the file for key, calling fill(path) to create it if missing.
+
+        The returned path stays pinned until release() is called.
+        """
+        name = self._name(key)
+        path = os.path.join(self.directory, name)
+        while True:
+            if self._try_pin(name, path):
+                with self._lock:
+                    self.hits += 1
+                return path
+            with self._lock:
+                filling = self._filling.get(name)
+                if filling is None:
+                    self._filling[name] = threading.Event()
+                    break
+            # Another thread is filling this key, use its result
+            filling.wait()
+
+        try:
+            with self._fill_lock(name):
+                # Another process may have filled it while we waited for the lock
+                if self._try_pin(name, path):
+                    with self._lock:
+                        self.hits += 1
+                    return path
+                with self._lock:
+                    self.misses += 1
+                temp_path = f"{path}.{uuid.uuid4().hex}.part"
+                try:
+                    fill(temp_path)
+                    os.replace(temp_path, path)
+                except BaseException:
+                    if os.path.exists(temp_path):
+                        os.unlink(temp_path)
+                    raise
+                with self._transaction() as db:
+                    self._add(db, name, path)
+                    self._pin(db, name)
+                    self._evict(db)
+                return path
+        finally:
+            with self._lock:
+                self._filling.pop(name).set()
+
+    def release(self, path):
+        """Unpin a path returned by acquire() or lookup()."""
+        name = os.path.basename(path)
+        with self._transaction() as db:
+            db.execute('UPDATE pins SET count = count - 1 WHERE name = ? AND pid = ?', (name, os.getpid()))
+            db.execute('DELETE FROM pins WHERE count <= 0')
+            self._evict(db)
+
+    @contextlib.contextmanager
+    def get(self, key, fill):
+        """Context manager form of acquire() and release()."""
+        path = self.acquire(key, fill)
+        try:
+            yield path
+        finally:
+            self.release(path)
+
+    def stats(self):
+        db = sqlite3.connect(self._index_path, timeout=60)
+        try:
+            entries, total = db.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries').fetchone()
+        finally:
+            db.close()
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': entries,
+                'bytes': total,
+                'max_bytes': self.max_bytes,
+            }
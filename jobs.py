@@ -0,0 +1,249 @@
+import contextlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import traceback
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+
+
+def configure():
+    """Read the job settings from the environment."""
+    global JOB_WORKERS, STAGE_CONCURRENCY, JOB_HISTORY, JOB_PROFILE_DIR, JOB_BACKEND, JOB_STORE_PATH
+    # Jobs running at once, and how many of them may be in each stage at once
+    JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))
+    STAGE_CONCURRENCY = {
+        'inference': int(os.getenv("INFERENCE_CONCURRENCY", "4")),
+        'compositing': int(os.getenv("COMPOSITE_CONCURRENCY", "1")),
+        'uploading': int(os.getenv("UPLOAD_CONCURRENCY", "2")),
+    }
+    # Finished jobs kept for status queries before the oldest are forgotten
+    JOB_HISTORY = int(os.getenv("JOB_HISTORY", "1000"))
+    # Directory for a cProfile dump of every job, job_<id>.prof (empty disables)
+    JOB_PROFILE_DIR = os.getenv("JOB_PROFILE_DIR", "")
+    # Where job status is kept: memory (per process) or sqlite (shared by every
+    # server process using the file, so any of them can answer status queries)
+    JOB_BACKEND = os.getenv("JOB_BACKEND", "memory")
+    # Relative to the app's directory, so processes started from anywhere share it
+    JOB_STORE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                  os.getenv("JOB_STORE_PATH", os.path.join("cache", "jobs.sqlite3")))
+
+
+configure()
+
+QUEUED = 'queued'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class Job:
+    """One annotation going through the pipeline stages.
+
+    Stage functions read job.input and store what they produce in
+    job.result, which later stages can use.
+    """
+
+    def __init__(self, job_input):
+        self.id = uuid.uuid4().hex
+        self.input = job_input
+        self.status = QUEUED
+        self.result = {}
+        self.error = None
+        self.created = time.time()
+        self.updated = self.created
+        self.timings = {}
+
+    @property
+    def finished(self):
+        return self.status in (DONE, FAILED)
+
+    def to_dict(self):
+        return {
+            'job_id': self.id,
+            'status': self.status,
+            'result': self.result,
+            'error': self.error,
+            'created': self.created,
+            'updated': self.updated,
+            'timings': self.timings,
+        }
+
+    def to_record(self):
+        """Everything about the job, for a job store."""
+        return dict(self.to_dict(), input=self.input)
+
+    @classmethod
+    def from_record(cls, record):
+        job = cls(record['input'])
+        job.id = record['job_id']
+        job.status = record['status']
+        job.result = record['result']
+        job.error = record['error']
+        job.created = record['created']
+        job.updated = record['updated']
+        job.timings = record['timings']
+        return job
+
+
+class SqliteJobStore:
+    """Job records in SQLite, shared by every process using the file.
+
+    Processes save the jobs they run; the others read them back as
+    snapshots, which is enough to answer status queries and render
+    finished jobs.
+    """
+
+    def __init__(self, path=None, history=None):
+        self.path = path or JOB_STORE_PATH
+        self.history = history or JOB_HISTORY
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connect() as db:
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('CREATE TABLE IF NOT EXISTS jobs ('
+                       'id TEXT PRIMARY KEY, record TEXT NOT NULL, created REAL NOT NULL, '
+                       'finished INTEGER NOT NULL)')
+            db.execute('CREATE INDEX IF NOT EXISTS jobs_created ON jobs (created)')
+
+    @contextlib.contextmanager
+    def _connect(self):
+        db = sqlite3.connect(self.path, timeout=30)
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    def save(self, job):
+        with self._connect() as db:
+            db.execute('INSERT OR REPLACE INTO jobs (id, record, created, finished) VALUES (?, ?, ?, ?)',
+                       (job.id, json.dumps(job.to_record()), job.created, int(job.finished)))
+            if job.finished:
+                # Forget the oldest finished jobs beyond the history
+                db.execute('DELETE FROM jobs WHERE id IN (SELECT id FROM jobs WHERE finished = 1 '
+                           'ORDER BY created DESC LIMIT -1 OFFSET ?)', (self.history,))
+
+    def load(self, job_id):
+        with self._connect() as db:
+            row = db.execute('SELECT record FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        return None if row is None else Job.from_record(json.loads(row[0]))
+
+    def list(self):
+        with self._connect() as db:
+            rows = db.execute('SELECT record FROM jobs ORDER BY created').fetchall()
+        return [Job.from_record(json.loads(row[0])) for row in rows]
+
+
+def make_job_store(backend=None):
+    """Create the job store selected by JOB_BACKEND; None keeps jobs in memory only."""
+    backend = backend or JOB_BACKEND
+    if backend == 'memory':
+        return None
+    if backend == 'sqlite':
+        return SqliteJobStore()
+    raise ValueError(f"Unknown job backend: {backend}")
+
+
+class JobManager:
+    """Runs jobs through a list of (name, function) stages on a bounded worker pool.
+
+    submit() returns immediately. Each stage has its own concurrency limit,
+    so for example many inferences can wait on Replicate while only one job
+    at a time uses the CPU for compositing.
+    """
+
+    def __init__(self, stages, workers=None, stage_concurrency=None, history=None, store=None):
+        self.stages = list(stages)
+        self.store = store
+        self.workers = workers or JOB_WORKERS
+        limits = dict(STAGE_CONCURRENCY)
+        limits.update(stage_concurrency or {})
+        # Jobs allowed in each stage at once
+        self.limits = {name: limits.get(name, self.workers) for name, _ in self.stages}
+        self._limits = {name: threading.BoundedSemaphore(limit) for name, limit in self.limits.items()}
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='job')
+        self._history = history or JOB_HISTORY
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def submit(self, job_input):
+        job = Job(job_input)
+        with self._lock:
+            self._jobs[job.id] = job
+            self._forget_finished()
+        self.save(job)
+        self._executor.submit(self._run, job)
+        return job
+
+    def get(self, job_id):
+        """Return a job of this process, or a snapshot of another's from the store."""
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is None and self.store is not None:
+            job = self.store.load(job_id)
+        return job
+
+    def list(self):
+        with self._lock:
+            jobs = list(self._jobs.values())
+        if self.store is None:
+            return jobs
+        local = {job.id: job for job in jobs}
+        return [local.get(job.id, job) for job in self.store.list()]
+
+    def save(self, job):
+        """Publish the job's current state to the store, if there is one."""
+        if self.store is not None:
+            self.store.save(job)
+
+    def _forget_finished(self):
+        finished = [job_id for job_id, job in self._jobs.items() if job.finished]
+        for job_id in finished[:max(len(finished) - self._history, 0)]:
+            del self._jobs[job_id]
+
+    def _set_status(self, job, status):
+        job.status = status
+        job.updated = time.time()
+        self.save(job)
+
+    def _run(self, job):
+        if not JOB_PROFILE_DIR:
+            self._run_stages(job)
+            return
+        os.makedirs(JOB_PROFILE_DIR, exist_ok=True)
+        path = os.path.join(JOB_PROFILE_DIR, f'job_{job.id}.prof')
+        with metrics.profiling(path):
+            self._run_stages(job)
+        print(f"Profile of job {job.id} written to {path}")
+
+    def _run_stages(self, job):
+        try:
+            for name, stage in self.stages:
+                with self._limits[name]:
+                    self._set_status(job, name)
+                    start = time.perf_counter()
+                    with metrics.timed(metrics.JOB_STAGE_SECONDS, metrics.JOB_STAGE_ERRORS, stage=name):
+                        stage(job)
+                    job.timings[name] = time.perf_counter() - start
+            self._set_status(job, DONE)
+        except Exception as e:
+            traceback.print_exc()
+            job.error = str(e)
+            self._set_status(job, FAILED)
+        metrics.JOBS.inc(status=job.status)
+
+    def wait(self, job, timeout=None, interval=0.1):
+        """Block until job finishes or timeout seconds pass, and return it."""
+        deadline = None if timeout is None else time.time() + timeout
+        while not job.finished and (deadline is None or time.time() < deadline):
+            time.sleep(interval)
+        return job
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
@@ -0,0 +1,257 @@
+"""Compact local archives of SAM2 mask videos.
+
+SAM2 delivers masks as lossy MP4 that has to be downloaded, decoded and
+thresholded on every composite. A mask archive stores each frame already
+thresholded, as one bit per pixel (np.packbits), optionally zlib
+compressed, with an index of frame offsets. Archives are memory-mapped, so
+any frame can be read directly without decoding the frames before it.
+
+Layout, little-endian:
+    header   magic, version, compressed flag, width, height, frame count,
+             fps and the offset of the index (see _HEADER)
+    frames   the packed bits of each frame, row by row
+    index    frame count + 1 uint64 offsets; frame i spans index[i]:index[i + 1]
+"""
+import os
+import struct
+import tempfile
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+from compositing import MASK_THRESHOLD
+from downloads import acquire_all, release_video
+import metrics
+from file_cache import FileCache
+
+
+def configure():
+    """Read the mask archive settings from the environment."""
+    global MASK_ARCHIVE_COMPRESSION, MASK_ARCHIVE_DIR, MASK_ARCHIVE_MAX_BYTES
+    # zlib level used for each frame's packed bits, 0 stores them uncompressed
+    MASK_ARCHIVE_COMPRESSION = int(os.getenv("MASK_ARCHIVE_COMPRESSION", "6"))
+    # On-disk cache of archives, keyed by mask video URLs and evicted least
+    # recently used beyond the budget; empty or unset keeps it in the temp directory
+    MASK_ARCHIVE_DIR = os.getenv("MASK_ARCHIVE_DIR") or os.path.join(tempfile.gettempdir(), "mask_archives")
+    MASK_ARCHIVE_MAX_BYTES = int(os.getenv("MASK_ARCHIVE_MAX_BYTES", str(1024 ** 3)))
+
+
+configure()
+
+_MAGIC = b'SAM2MASK'
+_VERSION = 1
+_HEADER = struct.Struct('<8sHHIIIdQ')
+
+_archive_cache = None
+_archive_cache_lock = threading.Lock()
+
+
+class MaskArchiveWriter:
+    """Writes binary masks of one size to an archive, one frame at a time."""
+
+    def __init__(self, path, width, height, fps, compression=None):
+        self.width = width
+        self.height = height
+        self.fps = fps
+        self.compression = MASK_ARCHIVE_COMPRESSION if compression is None else compression
+        self._file = open(path, 'wb')
+        self._file.write(b'\0' * _HEADER.size)
+        self._offsets = [_HEADER.size]
+        self.frames = 0
+
+    def write(self, mask):
+        """Append a (height, width) mask, nonzero where the subject is."""
+        if mask.shape != (self.height, self.width):
+            raise ValueError(f"Mask of shape {mask.shape} in an archive of {self.width}x{self.height}")
+        data = np.packbits(mask, axis=None)
+        if self.compression:
+            data = zlib.compress(data, self.compression)
+        self._file.write(data)
+        self._offsets.append(self._offsets[-1] + len(data))
+        self.frames += 1
+
+    def release(self):
+        try:
+            self._file.write(np.array(self._offsets, dtype='<u8').tobytes())
+            self._file.seek(0)
+            self._file.write(_HEADER.pack(_MAGIC, _VERSION, int(bool(self.compression)), self.width,
+                                          self.height, self.frames, self.fps, self._offsets[-1]))
+        finally:
+            self._file.close()
+
+
+class MaskArchive:
+    """Memory-mapped reader of a mask archive.
+
+    Frames are returned as (height, width) uint8 masks, 255 where the
+    subject is. Besides random access with frame(), it has the parts of the
+    cv2.VideoCapture interface the pipeline uses, so it can take the place
+    of a mask video.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._data = np.memmap(path, dtype=np.uint8, mode='r')
+        magic, version, compressed, self.width, self.height, self.frames, self.fps, index_offset = \
+            _HEADER.unpack_from(self._data)
+        if magic != _MAGIC or version != _VERSION:
+            raise ValueError(f"Not a version {_VERSION} mask archive: {path}")
+        self.compressed = bool(compressed)
+        self._index = np.frombuffer(self._data, dtype='<u8', count=self.frames + 1, offset=index_offset)
+        self.position = 0
+
+    def __len__(self):
+        return self.frames
+
+    def frame(self, index, out=None):
+        """Return mask frame index, written into out if given."""
+        if not 0 <= index < self.frames:
+            raise IndexError(f"Frame {index} out of range for {self.frames} frames")
+        data = self._data[int(self._index[index]):int(self._index[index + 1])]
+        if self.compressed:
+            data = np.frombuffer(zlib.decompress(data), dtype=np.uint8)
+        bits = np.unpackbits(data, count=self.width * self.height).reshape(self.height, self.width)
+        if out is None:
+            out = np.empty((self.height, self.width), dtype=np.uint8)
+        # 0 and 1 to 0 and 255, by uint8 wraparound
+        return np.negative(bits, out=out)
+
+    def isOpened(self):
+        return self._data is not None
+
+    def get(self, prop):
+        values = {
+            cv2.CAP_PROP_FRAME_WIDTH: self.width,
+            cv2.CAP_PROP_FRAME_HEIGHT: self.height,
+            cv2.CAP_PROP_FPS: self.fps,
+            cv2.CAP_PROP_FRAME_COUNT: self.frames,
+            cv2.CAP_PROP_POS_FRAMES: self.position,
+        }
+        return float(values.get(prop, 0))
+
+    def set(self, prop, value):
+        if prop != cv2.CAP_PROP_POS_FRAMES:
+            return False
+        self.position = min(max(int(value), 0), self.frames)
+        return True
+
+    def grab(self):
+        if self.position >= self.frames:
+            return False
+        self.position += 1
+        return True
+
+    def read(self, image=None):
+        if self.position >= self.frames:
+            return False, None
+        frame = self.frame(self.position, image)
+        self.position += 1
+        return True, frame
+
+    def release(self):
+        self._data = None
+        self._index = None
+
+
+def is_mask_archive(path):
+    """Check whether path is a local file starting with the archive magic."""
+    if not isinstance(path, str) or not os.path.isfile(path):
+        return False
+    with open(path, 'rb') as f:
+        return f.read(len(_MAGIC)) == _MAGIC
+
+
+def open_mask_video(path):
+    """Open a mask archive or a mask video for reading frame by frame."""
+    return MaskArchive(path) if is_mask_archive(path) else cv2.VideoCapture(path)
+
+
+def convert_masks(sources, path, threshold=MASK_THRESHOLD, compression=None):
+    """Threshold mask videos into one archive at path, in order.
+
+    Several sources, such as the chunks of a chunked prediction, are joined
+    into a single archive. Returns the number of frames written.
+    """
+    writer = None
+    gray = None
+    try:
+        for source in sources:
+            cap = cv2.VideoCapture(source)
+            try:
+                if writer is None:
+                    width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+                    height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+                    writer = MaskArchiveWriter(path, width, height, cap.get(cv2.CAP_PROP_FPS), compression)
+                    gray = np.empty((height, width), dtype=np.uint8)
+                while True:
+                    ret, frame = cap.read()
+                    if not ret:
+                        break
+                    cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY, dst=gray)
+                    # Same test as the compositor: not black means subject
+                    cv2.threshold(gray, threshold - 1, 255, cv2.THRESH_BINARY, dst=gray)
+                    writer.write(gray)
+            finally:
+                cap.release()
+    finally:
+        if writer is not None:
+            writer.release()
+    return writer.frames if writer is not None else 0
+
+
+def get_archive_cache():
+    """Return the process-wide cache of mask archives."""
+    global _archive_cache
+    with _archive_cache_lock:
+        if _archive_cache is None:
+            _archive_cache = FileCache(MASK_ARCHIVE_DIR, MASK_ARCHIVE_MAX_BYTES, suffix='.masks')
+        return _archive_cache
+
+
+metrics.register_cache('mask_archive', lambda: get_archive_cache().stats())
+
+
+def acquire_mask_archive(urls):
+    """Return the local archive of the mask videos at urls, converting them if needed.
+
+    Prediction output URLs never change content, so the URLs alone are the
+    key and a cached archive is used without touching the network. The path
+    stays valid until it is passed to release_mask_archive().
+    """
+    urls = [urls] if isinstance(urls, str) else list(urls)
+
+    def fill(path):
+        sources = acquire_all(urls)
+        try:
+            with metrics.stage('mask_archive'):
+                convert_masks(sources, path)
+        finally:
+            for source in sources:
+                release_video(source)
+        metrics.STAGE_BYTES.observe(os.path.getsize(path), stage='mask_archive')
+
+    return get_archive_cache().acquire('\n'.join(urls), fill)
+
+
+def release_mask_archive(path):
+    get_archive_cache().release(path)
+
+
+def acquire_mask_archives(url_lists):
+    """Acquire the archives of several lists of mask video URLs concurrently."""
+    with ThreadPoolExecutor(max_workers=max(len(url_lists), 1)) as executor:
+        futures = [executor.submit(acquire_mask_archive, urls) for urls in url_lists]
+        paths, error = [], None
+        for future in futures:
+            try:
+                paths.append(future.result())
+            except Exception as e:
+                error = error or e
+    if error is not None:
+        for path in paths:
+            release_mask_archive(path)
+        raise error
+    return paths
@@ -0,0 +1,73 @@
+import os
+import shutil
+import subprocess
+import tempfile
+
+import cv2
+
+
+def find_ffmpeg():
+    """Return the path of the ffmpeg binary, or None if it is not installed."""
+    return os.getenv("FFMPEG_BINARY") or shutil.which("ffmpeg")
+
+
+def frame_count(path):
+    """Return the number of frames the container reports for a video."""
+    cap = cv2.VideoCapture(path)
+    try:
+        return int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    finally:
+        cap.release()
+
+
+def video_fps(path):
+    """Return the frame rate of a video file or URL, or 0.0 if unknown."""
+    cap = cv2.VideoCapture(path)
+    try:
+        return cap.get(cv2.CAP_PROP_FPS) if cap.isOpened() else 0.0
+    finally:
+        cap.release()
+
+
+def concat_videos(paths, output_path, writer_factory=None, audio_source=None):
+    """Join videos with identical encoding settings into one file.
+
+    With ffmpeg the streams are copied without re-encoding, and the audio of
+    audio_source is muxed in. Otherwise the frames are decoded and written
+    again with writer_factory(path, fps, width, height, audio_source=...),
+    which costs a second encode.
+    """
+    ffmpeg = find_ffmpeg()
+    if ffmpeg:
+        with tempfile.NamedTemporaryFile('w', suffix='.txt', delete=False) as f:
+            for path in paths:
+                f.write(f"file '{os.path.abspath(path)}'\n")
+            list_path = f.name
+        command = [ffmpeg, '-y', '-loglevel', 'error', '-f', 'concat', '-safe', '0', '-i', list_path]
+        if audio_source:
+            command += ['-i', audio_source, '-map', '0:v:0', '-map', '1:a:0?', '-shortest']
+        try:
+            subprocess.run(command + ['-c', 'copy', output_path], check=True)
+        finally:
+            os.unlink(list_path)
+        return
+
+    print("ffmpeg not found, re-encoding segments to join them")
+    writer = None
+    try:
+        for path in paths:
+            cap = cv2.VideoCapture(path)
+            if writer is None:
+                width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+                height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+                fps = cap.get(cv2.CAP_PROP_FPS)
+                writer = writer_factory(output_path, fps, width, height, audio_source=audio_source)
+            while True:
+                ret, frame = cap.read()
+                if not ret:
+                    break
+                writer.write(frame)
+            cap.release()
+    finally:
+        if writer is not None:
+            writer.release()
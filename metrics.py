@@ -0,0 +1,286 @@
+"""Process-wide metrics in the Prometheus text format, and per-job profiles.
+
+Counters and histograms live in memory and are rendered by render(), which
+run.py serves on /metrics. Each process keeps its own values: segment mode
+workers report through the stats they return, not here.
+
+Stages are timed with stage(name), which also counts the errors they
+raise. Cache hit rates are read from the caches' own stats() when metrics
+are scraped, see register_cache().
+"""
+import contextlib
+import cProfile
+import math
+import pstats
+import threading
+import time
+
+DURATION_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+# 64 KiB to 16 GiB, by factors of 4
+BYTES_BUCKETS = tuple(64 * 1024 * 4 ** n for n in range(10))
+FRAMES_BUCKETS = (25, 100, 250, 500, 1000, 2500, 5000, 10000, 25000, 100000)
+FPS_BUCKETS = (1, 5, 10, 25, 50, 100, 200, 400, 800)
+
+_metrics = []
+_caches = {}
+_registry_lock = threading.Lock()
+_local = threading.local()
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in labels) + '}'
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        with _registry_lock:
+            _metrics.append(self)
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} takes labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _labels(self, key, *extra):
+        return list(zip(self.labelnames, key)) + list(extra)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+        with self._lock:
+            values = sorted(self._values.items())
+        for key, value in values:
+            lines.extend(self._samples(key, value))
+        return lines
+
+
+class Counter(_Metric):
+    """A count that only goes up, such as errors."""
+
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def _samples(self, key, value):
+        return [f'{self.name}{_format_labels(self._labels(key))} {_format_value(value)}']
+
+
+class Histogram(_Metric):
+    """Observations such as durations, counted in cumulative buckets."""
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=DURATION_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0.0))
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+                    break
+            self._values[key] = (counts, total + value)
+
+    def count(self, **labels):
+        with self._lock:
+            counts, _ = self._values.get(self._key(labels), ([0], 0.0))
+            return sum(counts)
+
+    def _samples(self, key, value):
+        counts, total = value
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, counts):
+            cumulative += count
+            labels = _format_labels(self._labels(key, ('le', _format_value(bound))))
+            lines.append(f'{self.name}_bucket{labels} {cumulative}')
+        labels = _format_labels(self._labels(key))
+        lines.append(f'{self.name}_sum{labels} {_format_value(total)}')
+        lines.append(f'{self.name}_count{labels} {cumulative}')
+        return lines
+
+
+STAGE_SECONDS = Histogram('sam2_stage_duration_seconds',
+                          'Wall time of download, inference, mask_archive, composite, upload and the request flows',
+                          ['stage'])
+STAGE_ERRORS = Counter('sam2_stage_errors_total', 'Stages that failed with an error', ['stage'])
+STAGE_BYTES = Histogram('sam2_stage_bytes', 'Bytes downloaded, converted, written or uploaded by a stage',
+                        ['stage'], BYTES_BUCKETS)
+VIDEO_FRAMES = Histogram('sam2_video_frames', 'Frames per composited video', [], FRAMES_BUCKETS)
+VIDEO_FPS = Histogram('sam2_video_fps', 'Frames per second of compositing a whole video', [], FPS_BUCKETS)
+PIPELINE_BUSY = Histogram('sam2_pipeline_busy_seconds',
+                          'Time each thread of the compositing pipeline worked per video: read_original '
+                          'decodes, read_mask_* read masks, composite composites and write encodes',
+                          ['thread'])
+JOB_STAGE_SECONDS = Histogram('sam2_job_stage_duration_seconds', 'Wall time of each job stage', ['stage'])
+JOB_STAGE_ERRORS = Counter('sam2_job_stage_errors_total', 'Job stages that failed with an error', ['stage'])
+JOBS = Counter('sam2_jobs_total', 'Finished jobs by outcome', ['status'])
+
+
+@contextlib.contextmanager
+def timed(histogram, errors, **labels):
+    """Observe the duration of the block in histogram, and count errors it raises."""
+    start = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        errors.inc(**labels)
+        raise
+    finally:
+        histogram.observe(time.perf_counter() - start, **labels)
+
+
+def stage(name):
+    """Time the block as stage name in sam2_stage_duration_seconds."""
+    return timed(STAGE_SECONDS, STAGE_ERRORS, stage=name)
+
+
+def record_video(stats):
+    """Record the frames, speed and per-thread busy time of one composited video."""
+    VIDEO_FRAMES.observe(stats['frames'])
+    if stats['seconds']:
+        VIDEO_FPS.observe(stats['frames'] / stats['seconds'])
+    for thread, timing in stats.get('stages', {}).items():
+        PIPELINE_BUSY.observe(timing['busy'], thread=thread)
+
+
+def register_cache(name, stats):
+    """Report a cache's hits, misses, entries and bytes on every scrape.
+
+    stats is called with no arguments and returns a dict such as
+    FileCache.stats() does.
+    """
+    with _registry_lock:
+        _caches[name] = stats
+
+
+def _render_caches():
+    with _registry_lock:
+        caches = sorted(_caches.items())
+    families = (
+        ('sam2_cache_hits_total', 'counter', 'Lookups answered from a cache', 'hits'),
+        ('sam2_cache_misses_total', 'counter', 'Lookups that had to fill a cache', 'misses'),
+        ('sam2_cache_entries', 'gauge', 'Entries in a cache', 'entries'),
+        ('sam2_cache_bytes', 'gauge', 'Bytes held by a cache', 'bytes'),
+    )
+    samples = {name: [] for name, _, _, _ in families}
+    for cache, stats in caches:
+        try:
+            values = stats()
+        except Exception as e:
+            print(f"Could not read stats of the {cache} cache: {e}")
+            continue
+        for name, _, _, field in families:
+            if field in values:
+                samples[name].append(f'{name}{_format_labels([("cache", cache)])} {values[field]}')
+    lines = []
+    for name, kind, help, _ in families:
+        if samples[name]:
+            lines += [f'# HELP {name} {help}', f'# TYPE {name} {kind}'] + samples[name]
+    return lines
+
+
+def render():
+    """All metrics in the Prometheus text exposition format."""
+    with _registry_lock:
+        metrics = list(_metrics)
+    lines = []
+    for metric in metrics:
+        lines.extend(metric.render())
+    lines.extend(_render_caches())
+    return '\n'.join(lines) + '\n'
+
+
+class Profile:
+    """cProfile stats of one job, gathered from the threads it ran on."""
+
+    def __init__(self, path):
+        self.path = path
+        self._profilers = []
+        self._lock = threading.Lock()
+
+    def add(self, profiler):
+        with self._lock:
+            self._profilers.append(profiler)
+
+    def dump(self):
+        with self._lock:
+            profilers = list(self._profilers)
+        if not profilers:
+            return None
+        stats = pstats.Stats(profilers[0])
+        for profiler in profilers[1:]:
+            stats.add(profiler)
+        stats.dump_stats(self.path)
+        return self.path
+
+
+def current_profile():
+    """The Profile of the block running on this thread, or None."""
+    return getattr(_local, 'profile', None)
+
+
+@contextlib.contextmanager
+def profile_thread(profile):
+    """Profile this thread for the duration of the block into profile (None does nothing).
+
+    Threads that work for a profiled block call this with the block's
+    current_profile(), so their time ends up in the same dump.
+    """
+    if profile is None:
+        yield
+        return
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        # Python 3.12+ allows one active profiler per process
+        yield
+        return
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profile.add(profiler)
+
+
+@contextlib.contextmanager
+def profiling(path):
+    """Profile the block with cProfile and write the stats to path, for pstats or snakeviz."""
+    profile = Profile(path)
+    previous = current_profile()
+    _local.profile = profile
+    try:
+        with profile_thread(profile):
+            yield profile
+    finally:
+        _local.profile = previous
+        profile.dump()
@@ -0,0 +1,195 @@
+import mimetypes
+import os
+import shutil
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+
+def configure():
+    """Read the storage settings from the environment."""
+    global STORAGE_BACKEND, GCP_CREDENTIALS_PATH, UPLOAD_CHUNK_SIZE, PARALLEL_UPLOAD_MIN_SIZE
+    global PARALLEL_UPLOAD_PART_SIZE, UPLOAD_WORKERS, LOCAL_STORAGE_DIR, LOCAL_STORAGE_URL
+    # Where finished videos are uploaded: 'gcs' or 'local'
+    STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "gcs")
+
+    # Service account key for GCS; when the file does not exist the default
+    # Google credentials are used (GOOGLE_APPLICATION_CREDENTIALS, metadata server)
+    GCP_CREDENTIALS_PATH = os.getenv("GCP_CREDENTIALS_PATH", "key.json")
+
+    # Resumable upload chunk size, a multiple of 256 KiB
+    UPLOAD_CHUNK_SIZE = int(os.getenv("UPLOAD_CHUNK_SIZE", str(8 * 1024 * 1024)))
+    # Files at least this large are uploaded as parallel parts
+    PARALLEL_UPLOAD_MIN_SIZE = int(os.getenv("PARALLEL_UPLOAD_MIN_SIZE", str(64 * 1024 * 1024)))
+    PARALLEL_UPLOAD_PART_SIZE = int(os.getenv("PARALLEL_UPLOAD_PART_SIZE", str(32 * 1024 * 1024)))
+    UPLOAD_WORKERS = int(os.getenv("UPLOAD_WORKERS", "8"))
+
+    # The local stand-in copies files into a directory and serves them from a base
+    # URL. Relative to the app's directory, so processes started from anywhere share it
+    LOCAL_STORAGE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                     os.getenv("LOCAL_STORAGE_DIR", os.path.join("cache", "uploads")))
+    LOCAL_STORAGE_URL = os.getenv("LOCAL_STORAGE_URL", "")
+
+
+configure()
+
+_storage = None
+_storage_lock = threading.Lock()
+
+
+class StorageBackend:
+    """Interface for the places finished videos are published to."""
+
+    def __init__(self):
+        self._executor = None
+        self._executor_lock = threading.Lock()
+
+    def upload(self, local_path, name, content_type=None, overwrite=False):
+        """Upload local_path as name and return its public URL.
+
+        Unless overwrite is set, uploading to a name that exists fails.
+        """
+        raise NotImplementedError
+
+    def delete(self, name):
+        """Remove name; a name that does not exist is ignored."""
+        raise NotImplementedError
+
+    def public_url(self, name):
+        raise NotImplementedError
+
+    def upload_async(self, local_path, name, content_type=None, overwrite=False):
+        """Start upload() in the background and return a Future of the URL."""
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=UPLOAD_WORKERS,
+                                                    thread_name_prefix='upload')
+        return self._executor.submit(self.upload, local_path, name, content_type, overwrite)
+
+
+class GCSStorage(StorageBackend):
+    """Google Cloud Storage bucket, with one client reused for every upload."""
+
+    def __init__(self, bucket_name, chunk_size=None):
+        super().__init__()
+        self.bucket_name = bucket_name
+        self.chunk_size = chunk_size or UPLOAD_CHUNK_SIZE
+        self._bucket = None
+        self._lock = threading.Lock()
+
+    @property
+    def bucket(self):
+        with self._lock:
+            if self._bucket is None:
+                from google.cloud import storage
+                if os.path.isfile(GCP_CREDENTIALS_PATH):
+                    client = storage.Client.from_service_account_json(GCP_CREDENTIALS_PATH)
+                else:
+                    client = storage.Client()
+                self._bucket = client.bucket(self.bucket_name)
+            return self._bucket
+
+    def public_url(self, name):
+        return f"https://storage.googleapis.com/{self.bucket_name}/{name}"
+
+    def upload(self, local_path, name, content_type=None, overwrite=False):
+        blob = self.bucket.blob(name, chunk_size=self.chunk_size)
+        if overwrite:
+            # Objects that get replaced, like live playlists, must not be cached
+            blob.cache_control = 'no-cache'
+            blob.upload_from_filename(local_path, content_type=content_type)
+        elif os.path.getsize(local_path) >= PARALLEL_UPLOAD_MIN_SIZE:
+            # XML multipart upload, the parts are sent over parallel connections.
+            # It takes no preconditions, so the parts go to a temporary object
+            # that is composed into name only if name does not exist yet
+            from google.cloud.storage import transfer_manager
+            part = self.bucket.blob(f"{name}.{uuid.uuid4().hex}.part", chunk_size=self.chunk_size)
+            try:
+                transfer_manager.upload_chunks_concurrently(
+                    local_path, part, content_type=content_type,
+                    chunk_size=PARALLEL_UPLOAD_PART_SIZE, max_workers=UPLOAD_WORKERS,
+                    worker_type=transfer_manager.THREAD,
+                )
+                blob.content_type = content_type or mimetypes.guess_type(local_path)[0]
+                blob.compose([part], if_generation_match=0)
+            finally:
+                self.delete(part.name)
+        else:
+            # Resumable upload in chunk_size pieces, failing if the name is taken
+            blob.upload_from_filename(local_path, content_type=content_type, if_generation_match=0)
+        return self.public_url(name)
+
+    def delete(self, name):
+        from google.api_core.exceptions import NotFound
+        try:
+            self.bucket.blob(name).delete()
+        except NotFound:
+            pass
+
+
+class LocalStorage(StorageBackend):
+    """Copies files into a local directory, for running without network access.
+
+    bytes_per_second throttles copies to mimic a network link in benchmarks.
+    """
+
+    def __init__(self, directory=None, base_url=None, bytes_per_second=None):
+        super().__init__()
+        self.directory = directory or LOCAL_STORAGE_DIR
+        self.base_url = LOCAL_STORAGE_URL if base_url is None else base_url
+        self.bytes_per_second = bytes_per_second
+        os.makedirs(self.directory, exist_ok=True)
+
+    def public_url(self, name):
+        if self.base_url:
+            return f"{self.base_url.rstrip('/')}/{name}"
+        return 'file://' + os.path.abspath(os.path.join(self.directory, name))
+
+    def upload(self, local_path, name, content_type=None, overwrite=False):
+        destination = os.path.join(self.directory, name)
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        if os.path.exists(destination) and not overwrite:
+            raise FileExistsError(f"{name} already exists")
+        temp_path = f"{destination}.{threading.get_ident()}.part"
+        start = time.perf_counter()
+        with open(local_path, 'rb') as source, open(temp_path, 'wb') as target:
+            shutil.copyfileobj(source, target, UPLOAD_CHUNK_SIZE)
+        if self.bytes_per_second:
+            remaining = os.path.getsize(local_path) / self.bytes_per_second - (time.perf_counter() - start)
+            if remaining > 0:
+                time.sleep(remaining)
+        os.replace(temp_path, destination)
+        return self.public_url(name)
+
+    def delete(self, name):
+        try:
+            os.remove(os.path.join(self.directory, name))
+        except FileNotFoundError:
+            pass
+
+
+def make_storage(backend=None):
+    """Create the storage backend selected by STORAGE_BACKEND."""
+    backend = backend or STORAGE_BACKEND
+    if backend == 'gcs':
+        return GCSStorage(os.getenv("GCP_BUCKET_NAME"))
+    if backend == 'local':
+        return LocalStorage()
+    raise ValueError(f"Unknown storage backend: {backend}")
+
+
+def get_storage():
+    """Return the process-wide storage backend."""
+    global _storage
+    with _storage_lock:
+        if _storage is None:
+            _storage = make_storage()
+        return _storage
+
+
+def set_storage(storage):
+    """Replace the process-wide storage backend, e.g. with a LocalStorage stand-in."""
+    global _storage
+    with _storage_lock:
+        _storage = storage
@@ -0,0 +1,440 @@
+import os
+import queue
+import shutil
+import tempfile
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+import numpy as np
+
+from compositing import Compositor
+import metrics
+from encoders import make_encoder
+from mask_archive import MaskArchive, open_mask_video
+from media import concat_videos, frame_count
+from temporal import MaskInterpolator, mask_index
+
+
+def configure():
+    """Read the pipeline settings from the environment."""
+    global READ_QUEUE_DEPTH, WRITE_QUEUE_DEPTH, REPORT_TIMINGS, PARALLEL_MIN_FRAMES, SEGMENT_FRAMES
+    global SEGMENT_WORKERS
+    # Number of frames each queue between stages may hold. Together with the
+    # frames being worked on this bounds the memory used by one video.
+    READ_QUEUE_DEPTH = int(os.getenv("PIPELINE_READ_QUEUE_DEPTH", "4"))
+    WRITE_QUEUE_DEPTH = int(os.getenv("PIPELINE_WRITE_QUEUE_DEPTH", "4"))
+
+    # Print per-stage timings after every video
+    REPORT_TIMINGS = os.getenv("PIPELINE_REPORT_TIMINGS", "1") == "1"
+
+    # Videos with at least this many frames are split into segments that are
+    # composited in parallel worker processes (0 disables segment mode)
+    PARALLEL_MIN_FRAMES = int(os.getenv("PARALLEL_MIN_FRAMES", "4500"))
+    SEGMENT_FRAMES = int(os.getenv("SEGMENT_FRAMES", "1500"))
+    SEGMENT_WORKERS = int(os.getenv("SEGMENT_WORKERS", "0")) or os.cpu_count()
+
+
+configure()
+
+# Marks the end of a stream in a queue
+_DONE = object()
+
+# A mask video of one object and what to do with it, see compositing.LAYER_POLICIES
+MaskLayer = namedtuple('MaskLayer', ['path', 'policy'], defaults=['keep'])
+
+
+def mask_layers(mask_path):
+    """Normalize a mask path or a list of MaskLayer/(path, policy) into MaskLayers."""
+    if mask_path is None:
+        return []
+    if isinstance(mask_path, str):
+        return [MaskLayer(mask_path)]
+    return [MaskLayer(*layer) for layer in mask_path]
+
+
+class StageTimer:
+    """Time a stage spends working versus waiting on its neighbours."""
+
+    def __init__(self, name):
+        self.name = name
+        self.busy = 0.0
+        self.wait = 0.0
+        self.frames = 0
+
+    def as_dict(self):
+        return {'busy': self.busy, 'wait': self.wait, 'frames': self.frames}
+
+
+def video_properties(cap):
+    """Return (width, height, fps) of an opened VideoCapture.
+
+    fps is kept fractional, so 29.97 fps sources do not drift out of sync.
+    """
+    width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+    height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    return width, height, fps
+
+
+def seek(cap, frame_index):
+    """Position cap so that the next read returns frame_index."""
+    cap.set(cv2.CAP_PROP_POS_FRAMES, frame_index)
+    if int(cap.get(cv2.CAP_PROP_POS_FRAMES)) == frame_index:
+        return
+    # The container could not seek exactly, decode up to the frame instead
+    cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+    for _ in range(frame_index):
+        if not cap.grab():
+            break
+
+
+def _frame_pool(size, shape):
+    """A queue of preallocated frame buffers that stages hand back when done."""
+    pool = queue.Queue()
+    for _ in range(size):
+        pool.put(np.empty(shape, dtype=np.uint8))
+    return pool
+
+
+class CompositingPipeline:
+    """Decode, composite and encode a video on separate threads.
+
+    The original and mask videos are read by their own threads, composited on
+    a third and encoded on a fourth. Stages are joined by bounded queues, so a
+    slow stage makes the others wait instead of piling up frames in memory.
+    OpenCV releases the GIL while decoding, resizing and encoding, which lets
+    the stages run on different cores.
+
+    If mask_path is None the input video is its own mask, as with the SAM2
+    output video where the background is already black. mask_path can also
+    be a list of MaskLayer, one mask video per object, which are all read
+    alongside a single decode of the original. Mask paths can point at mask
+    archives (see mask_archive) instead of videos.
+
+    start_frame and max_frames restrict processing to a range of frames.
+
+    writer_factory(path, fps, width, height, audio_source=None) opens the
+    encoder; the audio of audio_source is carried over to the output.
+
+    With mask_interval N the mask video holds a mask for every Nth original
+    frame, and the masks in between are filled in with mask_fill ('hold' or
+    'flow', see temporal.MaskInterpolator).
+
+    feather is the width of the soft edge around the subject, see Compositor.
+    """
+
+    def __init__(self, original_path, mask_path, output_path, background=None,
+                 read_queue_depth=None, write_queue_depth=None, writer_factory=make_encoder,
+                 start_frame=0, max_frames=None, report_timings=None, audio_source=None,
+                 mask_interval=1, mask_fill=None, feather=None):
+        self.original_path = original_path
+        self.mask_path = mask_path
+        self.layers = mask_layers(mask_path)
+        self.output_path = output_path
+        self.background = background
+        self.read_queue_depth = read_queue_depth or READ_QUEUE_DEPTH
+        self.write_queue_depth = write_queue_depth or WRITE_QUEUE_DEPTH
+        self.writer_factory = writer_factory
+        self.start_frame = start_frame
+        self.max_frames = max_frames
+        self.report_timings = REPORT_TIMINGS if report_timings is None else report_timings
+        self.audio_source = audio_source
+        self.mask_interval = max(1, int(mask_interval or 1))
+        self.mask_fill = mask_fill
+        self.feather = feather
+
+        self._stop = threading.Event()
+        self._errors = []
+        self.timers = {}
+
+    def _put(self, q, item, timer):
+        start = time.perf_counter()
+        while not self._stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                break
+            except queue.Full:
+                continue
+        timer.wait += time.perf_counter() - start
+        return not self._stop.is_set()
+
+    def _get(self, q, timer):
+        start = time.perf_counter()
+        item = _DONE
+        while not self._stop.is_set():
+            try:
+                item = q.get(timeout=0.1)
+                break
+            except queue.Empty:
+                continue
+        timer.wait += time.perf_counter() - start
+        return item
+
+    def _run_stage(self, target, *args):
+        try:
+            with metrics.profile_thread(self._profile):
+                target(*args)
+        except Exception as e:
+            self._errors.append(e)
+            self._stop.set()
+
+    def _read(self, cap, pool, out_queue, timer):
+        while not self._stop.is_set():
+            if self.max_frames is not None and timer.frames >= self.max_frames:
+                break
+            buffer = self._get(pool, timer)
+            if buffer is _DONE:
+                break
+            start = time.perf_counter()
+            ret, frame = cap.read(buffer)
+            timer.busy += time.perf_counter() - start
+            if not ret:
+                break
+            timer.frames += 1
+            if not self._put(out_queue, frame, timer):
+                break
+        self._put(out_queue, _DONE, timer)
+
+    def _composite(self, compositor, original_queue, original_pool, mask_inputs,
+                   output_pool, write_queue, timer):
+        # mask_inputs holds a (queue, pool, interpolator, policy) tuple per
+        # mask layer, the interpolator is None unless masks are sub-sampled
+        frame_index = self.start_frame
+        while not self._stop.is_set():
+            frame = self._get(original_queue, timer)
+            if frame is _DONE:
+                break
+            masks = []
+            for mask_queue, _, interpolator, _ in mask_inputs:
+                mask = None
+                if interpolator is None or not interpolator.has_mask or frame_index % self.mask_interval == 0:
+                    mask = self._get(mask_queue, timer)
+                    if mask is _DONE:
+                        break
+                masks.append(mask)
+            if len(masks) < len(mask_inputs):
+                break
+            output = self._get(output_pool, timer)
+            if output is _DONE:
+                break
+
+            start = time.perf_counter()
+            layers = []
+            for (_, _, interpolator, policy), mask in zip(mask_inputs, masks):
+                if interpolator is not None:
+                    mask = interpolator.key(frame, mask) if mask is not None else interpolator.fill(frame)
+                layers.append((mask, policy))
+            if not layers:
+                compositor.composite(frame, frame, output)
+            elif len(layers) == 1 and layers[0][1] == 'keep':
+                compositor.composite(frame, layers[0][0], output)
+            else:
+                compositor.composite_layers(frame, layers, output)
+            timer.busy += time.perf_counter() - start
+            timer.frames += 1
+            frame_index += 1
+
+            original_pool.put(frame)
+            for (_, mask_pool, _, _), mask in zip(mask_inputs, masks):
+                if mask is not None:
+                    mask_pool.put(mask)
+            if not self._put(write_queue, output, timer):
+                break
+        self._put(write_queue, _DONE, timer)
+        # Either input may have ended first, release the other reader
+        self._stop.set()
+
+    def _write(self, writer, write_queue, output_pool, timer):
+        while True:
+            # Drain the queue even after the other stages have stopped
+            start = time.perf_counter()
+            try:
+                output = write_queue.get(timeout=0.1)
+            except queue.Empty:
+                timer.wait += time.perf_counter() - start
+                if self._stop.is_set() and write_queue.empty():
+                    break
+                continue
+            timer.wait += time.perf_counter() - start
+            if output is _DONE:
+                break
+            start = time.perf_counter()
+            writer.write(output)
+            timer.busy += time.perf_counter() - start
+            timer.frames += 1
+            output_pool.put(output)
+
+    def run(self):
+        """Process the whole video and return frame count and stage timings."""
+        start = time.perf_counter()
+        # Stage threads add their time to the caller's profile, if it is profiled
+        self._profile = metrics.current_profile()
+        cap_original = cv2.VideoCapture(self.original_path)
+        mask_caps = [open_mask_video(layer.path) for layer in self.layers]
+        writer = None
+        try:
+            width, height, fps = video_properties(cap_original)
+            if self.start_frame:
+                seek(cap_original, self.start_frame)
+                for cap_mask in mask_caps:
+                    seek(cap_mask, mask_index(self.start_frame, self.mask_interval))
+            writer = self.writer_factory(self.output_path, fps, width, height,
+                                         audio_source=self.audio_source)
+            compositor = Compositor(width, height, self.background, feather=self.feather,
+                                    start_frame=self.start_frame)
+
+            # Each pool holds enough buffers for a full queue plus the frames
+            # being read, composited and written at the same time
+            pool_size = self.read_queue_depth + 2
+            original_queue = queue.Queue(self.read_queue_depth)
+            original_pool = _frame_pool(pool_size, (height, width, 3))
+            mask_inputs = []
+            for layer, cap_mask in zip(self.layers, mask_caps):
+                mask_width, mask_height, _ = video_properties(cap_mask)
+                # Archives hold single-channel masks, videos decode to BGR
+                mask_shape = (mask_height, mask_width)
+                if not isinstance(cap_mask, MaskArchive):
+                    mask_shape += (3,)
+                interpolator = None
+                if self.mask_interval > 1:
+                    interpolator = MaskInterpolator(width, height, self.mask_fill,
+                                                    upscaler=compositor.upscaler)
+                mask_inputs.append((queue.Queue(self.read_queue_depth),
+                                    _frame_pool(pool_size, mask_shape),
+                                    interpolator, layer.policy))
+            write_queue = queue.Queue(self.write_queue_depth)
+            output_pool = _frame_pool(self.write_queue_depth + 2, (height, width, 3))
+
+            mask_names = ['read_mask'] if len(mask_caps) == 1 else [
+                f'read_mask_{index + 1}' for index in range(len(mask_caps))]
+            self.timers = {name: StageTimer(name)
+                           for name in ['read_original', *mask_names, 'composite', 'write']}
+            threads = [
+                threading.Thread(target=self._run_stage, args=(
+                    self._read, cap_original, original_pool, original_queue, self.timers['read_original'])),
+                threading.Thread(target=self._run_stage, args=(
+                    self._composite, compositor, original_queue, original_pool, mask_inputs,
+                    output_pool, write_queue, self.timers['composite'])),
+                threading.Thread(target=self._run_stage, args=(
+                    self._write, writer, write_queue, output_pool, self.timers['write'])),
+            ]
+            for name, cap_mask, (mask_queue, mask_pool, _, _) in zip(mask_names, mask_caps, mask_inputs):
+                threads.append(threading.Thread(target=self._run_stage, args=(
+                    self._read, cap_mask, mask_pool, mask_queue, self.timers[name])))
+
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            cap_original.release()
+            for cap_mask in mask_caps:
+                cap_mask.release()
+            if writer is not None:
+                writer.release()
+
+        if self._errors:
+            raise self._errors[0]
+
+        stats = {
+            'frames': self.timers['write'].frames,
+            'seconds': time.perf_counter() - start,
+            'stages': {name: timer.as_dict() for name, timer in self.timers.items()},
+        }
+        if self.report_timings:
+            print_timings(stats)
+        return stats
+
+
+def print_timings(stats):
+    fps = stats['frames'] / stats['seconds'] if stats['seconds'] else 0.0
+    print(f"Processed {stats['frames']} frames in {stats['seconds']:.2f}s ({fps:.1f} fps)")
+    for name, timing in stats['stages'].items():
+        print(f"  {name:<14} busy {timing['busy']:7.2f}s  wait {timing['wait']:7.2f}s")
+
+
+def _composite_segment(original_path, mask_path, output_path, background, writer_factory,
+                       start_frame, max_frames, mask_interval, mask_fill, feather):
+    """Worker process entry point for one segment of composite_video_parallel."""
+    pipeline = CompositingPipeline(original_path, mask_path, output_path, background,
+                                   writer_factory=writer_factory, start_frame=start_frame,
+                                   max_frames=max_frames, report_timings=False,
+                                   mask_interval=mask_interval, mask_fill=mask_fill, feather=feather)
+    return pipeline.run()
+
+
+def composite_video_parallel(original_path, mask_path, output_path, background=None,
+                             workers=None, segment_frames=None, writer_factory=make_encoder,
+                             audio_source=None, mask_interval=1, mask_fill=None, feather=None):
+    """Composite a long video as frame ranges in parallel worker processes.
+
+    Each worker seeks both videos to the start of its range and encodes the
+    range to its own file. The segments are then joined in order, so every
+    composited frame is the same as with the serial pipeline. The audio of
+    audio_source is added while joining.
+    """
+    start = time.perf_counter()
+    workers = workers or SEGMENT_WORKERS
+    segment_frames = segment_frames or SEGMENT_FRAMES
+    # Segments start on frames that have a model mask, so filled-in masks
+    # come out the same as with the serial pipeline
+    mask_interval = max(1, int(mask_interval or 1))
+    segment_frames = max(1, round(segment_frames / mask_interval)) * mask_interval
+    total_frames = frame_count(original_path)
+    starts = list(range(0, max(total_frames, 1), segment_frames))
+
+    extension = os.path.splitext(output_path)[1] or '.mp4'
+    segment_dir = tempfile.mkdtemp(prefix='segments_')
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = []
+            for index, start_frame in enumerate(starts):
+                # The last segment reads to the end, in case the reported
+                # frame count is short
+                max_frames = segment_frames if index < len(starts) - 1 else None
+                segment_path = os.path.join(segment_dir, f'segment_{index:05d}{extension}')
+                futures.append((segment_path, executor.submit(
+                    _composite_segment, original_path, mask_path, segment_path, background,
+                    writer_factory, start_frame, max_frames, mask_interval, mask_fill, feather)))
+            results = [(path, future.result()) for path, future in futures]
+
+        # A mask shorter than the original leaves empty trailing segments
+        segments = [path for path, stats in results if stats['frames'] > 0]
+        if len(segments) == 1 and not audio_source:
+            shutil.move(segments[0], output_path)
+        elif segments:
+            concat_videos(segments, output_path, writer_factory, audio_source=audio_source)
+    finally:
+        shutil.rmtree(segment_dir, ignore_errors=True)
+
+    stats = {
+        'frames': sum(stats['frames'] for _, stats in results),
+        'seconds': time.perf_counter() - start,
+        'segments': len(segments),
+    }
+    if REPORT_TIMINGS:
+        fps = stats['frames'] / stats['seconds'] if stats['seconds'] else 0.0
+        print(f"Processed {stats['frames']} frames in {stats['segments']} segments "
+              f"on {workers} workers in {stats['seconds']:.2f}s ({fps:.1f} fps)")
+    return stats
+
+
+def composite_video(original_path, mask_path, output_path, background=None, parallel=None, **options):
+    """Composite original_path over background using mask_path and encode to output_path.
+
+    Long videos are split across worker processes unless parallel is False.
+    """
+    if parallel is None:
+        parallel = PARALLEL_MIN_FRAMES > 0 and frame_count(original_path) >= PARALLEL_MIN_FRAMES
+    with metrics.stage('composite'):
+        if parallel:
+            stats = composite_video_parallel(original_path, mask_path, output_path, background, **options)
+        else:
+            stats = CompositingPipeline(original_path, mask_path, output_path, background, **options).run()
+    metrics.record_video(stats)
+    if os.path.isfile(output_path):
+        metrics.STAGE_BYTES.observe(os.path.getsize(output_path), stage='composite')
+    return stats
@@ -0,0 +1,125 @@
+import os
+import shutil
+import tempfile
+import threading
+
+import cv2
+import requests
+
+import downloads
+from downloads import acquire_video, get_session, get_video_cache, probe, release_video, video_cache_key
+
+
+def configure():
+    """Read the preview settings from the environment."""
+    global PREVIEW_HEAD_BYTES, PREVIEW_TAIL_BYTES, PREVIEW_TIMEOUT_MS, PREFETCH_ON_PREVIEW
+    # Bytes fetched from the start (and, for files with the index at the end,
+    # from the end) of a video when it cannot be opened from its URL directly
+    PREVIEW_HEAD_BYTES = int(os.getenv("PREVIEW_HEAD_BYTES", str(4 * 1024 * 1024)))
+    PREVIEW_TAIL_BYTES = int(os.getenv("PREVIEW_TAIL_BYTES", str(1024 * 1024)))
+    PREVIEW_TIMEOUT_MS = int(os.getenv("PREVIEW_TIMEOUT_MS", "15000"))
+
+    # Download the whole video into the cache in the background after a preview,
+    # so it is ready by the time the annotations are submitted
+    PREFETCH_ON_PREVIEW = os.getenv("PREFETCH_ON_PREVIEW", "1") == "1"
+
+
+configure()
+
+
+def _read_from(source, frame_index, params=()):
+    cap = cv2.VideoCapture(source, cv2.CAP_FFMPEG, list(params))
+    try:
+        if not cap.isOpened():
+            return None
+        if frame_index:
+            cap.set(cv2.CAP_PROP_POS_FRAMES, frame_index)
+        ret, frame = cap.read()
+        return frame if ret else None
+    finally:
+        cap.release()
+
+
+def _read_from_url(url, frame_index):
+    # FFmpeg only requests the byte ranges it needs to decode the frame
+    params = (cv2.CAP_PROP_OPEN_TIMEOUT_MSEC, PREVIEW_TIMEOUT_MS,
+              cv2.CAP_PROP_READ_TIMEOUT_MSEC, PREVIEW_TIMEOUT_MS)
+    return _read_from(url, frame_index, params)
+
+
+def _fetch_range(url, start, end):
+    headers = {'Range': f'bytes={start}-{end}'}
+    response = get_session().get(url, headers=headers, timeout=downloads.DOWNLOAD_TIMEOUT)
+    response.raise_for_status()
+    if response.status_code != 206:
+        raise requests.HTTPError(f"Server ignored range request for {url}")
+    return response.content
+
+
+def _read_from_ranges(url, info, frame_index):
+    """Decode a frame from a sparse local copy holding only the head and tail of the file.
+
+    The head holds the first keyframes. The tail holds the moov atom of MP4
+    files that were not written for progressive playback.
+    """
+    if not (info.accepts_ranges and info.size):
+        return None
+    directory = tempfile.mkdtemp(prefix='preview_')
+    try:
+        path = os.path.join(directory, 'partial.mp4')
+        with open(path, 'wb') as f:
+            f.truncate(info.size)
+            head_end = min(PREVIEW_HEAD_BYTES, info.size) - 1
+            f.write(_fetch_range(url, 0, head_end))
+            tail_start = max(info.size - PREVIEW_TAIL_BYTES, head_end + 1)
+            if tail_start < info.size:
+                f.seek(tail_start)
+                f.write(_fetch_range(url, tail_start, info.size - 1))
+        return _read_from(path, frame_index)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def _read_from_download(url, info, frame_index):
+    path = acquire_video(url, info)
+    try:
+        return _read_from(path, frame_index)
+    finally:
+        release_video(path)
+
+
+def _prefetch(url, info):
+    try:
+        release_video(acquire_video(url, info))
+    except Exception as e:
+        print(f"Error prefetching video: {str(e)}")
+
+
+def read_frame(url, frame_index=0):
+    """Decode one frame of the video at url, fetching as little of it as possible.
+
+    Tries, in order: the video cache, opening the URL with FFmpeg, a partial
+    copy with only the head and tail of the file, and a full download.
+    Returns None if the frame cannot be decoded.
+    """
+    info = probe(url)
+    cache = get_video_cache()
+    cached_path = cache.lookup(video_cache_key(url, info))
+    if cached_path:
+        try:
+            return _read_from(cached_path, frame_index)
+        finally:
+            cache.release(cached_path)
+
+    if PREFETCH_ON_PREVIEW:
+        threading.Thread(target=_prefetch, args=(url, info), daemon=True).start()
+
+    frame = _read_from_url(url, frame_index)
+    if frame is None:
+        try:
+            frame = _read_from_ranges(url, info, frame_index)
+        except requests.RequestException as e:
+            print(f"Partial download failed ({e}), downloading the whole video")
+    if frame is None:
+        frame = _read_from_download(url, info, frame_index)
+    return frame
@@ -0,0 +1,81 @@
+import os
+import subprocess
+
+import cv2
+
+import encoders
+from encoders import make_encoder
+from media import find_ffmpeg
+
+
+def configure():
+    """Read the proxy settings from the environment."""
+    global PROXY_MAX_DIM, PROXY_CRF
+    # SAM2 runs on a copy of the video scaled down so its longest side is at most
+    # PROXY_MAX_DIM pixels (0 sends the original). The masks are scaled back up
+    # to the original resolution when compositing.
+    PROXY_MAX_DIM = int(os.getenv("PROXY_MAX_DIM", "0"))
+    # Quality of the proxy encode, lower is better
+    PROXY_CRF = int(os.getenv("PROXY_CRF", "20"))
+
+
+configure()
+
+
+def proxy_size(width, height, max_dim=None):
+    """Return the (width, height) of the proxy, or None if no proxy is needed."""
+    max_dim = PROXY_MAX_DIM if max_dim is None else max_dim
+    if not max_dim or max(width, height) <= max_dim:
+        return None
+    scale = max_dim / max(width, height)
+    # H.264 with 4:2:0 chroma needs even dimensions
+    return max(2, round(width * scale / 2) * 2), max(2, round(height * scale / 2) * 2)
+
+
+def scale_coordinates(coordinates, from_size, to_size):
+    """Map [x, y] pixel coordinates from one frame size to another."""
+    scale_x = to_size[0] / from_size[0]
+    scale_y = to_size[1] / from_size[1]
+    return [[min(round(x * scale_x), to_size[0] - 1), min(round(y * scale_y), to_size[1] - 1)]
+            for x, y in coordinates]
+
+
+def make_proxy(source, output_path, max_dim=None):
+    """Transcode a scaled-down copy of source to output_path.
+
+    Returns ((width, height) of source, (width, height) of the proxy), or
+    None without writing anything if source is small enough already.
+    """
+    cap = cv2.VideoCapture(source)
+    try:
+        width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+        height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        fps = cap.get(cv2.CAP_PROP_FPS)
+        size = proxy_size(width, height, max_dim)
+        if size is None:
+            return None
+
+        ffmpeg = find_ffmpeg()
+        if ffmpeg:
+            # ffmpeg decodes and scales on its own threads; every frame is
+            # kept so mask frames line up with the original frames
+            subprocess.run(
+                [ffmpeg, '-y', '-loglevel', 'error', '-i', source,
+                 '-vf', f'scale={size[0]}:{size[1]}:flags=area', '-fps_mode', 'passthrough', '-an',
+                 '-c:v', encoders.ENCODER_CODEC, '-preset', encoders.ENCODER_PRESET, '-crf', str(PROXY_CRF),
+                 '-pix_fmt', 'yuv420p', '-movflags', '+faststart', output_path],
+                check=True,
+            )
+        else:
+            writer = make_encoder(output_path, fps, *size)
+            try:
+                while True:
+                    ret, frame = cap.read()
+                    if not ret:
+                        break
+                    writer.write(cv2.resize(frame, size, interpolation=cv2.INTER_AREA))
+            finally:
+                writer.release()
+        return (width, height), size
+    finally:
+        cap.release()
@@ -0,0 +1,129 @@
+import contextlib
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+
+
+def configure():
+    """Read the result cache settings from the environment."""
+    global RESULT_CACHE_PATH, RESULT_CACHE_TTL, RESULT_CACHE_MAX_ENTRIES
+    # Where memoized SAM2 results are kept. Replicate deletes prediction outputs
+    # after about an hour, so results older than that point at dead URLs.
+    # Relative to the app's directory, so processes started from anywhere share it.
+    RESULT_CACHE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.getenv(
+        "RESULT_CACHE_PATH", os.path.join("cache", "inference_results.sqlite3")))
+    RESULT_CACHE_TTL = float(os.getenv("RESULT_CACHE_TTL", "3600"))
+    RESULT_CACHE_MAX_ENTRIES = int(os.getenv("RESULT_CACHE_MAX_ENTRIES", "10000"))
+
+
+configure()
+
+
+def inference_key(model, model_input):
+    """Stable hash of a prediction: the model version and every input field."""
+    payload = json.dumps({'model': model, 'input': model_input}, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class ResultCache:
+    """Persistent memo of prediction outputs with TTL and LRU eviction.
+
+    Results live in SQLite, so they survive restarts and can be shared by
+    several processes. Identical predictions that are in flight at the same
+    time in this process run only once.
+    """
+
+    def __init__(self, path=None, ttl=None, max_entries=None):
+        self.path = path or RESULT_CACHE_PATH
+        self.ttl = RESULT_CACHE_TTL if ttl is None else ttl
+        self.max_entries = max_entries or RESULT_CACHE_MAX_ENTRIES
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connect() as db:
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('CREATE TABLE IF NOT EXISTS results ('
+                       'key TEXT PRIMARY KEY, output TEXT NOT NULL, '
+                       'created REAL NOT NULL, accessed REAL NOT NULL)')
+            db.execute('CREATE INDEX IF NOT EXISTS results_accessed ON results (accessed)')
+
+        self._lock = threading.Lock()
+        self._in_flight = {}
+        self.hits = 0
+        self.misses = 0
+        self.shared = 0
+
+    @contextlib.contextmanager
+    def _connect(self):
+        db = sqlite3.connect(self.path, timeout=30)
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    def get(self, key):
+        """Return the stored output for key, or None if missing or expired."""
+        now = time.time()
+        with self._connect() as db:
+            row = db.execute('SELECT output, created FROM results WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            if self.ttl and now - row[1] > self.ttl:
+                db.execute('DELETE FROM results WHERE key = ?', (key,))
+                return None
+            db.execute('UPDATE results SET accessed = ? WHERE key = ?', (now, key))
+        return json.loads(row[0])
+
+    def put(self, key, output):
+        now = time.time()
+        with self._connect() as db:
+            db.execute('INSERT OR REPLACE INTO results (key, output, created, accessed) VALUES (?, ?, ?, ?)',
+                       (key, json.dumps(output), now, now))
+            if self.ttl:
+                db.execute('DELETE FROM results WHERE created < ?', (now - self.ttl,))
+            db.execute('DELETE FROM results WHERE key IN (SELECT key FROM results '
+                       'ORDER BY accessed DESC LIMIT -1 OFFSET ?)', (self.max_entries,))
+
+    def call(self, key, fn, bypass=False):
+        """Return fn()'s output for key, running fn only if no result is stored.
+
+        With bypass the stored result is ignored and replaced by a fresh one.
+        Concurrent calls with the same key share one run of fn.
+        """
+        with self._lock:
+            future = self._in_flight.get(key)
+            if future is not None:
+                self.shared += 1
+                owner = False
+            else:
+                future = self._in_flight[key] = Future()
+                owner = True
+        if not owner:
+            return future.result()
+
+        try:
+            output = None if bypass else self.get(key)
+            if output is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+                output = fn()
+                self.put(key, output)
+            future.set_result(output)
+            return output
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+
+    def stats(self):
+        with self._connect() as db:
+            entries = db.execute('SELECT COUNT(*) FROM results').fetchone()[0]
+        return {'hits': self.hits, 'misses': self.misses, 'shared': self.shared, 'entries': entries}
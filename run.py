@@ -1,38 +1,87 @@
-import cv2
-import numpy as np
-import urllib.request
+import importlib
 import json
-import tkinter as tk
-from tkinter import ttk, scrolledtext
-from PIL import Image, ImageTk
-import threading
-from io import StringIO
-from flask import Flask, render_template_string, jsonify, request, send_file
-import webbrowser
+import re
+import contextlib
+from flask import Blueprint, Flask, Response, render_template_string, jsonify, request, send_file, send_from_directory, after_this_request, redirect
 import socket
 import sys
 import base64
-import replicate
-import asyncio
 from dotenv import load_dotenv
 import os
 import tempfile
-import requests
-from google.cloud import storage
+import shutil
 import uuid
 
-# Load environment variables from .env file
-load_dotenv()
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+import chunking
+import proxy
+import temporal
+from pipeline import MaskLayer, composite_video, mask_layers
+from compositing import LAYER_POLICIES
+from media import frame_count, video_fps
+from temporal import frame_interval
+from downloads import cached_video, video_inputs
+from proxy import make_proxy, scale_coordinates
+from chunking import chunk_length, predict_chunks, split_video
+from mask_archive import acquire_mask_archives, release_mask_archive
+from preview import read_frame
+from jobs import JobManager, make_job_store
+from result_cache import ResultCache, inference_key
+from file_cache import FileCache
+import metrics
+from state import encode_preview, make_state_store
+from object_storage import get_storage
+from segmented import HLSWriter
 
-# Configure Replicate API token
-os.environ["REPLICATE_API_TOKEN"] = os.getenv("REPLICATE_API_TOKEN")
+OUTPUT_MODES = ('mp4', 'hls')
 
-# Configure GCP credentials
-GCP_CREDENTIALS_PATH = os.getenv("GCP_CREDENTIALS_PATH", "key.json")
-os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = GCP_CREDENTIALS_PATH
+def configure():
+    """Read the settings of the server and its jobs from the environment."""
+    global OUTPUT_MODE, OUTPUT_DIR, RENDER_CACHE_DIR, RENDER_CACHE_MAX_BYTES, RENDER_FEATHER
+    global SAM2_PER_OBJECT_MASKS
+    # Output format of composited videos: mp4, uploaded once finished, or hls,
+    # whose segments are uploaded while later frames are still being composited
+    OUTPUT_MODE = os.getenv("OUTPUT_MODE", "mp4")
 
-# GCP bucket name
-BUCKET_NAME = os.getenv("GCP_BUCKET_NAME")
+    # Composited videos are written here and served on /output/<name>. Relative
+    # to the app's directory, so processes started from anywhere share it
+    OUTPUT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.getenv("OUTPUT_DIR", "output"))
+
+    # Finished jobs re-composited over other backgrounds are kept on disk, one
+    # file per job and background, evicted least recently used beyond the budget.
+    # Relative to the app's directory, so processes started from anywhere share it
+    RENDER_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                    os.getenv("RENDER_CACHE_DIR", os.path.join("cache", "renders")))
+    RENDER_CACHE_MAX_BYTES = int(os.getenv("RENDER_CACHE_MAX_BYTES", str(2 * 1024 ** 3)))
+    # Width in pixels of the soft edge around re-composited subjects
+    RENDER_FEATHER = int(os.getenv("RENDER_FEATHER", "2"))
+
+    # Whether the model returns a mask video per object, so objects can have
+    # different policies; meta/sam-2-video returns one mask for all of them
+    SAM2_PER_OBJECT_MASKS = os.getenv("SAM2_PER_OBJECT_MASKS", "0") == "1"
+
+configure()
+
+# The .env file of the app, read by load_settings() wherever the app is started from
+ENV_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.env')
+
+# Modules whose settings load_settings() reads again
+SETTINGS_MODULES = ('chunking', 'compositing', 'downloads', 'encoders', 'jobs', 'mask_archive',
+                    'object_storage', 'pipeline', 'preview', 'proxy', 'result_cache', 'segmented',
+                    'state', 'temporal')
+
+def load_settings():
+    """Load .env into the environment, then read every module's settings again.
+
+    Modules read their settings when they are imported, which under a WSGI
+    server happens before anything could load .env. Variables already set
+    in the environment take precedence over .env.
+    """
+    load_dotenv(ENV_PATH)
+    for name in SETTINGS_MODULES:
+        importlib.import_module(name).configure()
+    configure()
 
 def upload_to_gcp(local_file_path, destination_blob_name=None):
     """Uploads a file to GCP bucket."""
@@ -44,23 +93,18 @@ def upload_to_gcp(local_file_path, destination_blob_name=None):
 
         print(f"Uploading to GCP bucket: {destination_blob_name}")
 
-        # Initialize GCP storage client
-        storage_client = storage.Client()
-        bucket = storage_client.bucket(BUCKET_NAME)
-        blob = bucket.blob(destination_blob_name)
-        generation_match_precondition = 0
-        # Upload the file
-        blob.upload_from_filename(local_file_path, if_generation_match=generation_match_precondition)
-
-        # Get the public URL
-        public_url = f"https://storage.googleapis.com/{BUCKET_NAME}/{destination_blob_name}"
-        return public_url
+        # Upload the file through the shared storage backend and get the public URL
+        with metrics.stage('upload'):
+            url = get_storage().upload(local_file_path, destination_blob_name, content_type='video/mp4')
+        metrics.STAGE_BYTES.observe(os.path.getsize(local_file_path), stage='upload')
+        return url
 
     except Exception as e:
         print(f"Error uploading to GCP: {str(e)}")
         return None
 
-app = Flask(__name__)
+# Routes of the web interface, registered on the app built by create_app()
+routes = Blueprint('segmentation', __name__)
 
 # HTML template for the web interface
 HTML_TEMPLATE = '''
@@ -167,6 +211,16 @@ HTML_TEMPLATE = '''
             <button onclick="doneWithCurrent()">Done with Current Video</button>
             <button onclick="clearPoints()">Clear Points</button>
         </div>
+        <div class="button-group">
+            <button onclick="newObject()">New Object</button>
+            Object <span id="currentObject">1</span>:
+            <select id="objectPolicy" onchange="setPolicy()">
+                <option value="keep">Keep</option>
+                <option value="replace">Replace with background</option>
+            </select>
+            {% if not per_object_masks %}<span>(applies to every object)</span>{% endif %}
+            <span>(Shift+click adds a negative point)</span>
+        </div>
         <div class="coordinates-display">
             <div class="coordinates-title">Selected Points (Original Image Coordinates):</div>
             <div id="coordsList"></div>
@@ -181,8 +235,15 @@ HTML_TEMPLATE = '''
 
     <script>
         let videoUrls = [];
-        let coordinates = [];
+        // Each point is {x, y, label, object}: label 1 marks the object, 0 excludes the spot
+        let points = [];
+        let currentObject = 1;
+        let objectPolicies = {};
+        // Unless the model returns a mask per object, one mask covers them all
+        // and they share its policy
+        const perObjectPolicies = {{ 'true' if per_object_masks else 'false' }};
         let currentVideoIdx = -1;
+        const objectColors = ['red', 'blue', 'orange', 'purple', 'teal', 'brown'];
         
         function setStatus(message) {
             document.getElementById('status').textContent = message;
@@ -198,12 +259,42 @@ HTML_TEMPLATE = '''
             }
         }
         
+        function resetObjects() {
+            points = [];
+            currentObject = 1;
+            objectPolicies = {'mask_1': 'keep'};
+            document.getElementById('currentObject').textContent = currentObject;
+            document.getElementById('objectPolicy').value = 'keep';
+        }
+        
         function clearPoints() {
-            coordinates = [];
+            resetObjects();
             drawPoints();
+            updateCoordinatesDisplay();
             setStatus('Cleared all points');
         }
         
+        function newObject() {
+            currentObject++;
+            const policy = perObjectPolicies ? 'keep' : document.getElementById('objectPolicy').value;
+            objectPolicies[`mask_${currentObject}`] = policy;
+            document.getElementById('currentObject').textContent = currentObject;
+            document.getElementById('objectPolicy').value = policy;
+            setStatus(`Now annotating object ${currentObject}`);
+        }
+        
+        function setPolicy() {
+            const policy = document.getElementById('objectPolicy').value;
+            if (perObjectPolicies) {
+                objectPolicies[`mask_${currentObject}`] = policy;
+            } else {
+                for (const object in objectPolicies) {
+                    objectPolicies[object] = policy;
+                }
+            }
+            updateCoordinatesDisplay();
+        }
+        
         async function startProcessing() {
             if (videoUrls.length === 0) {
                 setStatus('Please add some video URLs first');
@@ -260,18 +351,22 @@ HTML_TEMPLATE = '''
                     const ctx = canvas.getContext('2d');
                     ctx.drawImage(img, 0, 0, canvas.width, canvas.height);
                     
-                    // Store original dimensions and scale for coordinate conversion
-                    canvas.dataset.originalWidth = img.naturalWidth;
-                    canvas.dataset.originalHeight = img.naturalHeight;
+                    // Store original dimensions and scale for coordinate conversion.
+                    // The preview may be smaller than the original video.
+                    const originalWidth = data.width || img.naturalWidth;
+                    const originalHeight = data.height || img.naturalHeight;
+                    canvas.dataset.originalWidth = originalWidth;
+                    canvas.dataset.originalHeight = originalHeight;
                     canvas.dataset.scale = scale;
+                    canvas.dataset.previewScale = img.naturalWidth / originalWidth;
                     
                     // Display image dimensions
-                    setStatus(`Image loaded - Original dimensions: ${img.naturalWidth}x${img.naturalHeight}px, Scale: ${scale.toFixed(3)}`);
+                    setStatus(`Image loaded - Original dimensions: ${originalWidth}x${originalHeight}px, Scale: ${scale.toFixed(3)}`);
                     updateCoordinatesDisplay();
                 };
                 img.src = data.frame;
                 
-                coordinates = [];
+                resetObjects();
                 drawPoints();
                 
             } catch (error) {
@@ -283,6 +378,7 @@ HTML_TEMPLATE = '''
             const canvas = document.getElementById('imageCanvas');
             const ctx = canvas.getContext('2d');
             const scale = parseFloat(canvas.dataset.scale);
+            const previewScale = parseFloat(canvas.dataset.previewScale || '1');
             
             // Clear and redraw image
             const img = new Image();
@@ -290,29 +386,37 @@ HTML_TEMPLATE = '''
                 ctx.drawImage(img, 0, 0, canvas.width, canvas.height);
                 
                 // Draw points
-                coordinates.forEach((point, index) => {
-                    const displayX = point[0] * scale;
-                    const displayY = point[1] * scale;
+                points.forEach((point, index) => {
+                    // Points are in original video pixels, the canvas in preview pixels
+                    const x = point.x * previewScale;
+                    const y = point.y * previewScale;
+                    const objectNumber = parseInt(point.object.split('_')[1]);
+                    const color = objectColors[(objectNumber - 1) % objectColors.length];
                     
+                    // Negative points are drawn hollow
                     ctx.beginPath();
-                    ctx.arc(point[0], point[1], 5, 0, 2 * Math.PI);
-                    ctx.fillStyle = 'red';
-                    ctx.fill();
+                    ctx.arc(x, y, 5, 0, 2 * Math.PI);
+                    ctx.strokeStyle = color;
+                    ctx.lineWidth = 2;
+                    if (point.label) {
+                        ctx.fillStyle = color;
+                        ctx.fill();
+                    } else {
+                        ctx.stroke();
+                    }
                     
                     ctx.fillStyle = 'white';
-                    ctx.strokeStyle = 'red';
-                    ctx.lineWidth = 2;
                     ctx.font = '16px Arial';
-                    const text = (index + 1).toString();
+                    const text = `${index + 1}${point.label ? '+' : '-'}`;
                     const textWidth = ctx.measureText(text).width;
                     
                     // Draw text background
-                    ctx.fillStyle = 'red';
-                    ctx.fillRect(point[0] + 10, point[1] - 8, textWidth + 4, 16);
+                    ctx.fillStyle = color;
+                    ctx.fillRect(x + 10, y - 8, textWidth + 4, 16);
                     
                     // Draw text
                     ctx.fillStyle = 'white';
-                    ctx.fillText(text, point[0] + 12, point[1] + 4);
+                    ctx.fillText(text, x + 12, y + 4);
                 });
             };
             img.src = document.getElementById('imageCanvas').toDataURL();
@@ -320,8 +424,10 @@ HTML_TEMPLATE = '''
         
         function updateCoordinatesDisplay() {
             const coordsList = document.getElementById('coordsList');
-            coordsList.innerHTML = coordinates.map((coord, index) => {
-                return `Point ${index + 1}: (${coord[0]}, ${coord[1]})`;
+            coordsList.innerHTML = points.map((point, index) => {
+                const kind = point.label ? 'positive' : 'negative';
+                return `Point ${index + 1}: (${point.x}, ${point.y}) ${kind}, ` +
+                    `object ${point.object.split('_')[1]} (${objectPolicies[point.object]})`;
             }).join('<br>');
         }
         
@@ -335,28 +441,32 @@ HTML_TEMPLATE = '''
             
             // Convert to original image coordinates
             const scale = parseFloat(canvas.dataset.scale);
-            const x = Math.round(displayX / scale);
-            const y = Math.round(displayY / scale);
+            const previewScale = parseFloat(canvas.dataset.previewScale || '1');
+            const x = Math.round(displayX / scale / previewScale);
+            const y = Math.round(displayY / scale / previewScale);
             
-            coordinates.push([x, y]);
+            const label = event.shiftKey ? 0 : 1;
+            points.push({x: x, y: y, label: label, object: `mask_${currentObject}`});
             drawPoints();
             updateCoordinatesDisplay();
-            setStatus(`Added point at original coordinates: (${x}, ${y})`);
+            setStatus(`Added ${label ? 'positive' : 'negative'} point for object ${currentObject} at original coordinates: (${x}, ${y})`);
         });
         
         async function doneWithCurrent() {
             if (currentVideoIdx < 0) return;
             
+            const videoIdx = currentVideoIdx;
             try {
-                setStatus('Processing annotations and running AI model...');
+                setStatus('Submitting annotations...');
                 const response = await fetch('/save_annotations', {
                     method: 'POST',
                     headers: {
                         'Content-Type': 'application/json',
                     },
                     body: JSON.stringify({
-                        url: videoUrls[currentVideoIdx],
-                        coordinates: coordinates
+                        url: videoUrls[videoIdx],
+                        points: points,
+                        objects: objectPolicies
                     })
                 });
                 
@@ -366,149 +476,177 @@ HTML_TEMPLATE = '''
                     return;
                 }
                 
-                // Display the result URL in the results textarea
-                if (data.output) {
-                    document.getElementById('results').value += `\nProcessed Video ${currentVideoIdx + 1}:\n${data.output}\n`;
-                    
-                    // Add buttons container
-                    const buttonContainer = document.getElementById('downloadButtons');
-                    
-                    // Button to view original result
-                    const viewButton = document.createElement('button');
-                    viewButton.className = 'download-button';
-                    const videoName = videoUrls[currentVideoIdx].split('/').pop();
-                    viewButton.textContent = `${videoName}: View Original`;
-                    viewButton.onclick = function() {
-                        window.open(data.output, '_blank');
-                        setStatus(`Opening original result for ${videoName} in new tab`);
-                    };
-                    
-                    // Button to download green screen version
-                    const downloadButton = document.createElement('button');
-                    downloadButton.className = 'download-button';
-                    downloadButton.textContent = `${videoName}: Download Green Screen Version`;
-                    downloadButton.onclick = function() {
-                        setStatus(`Processing and downloading green screen version for ${videoName}...`);
-                        window.location.href = `/process_and_download/${data.video_id}`;
-                    };
-                    
-                    buttonContainer.appendChild(viewButton);
-                    buttonContainer.appendChild(downloadButton);
-                }
-                
-                setStatus('Processing complete. Moving to next video...');
+                // The job runs in the background while the next video is annotated
+                watchJob(data.job_id, videoIdx);
+                setStatus('Annotations submitted. Moving to next video...');
                 await processNextVideo();
                 
             } catch (error) {
                 setStatus(`Error: ${error.message}`);
             }
         }
+        
+        async function watchJob(jobId, videoIdx) {
+            const videoName = videoUrls[videoIdx].split('/').pop();
+            const results = document.getElementById('results');
+            let lastStatus = null;
+            let streamShown = false;
+            
+            while (true) {
+                await new Promise(resolve => setTimeout(resolve, 2000));
+                let job;
+                try {
+                    const response = await fetch(`/jobs/${jobId}`);
+                    job = await response.json();
+                } catch (error) {
+                    continue;
+                }
+                if (job.error && !job.status) {
+                    results.value += `\nVideo ${videoIdx + 1} (${videoName}): ${job.error}\n`;
+                    return;
+                }
+                if (job.status !== lastStatus) {
+                    lastStatus = job.status;
+                    results.value += `Video ${videoIdx + 1} (${videoName}): ${job.status}\n`;
+                    if (job.status === 'uploading' && job.result.output_url) {
+                        results.value += `Composited, available at ${window.location.origin}${job.result.output_url}\n`;
+                    }
+                }
+                if (job.result && job.result.manifest_url && !streamShown) {
+                    streamShown = true;
+                    results.value += `Stream available at ${job.result.manifest_url}\n`;
+                }
+                if (job.status === 'failed') {
+                    results.value += `Error: ${job.error}\n`;
+                    return;
+                }
+                if (job.status === 'done') {
+                    showJobResult(job.result, videoIdx, job.job_id);
+                    return;
+                }
+            }
+        }
+        
+        function showJobResult(result, videoIdx, jobId) {
+            const videoName = videoUrls[videoIdx].split('/').pop();
+            document.getElementById('results').value += `\nProcessed Video ${videoIdx + 1}:\n${result.greenscreen_url || result.mask_url}\n`;
+            
+            // Add buttons container
+            const buttonContainer = document.getElementById('downloadButtons');
+            
+            // Button to view original result
+            const viewButton = document.createElement('button');
+            viewButton.className = 'download-button';
+            viewButton.textContent = `${videoName}: View Original`;
+            viewButton.onclick = function() {
+                window.open(result.mask_url, '_blank');
+                setStatus(`Opening original result for ${videoName} in new tab`);
+            };
+            buttonContainer.appendChild(viewButton);
+            
+            // Button to download green screen version
+            const downloadButton = document.createElement('button');
+            downloadButton.className = 'download-button';
+            downloadButton.textContent = `${videoName}: Download Green Screen Version`;
+            downloadButton.onclick = function() {
+                if (result.greenscreen_url) {
+                    window.open(result.greenscreen_url, '_blank');
+                    setStatus(`Opening green screen version for ${videoName} in new tab`);
+                } else {
+                    setStatus(`Processing and downloading green screen version for ${videoName}...`);
+                    window.location.href = `/process_and_download/${result.video_id}`;
+                }
+            };
+            buttonContainer.appendChild(downloadButton);
+
+            // Re-composite over another color from the cached masks
+            const backgroundInput = document.createElement('input');
+            backgroundInput.type = 'color';
+            backgroundInput.value = '#00ff00';
+            const renderButton = document.createElement('button');
+            renderButton.className = 'download-button';
+            renderButton.textContent = `${videoName}: Download With Background`;
+            renderButton.onclick = function() {
+                setStatus(`Rendering ${videoName} over ${backgroundInput.value}...`);
+                window.location.href = `/jobs/${jobId}/render?background=${encodeURIComponent(backgroundInput.value)}`;
+            };
+            buttonContainer.appendChild(backgroundInput);
+            buttonContainer.appendChild(renderButton);
+        }
     </script>
 </body>
 </html>
 '''
 
-# Store video frames and annotations
-video_frames = {}
-video_annotations = {}
+# Video preview frames and annotations, bounded in size and age; set up by create_app()
+state = None
 
-@app.route('/')
+@routes.route('/')
 def home():
-    return render_template_string(HTML_TEMPLATE)
+    return render_template_string(HTML_TEMPLATE, per_object_masks=SAM2_PER_OBJECT_MASKS)
 
-@app.route('/process_video', methods=['POST'])
+@routes.route('/process_video', methods=['POST'])
 def process_video():
     try:
         data = request.get_json()
         url = data['url']
         
-        # Download and process video
-        video_path = download_video(url)
-        cap = cv2.VideoCapture(video_path)
-        ret, frame = cap.read()
-        cap.release()
+        # Reuse the stored preview if this video was opened before
+        preview = state.get('frames', url)
+        frame_info = state.get_json('frame_info', url)
         
-        if not ret:
-            return jsonify({'error': 'Failed to read video frame'})
+        if preview is None or frame_info is None:
+            # Decode the first frame, fetching only as much of the video as needed
+            frame = read_frame(url)
+            
+            if frame is None:
+                return jsonify({'error': 'Failed to read video frame'})
+            
+            # Store the frame as a scaled-down JPEG, with the original size
+            # so clicks can be mapped back to original pixels
+            preview = encode_preview(frame)
+            frame_info = {'width': frame.shape[1], 'height': frame.shape[0]}
+            state.set('frames', url, preview)
+            state.set_json('frame_info', url, frame_info)
         
         # Convert frame to base64
-        _, buffer = cv2.imencode('.jpg', frame)
-        frame_b64 = base64.b64encode(buffer).decode('utf-8')
-        
-        # Store frame for later use
-        video_frames[url] = frame
+        frame_b64 = base64.b64encode(preview).decode('utf-8')
         
         return jsonify({
-            'frame': f'data:image/jpeg;base64,{frame_b64}'
+            'frame': f'data:image/jpeg;base64,{frame_b64}',
+            'width': frame_info['width'],
+            'height': frame_info['height']
         })
         
     except Exception as e:
         return jsonify({'error': str(e)})
 
-def process_video_with_green_screen(video_url):
-    # Create temp files for processing
-    temp_input = tempfile.NamedTemporaryFile(suffix='.mp4', delete=False).name
+def process_video_with_green_screen(video_url, background=None):
+    # Create temp file for the output, which the caller removes once sent
     temp_output = tempfile.NamedTemporaryFile(suffix='.mp4', delete=False).name
     
     try:
-        # Download the video
-        response = requests.get(video_url)
-        with open(temp_input, 'wb') as f:
-            f.write(response.content)
-        
-        # Open the video
-        cap = cv2.VideoCapture(temp_input)
-        
-        # Get video properties
-        width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-        height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-        fps = int(cap.get(cv2.CAP_PROP_FPS))
-        
-        # Create VideoWriter object
-        fourcc = cv2.VideoWriter_fourcc(*'mp4v')
-        out = cv2.VideoWriter(temp_output, fourcc, fps, (width, height))
-        
-        # Green screen color (RGB)
-        green_color = [0, 255, 0]  # Green in BGR
-        
-        while cap.isOpened():
-            ret, frame = cap.read()
-            if not ret:
-                break
-            
-            # Convert frame to grayscale for mask detection
-            gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-            
-            # Create mask where black pixels (background) are found
-            # Threshold value of 10 to account for compression artifacts
-            mask = gray < 10
-            
-            # Create output frame
-            output_frame = frame.copy()
-            
-            # Replace black pixels with green
-            output_frame[mask] = green_color
-            
-            # Write the frame
-            out.write(output_frame)
-        
-        # Release everything
-        cap.release()
-        out.release()
+        # The downloaded input is removed when the block exits
+        with metrics.stage('process_video_with_green_screen'), video_inputs(video_url) as (source,):
+            # The SAM2 output video is its own mask: black pixels are background
+            composite_video(source, None, temp_output, background)
         
         return temp_output
         
     except Exception as e:
         print(f"Error processing video: {str(e)}")
-        if os.path.exists(temp_input):
-            os.unlink(temp_input)
         if os.path.exists(temp_output):
             os.unlink(temp_output)
         return None
 
-@app.route('/process_and_download/<video_id>')
+@routes.route('/process_and_download/<video_id>')
 def process_and_download(video_id):
     try:
+        # Jobs of this server have their masks cached, render from those
+        for job in job_manager.list():
+            if job.result.get('video_id') == video_id and job.result.get('layers'):
+                return redirect(f'/jobs/{job.id}/render')
+
         # Get the original video URL from stored data
         video_url = f"https://replicate.delivery/xezq/{video_id}/output_video.mp4"
         
@@ -516,6 +654,15 @@ def process_and_download(video_id):
         processed_video_path = process_video_with_green_screen(video_url)
         
         if processed_video_path:
+            @after_this_request
+            def remove_processed_video(response):
+                # send_file already holds the file open
+                try:
+                    os.unlink(processed_video_path)
+                except OSError:
+                    pass
+                return response
+
             return send_file(
                 processed_video_path,
                 as_attachment=True,
@@ -528,176 +675,519 @@ def process_and_download(video_id):
     except Exception as e:
         return jsonify({'error': str(e)})
 
-def process_video_with_mask(original_url, mask_url):
-    # Create output directory if it doesn't exist
-    output_dir = "output"
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
+def composite_with_mask(original_url, mask_url, background=None, output_mode=None, on_manifest=None,
+                        mask_interval=1, feather=None):
+    """Composite the original video over a background using the SAM2 mask video.
 
-    # Create temp files for processing
-    temp_original = tempfile.NamedTemporaryFile(suffix='.mp4', delete=False).name
-    temp_mask = tempfile.NamedTemporaryFile(suffix='.mp4', delete=False).name
-    
-    # Create a unique filename for local storage
-    local_filename = f'greenscreen_{uuid.uuid4()}.mp4'
-    output_path = os.path.join(output_dir, local_filename)
+    mask_url is a mask video URL, or a list of MaskLayer with one mask video
+    URL and keep/replace policy per object. A layer of a chunked prediction
+    has a list of mask video URLs, one per chunk, which are joined first.
 
-    try:
-        # Download both videos
-        print("Downloading original video...")
-        response = requests.get(original_url)
-        with open(temp_original, 'wb') as f:
-            f.write(response.content)
-
-        print("Downloading mask video...")
-        response = requests.get(mask_url)
-        with open(temp_mask, 'wb') as f:
-            f.write(response.content)
-
-        # Open both videos
-        cap_original = cv2.VideoCapture(temp_original)
-        cap_mask = cv2.VideoCapture(temp_mask)
-
-        # Get video properties from original video
-        width = int(cap_original.get(cv2.CAP_PROP_FRAME_WIDTH))
-        height = int(cap_original.get(cv2.CAP_PROP_FRAME_HEIGHT))
-        fps = int(cap_original.get(cv2.CAP_PROP_FPS))
-
-        # Create VideoWriter object
-        fourcc = cv2.VideoWriter_fourcc(*'mp4v')
-        out = cv2.VideoWriter(output_path, fourcc, fps, (width, height))
-
-        # Green screen color (BGR)
-        green_color = [0, 255, 0]
-
-        while True:
-            ret_original, frame_original = cap_original.read()
-            ret_mask, frame_mask = cap_mask.read()
-
-            if not ret_original or not ret_mask:
-                break
-
-            # Convert mask frame to grayscale
-            mask_gray = cv2.cvtColor(frame_mask, cv2.COLOR_BGR2GRAY)
-            
-            # Create binary mask where black pixels are found
-            # Threshold value of 10 to account for compression artifacts
-            mask = mask_gray < 10
+    With the 'mp4' output mode, returns the path of the output video in the
+    output directory. With 'hls', returns the directory of the HLS segments,
+    which are uploaded while compositing runs; on_manifest(url) is called
+    once the playlist is online. mask_interval is the number of original
+    frames per mask frame, and feather the width of the soft edge around
+    the subject.
+    """
+    output_mode = output_mode or OUTPUT_MODE
 
-            # Create output frame
-            output_frame = frame_original.copy()
-            
-            # Replace masked pixels with green
-            output_frame[mask] = green_color
+    # Create output directory if it doesn't exist
+    output_dir = OUTPUT_DIR
+    os.makedirs(output_dir, exist_ok=True)
 
-            # Write the frame
-            out.write(output_frame)
+    options = {'mask_interval': mask_interval, 'feather': feather}
+    if output_mode == 'hls':
+        output_path = os.path.join(output_dir, f'greenscreen_{uuid.uuid4()}')
+        # Segments are uploaded in order from a single writer, so no segment mode
+        options['parallel'] = False
+        options['writer_factory'] = lambda path, fps, width, height, audio_source=None: HLSWriter(
+            path, fps, width, height, prefix=os.path.basename(path), on_manifest=on_manifest,
+            audio_source=audio_source)
+    elif output_mode == 'mp4':
+        # Create a unique filename for local storage
+        local_filename = f'greenscreen_{uuid.uuid4()}.mp4'
+        output_path = os.path.join(output_dir, local_filename)
+    else:
+        raise ValueError(f"Unknown output mode: {output_mode}")
+
+    # Masks are read from local archives, converted from the mask videos the
+    # first time; this happens while the original downloads. A layer of a
+    # chunked prediction has its chunks joined into one archive.
+    print("Downloading original and mask videos...")
+    layers = mask_layers(mask_url)
+    chunk_urls = [layer.path if isinstance(layer.path, list) else [layer.path] for layer in layers]
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        archives = executor.submit(acquire_mask_archives, chunk_urls)
+        try:
+            with video_inputs(original_url) as (original_source,):
+                mask_source = [MaskLayer(path, layer.policy)
+                               for path, layer in zip(archives.result(), layers)]
+                # Decode the original once and composite every mask layer on
+                # a staged pipeline, keeping the soundtrack of the original
+                composite_video(original_source, mask_source, output_path, background,
+                                audio_source=original_source, **options)
+        finally:
+            if archives.exception() is None:
+                for path in archives.result():
+                    release_mask_archive(path)
 
-        # Release everything
-        cap_original.release()
-        cap_mask.release()
-        out.release()
+    return output_path
 
-        # Upload to GCP bucket
-        print("Uploading to GCP bucket...")
-        gcp_url = upload_to_gcp(output_path, local_filename)
+def process_video_with_mask(original_url, mask_url, background=None):
+    """Composite and upload; mask_url can be a list of MaskLayer as in composite_with_mask."""
+    try:
+        with metrics.stage('process_video_with_mask'):
+            output_path = composite_with_mask(original_url, mask_url, background, output_mode='mp4')
+
+            # Upload to GCP bucket
+            print("Uploading to GCP bucket...")
+            gcp_url = upload_to_gcp(output_path, os.path.basename(output_path))
         
         if gcp_url:
             print(f"Video uploaded successfully: {gcp_url}")
-            return {
-                'local_path': output_path,
-                'gcp_url': gcp_url
-            }
         else:
             print("Failed to upload to GCP bucket")
-            return {
-                'local_path': output_path,
-                'gcp_url': None
-            }
+        return {
+            'local_path': output_path,
+            'gcp_url': gcp_url
+        }
 
     except Exception as e:
         print(f"Error processing video with mask: {str(e)}")
-        if os.path.exists(temp_original):
-            os.unlink(temp_original)
-        if os.path.exists(temp_mask):
-            os.unlink(temp_mask)
         return None
 
-@app.route('/save_annotations', methods=['POST'])
+SAM2_MODEL = "meta/sam-2-video:33432afdfc06a10da6b4018932893d39b0159f838b6d11dd1236dff85cc5ec1d"
+
+def run_replicate(model, input):
+    """replicate.run, with the client imported on first use since it is slow to import."""
+    import replicate
+    return replicate.run(model, input=input)
+
+# Runs SAM2 predictions. Replace with a stand-in such as fakes.FakePredictor
+# to run the pipeline offline.
+predictor = run_replicate
+
+# Memoized SAM2 results, keyed by model version and input; set up by create_app()
+result_cache = None
+
+# Re-composited variants of finished jobs; set up by create_app()
+render_cache = None
+
+def format_coordinates(coordinates):
+    return ','.join([f"[{x},{y}]" for x, y in coordinates])
+
+def build_sam2_input(url, coordinates, frame_interval=1, mask_fps=25, labels=None, object_ids=None,
+                     frames=None):
+    """Build the SAM2 video model input for clicks.
+
+    labels holds 1 for positive and 0 for negative clicks, object_ids the
+    object each click belongs to and frames the frame it was made on; by
+    default every click is a positive click on one object in the first
+    frame. The model outputs a mask for every frame_interval-th frame,
+    played back at mask_fps.
+    """
+    labels = labels or [1] * len(coordinates)
+    frames = frames or [0] * len(coordinates)
+    return {
+        "mask_type": "binary",
+        "video_fps": mask_fps,
+        "input_video": url,
+        "click_frames": ','.join(str(int(frame)) for frame in frames),
+        "click_labels": ','.join(str(int(label)) for label in labels),
+        "output_video": True,
+        "output_format": "webp",
+        "output_quality": 100,
+        "annotation_type": "mask",
+        "click_object_ids": ','.join(object_ids) if object_ids else "mask_1",
+        "click_coordinates": format_coordinates(coordinates),
+        "output_frame_interval": frame_interval
+    }
+
+def parse_points(data):
+    """Return the coordinates, labels, object ids and frames of the clicks in an annotation request.
+
+    Clicks come as 'points' ({x, y, label, object, frame}, label 1 for
+    positive and 0 for negative clicks) or, from older clients, as
+    'coordinates' of positive clicks on a single object. Clicks without a
+    frame are on data['frame'], the first frame by default.
+    """
+    frame = int(data.get('frame') or 0)
+    if 'points' not in data:
+        coordinates = data['coordinates']
+        return coordinates, None, None, [frame] * len(coordinates)
+    points = data['points']
+    coordinates = [[int(point['x']), int(point['y'])] for point in points]
+    labels = [1 if int(point.get('label', 1)) else 0 for point in points]
+    object_ids = [str(point.get('object', 'mask_1')) for point in points]
+    frames = [int(point.get('frame', frame)) for point in points]
+    return coordinates, labels, object_ids, frames
+
+def output_layers(output, objects, policies):
+    """Pair the prediction output with the annotated objects and their policies.
+
+    If the model returned one mask per object, each becomes its own layer.
+    Otherwise the last output holds all objects, which then need to share a policy.
+    """
+    if len(objects) > 1 and len(output) == len(objects):
+        return [{'object': obj, 'mask_url': url, 'policy': policies.get(obj, 'keep')}
+                for obj, url in zip(objects, output)]
+    shared = {policies.get(obj, 'keep') for obj in objects}
+    if len(shared) > 1:
+        raise ValueError('The model returned a single mask for all objects, '
+                         'so they cannot have different policies')
+    return [{'object': ','.join(objects), 'mask_url': output[-1], 'policy': shared.pop()}]
+
+def replicate_video_id(mask_url):
+    """Return the id in a replicate.delivery/xezq/<id>/output_video.mp4 URL."""
+    parts = urlparse(mask_url).path.strip('/').split('/')
+    return parts[-2] if len(parts) >= 2 else None
+
+def predict_sam2(sam2_input):
+    print("\nMaking API call to Replicate...")
+    with metrics.stage('inference'):
+        return [str(item) for item in predictor(SAM2_MODEL, input=sam2_input)]
+
+def predict_sam2_local(sam2_input, coordinates):
+    """Run SAM2 on local copies of the input video and return one output per chunk.
+
+    The video is scaled down to PROXY_MAX_DIM and, if it has at least
+    CHUNK_MIN_FRAMES frames, split into chunks that are predicted
+    concurrently. Each copy is uploaded to storage for the model to fetch,
+    with the clicks mapped into its pixel space and carried to its first
+    frame, and deleted once its prediction finishes. Videos that need
+    neither are sent as they are.
+    """
+    directory = tempfile.mkdtemp(prefix='inference_')
+    try:
+        # The original is kept in the video cache for compositing afterwards
+        with cached_video(sam2_input['input_video']) as source:
+            video_path = source
+            proxy_path = os.path.join(directory, 'proxy.mp4')
+            sizes = make_proxy(source, proxy_path) if proxy.PROXY_MAX_DIM else None
+            if sizes is not None:
+                original_size, size = sizes
+                print(f"Running SAM2 on a {size[0]}x{size[1]} proxy of the {original_size[0]}x{original_size[1]} video")
+                video_path = proxy_path
+                coordinates = scale_coordinates(coordinates, original_size, size)
+
+            # Clicks are carried into chunks from the first frame only
+            on_first_frame = set(sam2_input['click_frames'].split(',')) == {'0'}
+            if chunking.CHUNK_MIN_FRAMES and on_first_frame and frame_count(video_path) >= chunking.CHUNK_MIN_FRAMES:
+                chunk_frames = chunk_length(chunking.CHUNK_FRAMES, sam2_input['output_frame_interval'])
+                chunks = split_video(video_path, directory, chunk_frames, coordinates)
+                print(f"Running SAM2 on {len(chunks)} chunks of {chunk_frames} frames")
+            elif sizes is not None:
+                chunks = [(proxy_path, coordinates)]
+            else:
+                return [predict_sam2(sam2_input)]
+
+        def predict_chunk(path, points):
+            storage = get_storage()
+            name = f'sam2_input_{uuid.uuid4()}.mp4'
+            url = storage.upload(path, name, content_type='video/mp4')
+            # A proxy keeps the clicks on their frames, chunks have them on their first
+            click_frames = sam2_input['click_frames'] if path == proxy_path else ','.join(['0'] * len(points))
+            try:
+                return predict_sam2(dict(
+                    sam2_input,
+                    input_video=url,
+                    click_frames=click_frames,
+                    click_coordinates=format_coordinates(points)
+                ))
+            finally:
+                # The model has read it; only its output is kept
+                try:
+                    storage.delete(name)
+                except Exception as e:
+                    print(f"Error deleting {name}: {e}")
+
+        return predict_chunks(chunks, predict_chunk)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+def run_inference(job):
+    sam2_input = job.input['sam2_input']
+    target_fps = job.input.get('target_fps')
+    if target_fps:
+        # Ask for masks at about target_fps, the frames in between are filled in locally
+        source_fps = video_fps(job.input['url'])
+        interval = frame_interval(source_fps, target_fps)
+        sam2_input = dict(sam2_input, output_frame_interval=interval,
+                          video_fps=max(1, round(source_fps / interval)))
+    job.result['frame_interval'] = sam2_input['output_frame_interval']
+
+    local_options = {}
+    if proxy.PROXY_MAX_DIM:
+        local_options['proxy_max_dim'] = proxy.PROXY_MAX_DIM
+    if chunking.CHUNK_MIN_FRAMES:
+        local_options.update(chunk_min_frames=chunking.CHUNK_MIN_FRAMES, chunk_frames=chunking.CHUNK_FRAMES)
+    if local_options:
+        # Local copies get a new URL every time, so key on the original input
+        key = inference_key(SAM2_MODEL, dict(sam2_input, **local_options))
+        predict = lambda: predict_sam2_local(sam2_input, job.input['coordinates'])
+    else:
+        key = inference_key(SAM2_MODEL, sam2_input)
+        predict = lambda: predict_sam2(sam2_input)
+
+    # Identical inputs reuse the stored result instead of paying for
+    # another prediction, unless the caller asked to bypass the cache
+    output = result_cache.call(key, predict, bypass=job.input.get('bypass_cache', False))
+    print(output)
+    chunk_outputs = output if local_options else [output]
+    
+    result_url = None
+    for item in chunk_outputs[-1]:
+        result_url = item
+    
+    if not result_url:
+        raise ValueError('No output URL found in API response')
+    job.result['mask_url'] = result_url
+    job.result['video_id'] = replicate_video_id(result_url)
+
+    # Every chunk has the same layers; a layer of several chunks lists their masks in order
+    objects = list(dict.fromkeys(job.input.get('object_ids') or ['mask_1']))
+    policies = job.input.get('policies') or {}
+    chunk_layers = [output_layers(chunk_output, objects, policies) for chunk_output in chunk_outputs]
+    job.result['layers'] = []
+    for index, layer in enumerate(chunk_layers[0]):
+        urls = [layers[index]['mask_url'] for layers in chunk_layers]
+        job.result['layers'].append(dict(layer, mask_url=urls[0] if len(urls) == 1 else urls))
+
+def run_compositing(job):
+    print("Processing videos to create green screen version...")
+    output_mode = job.input.get('output_mode') or OUTPUT_MODE
+
+    def on_manifest(url):
+        # The stream is playable before compositing finishes
+        job.result['manifest_url'] = url
+        job_manager.save(job)
+
+    layers = [MaskLayer(layer['mask_url'], layer['policy']) for layer in job.result['layers']]
+    local_path = composite_with_mask(job.input['url'], layers,
+                                     output_mode=output_mode, on_manifest=on_manifest,
+                                     mask_interval=job.result.get('frame_interval', 1))
+    job.result['local_path'] = local_path
+    if output_mode == 'hls' and not job.result.get('manifest_url'):
+        # Nothing to upload or play; the directory is no video
+        raise RuntimeError('No HLS segments were produced')
+    if output_mode == 'mp4':
+        # The output can be downloaded from this server while it is being uploaded
+        job.result['output_url'] = f"/output/{os.path.basename(local_path)}"
+
+def run_upload(job):
+    if job.result.get('manifest_url'):
+        # HLS segments were uploaded while compositing
+        job.result['greenscreen_url'] = job.result['manifest_url']
+        return
+
+    print("Uploading to GCP bucket...")
+    local_path = job.result['local_path']
+    gcp_url = upload_to_gcp(local_path, os.path.basename(local_path))
+    if gcp_url:
+        print(f"Video uploaded successfully: {gcp_url}")
+    else:
+        print("Failed to upload to GCP bucket")
+    job.result['greenscreen_url'] = gcp_url
+
+# Annotations are processed in the background: inference, then compositing,
+# then upload, each stage with its own concurrency limit
+JOB_STAGES = [
+    ('inference', run_inference),
+    ('compositing', run_compositing),
+    ('uploading', run_upload),
+]
+# Runs the jobs of this process; set up by create_app()
+job_manager = None
+
+def annotation_job_input(data):
+    """Return the job input for an annotation request, as save_annotations and batch.py receive it.
+
+    data holds the url and clicks (see parse_points), and optionally the
+    objects' policies, frame_interval, target_fps, output_mode and
+    bypass_cache. Raises ValueError for an unknown policy or output mode, or
+    for objects with different policies when the model returns one mask for
+    all of them.
+    """
+    url = data['url']
+    coordinates, labels, object_ids, frames = parse_points(data)
+    # What to do with each object: keep it or replace it with the background
+    policies = data.get('objects') or {}
+    for object_id, policy in policies.items():
+        if policy not in LAYER_POLICIES:
+            raise ValueError(f'Unknown policy for {object_id}: {policy}')
+    # Checked before paying for a prediction that could not be composited
+    used = {policies.get(object_id, 'keep') for object_id in set(object_ids or ['mask_1'])}
+    if len(used) > 1 and not SAM2_PER_OBJECT_MASKS:
+        raise ValueError('The model returns a single mask for all objects, '
+                         'so they cannot have different policies')
+    output_mode = data.get('output_mode') or None
+    if output_mode is not None and output_mode not in OUTPUT_MODES:
+        raise ValueError(f'Unknown output mode: {output_mode}')
+    # Masks for every Nth frame only, or for about target_fps frames per
+    # second. What the request asks for wins over the server defaults, and
+    # its target_fps over its frame_interval.
+    if data.get('target_fps'):
+        interval, target_fps = temporal.SAM2_FRAME_INTERVAL, float(data['target_fps'])
+    elif data.get('frame_interval'):
+        interval, target_fps = int(data['frame_interval']), 0.0
+    else:
+        interval, target_fps = temporal.SAM2_FRAME_INTERVAL, temporal.SAM2_TARGET_FPS
+
+    # Create JSON output
+    json_output = build_sam2_input(url, coordinates, frame_interval=max(1, interval),
+                                   labels=labels, object_ids=object_ids, frames=frames)
+    return {
+        'url': url,
+        'coordinates': coordinates,
+        'object_ids': object_ids,
+        'policies': policies,
+        'sam2_input': json_output,
+        'bypass_cache': bool(data.get('bypass_cache', False)),
+        'output_mode': output_mode,
+        'target_fps': target_fps
+    }
+
+@routes.route('/save_annotations', methods=['POST'])
 def save_annotations():
     try:
         data = request.get_json()
-        url = data['url']
-        coordinates = data['coordinates']
+        with metrics.stage('save_annotations'):
+            try:
+                job_input = annotation_job_input(data)
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 400
         
-        # Create JSON output
-        coord_str = ','.join([f"[{x},{y}]" for x, y in coordinates])
-        json_output = {
-            "mask_type": "binary",
-            "video_fps": 25,
-            "input_video": url,
-            "click_frames": ','.join(['0'] * len(coordinates)),
-            "click_labels": ','.join(['1'] * len(coordinates)),
-            "output_video": True,
-            "output_format": "webp",
-            "output_quality": 100,
-            "annotation_type": "mask",
-            "click_object_ids": "mask_1",
-            "click_coordinates": coord_str,
-            "output_frame_interval": 1
-        }
+            # Store annotations
+            state.set_json('annotations', job_input['url'], job_input['sam2_input'])
         
-        # Store annotations
-        video_annotations[url] = json_output
-        
-        try:
-            print("\nMaking API call to Replicate...")
-            output = replicate.run(
-                "meta/sam-2-video:33432afdfc06a10da6b4018932893d39b0159f838b6d11dd1236dff85cc5ec1d",
-                input=json_output
-            )
-            print(output)
-            
-            result_url = None
-            for item in output:
-                result_url = item
-            
-            if result_url:
-                # Process the videos to create green screen version
-                print("Processing videos to create green screen version...")
-                result = process_video_with_mask(url, result_url)
-                
-                if result:
-                    return jsonify({
-                        'video_id': str(data['url']),
-                        'greenscreen_url': result['gcp_url']
-                    })
-                else:
-                    return jsonify({
-                        'error': 'Failed to create green screen version'
-                    })
-            else:
-                return jsonify({
-                    'error': 'No output URL found in API response'
-                })
-            
-        except Exception as e:
-            print(f"\nAPI Error: {str(e)}")
-            return jsonify({
-                'error': str(e)
-            })
+            # Queue the job and return right away, the page polls /jobs/<job_id>
+            job = job_manager.submit(job_input)
+            return jsonify(job.to_dict()), 202
         
     except Exception as e:
         return jsonify({'error': str(e)})
 
+@routes.route('/jobs/<job_id>')
+def job_status(job_id):
+    job = job_manager.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job.to_dict())
+
+@routes.route('/jobs')
+def list_jobs():
+    return jsonify({'jobs': [job.to_dict() for job in job_manager.list()]})
+
+@routes.route('/metrics')
+def metrics_endpoint():
+    """Stage timings, sizes, errors and cache hit rates for Prometheus."""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+def parse_background(spec):
+    """Check a background from a request: #rrggbb (or rrggbb), or an http(s) URL of an image or video."""
+    spec = (spec or '').strip()
+    if not spec:
+        return '#00ff00'
+    if re.fullmatch(r'#?[0-9a-fA-F]{6}', spec):
+        return '#' + spec.lstrip('#').lower()
+    # Local paths are refused, they would let anyone render files of the server
+    if urlparse(spec).scheme in ('http', 'https'):
+        return spec
+    raise ValueError(f"Background must be a #rrggbb color or an http(s) URL: {spec}")
+
+def render_job(job, background, feather):
+    """Return the path of job's video composited over background, rendering it once.
+
+    Renders come from the cached original and mask archives, and are kept
+    in the render cache by job and background. The path stays valid until
+    it is passed to render_cache.release().
+    """
+    key = json.dumps({'job': job.id, 'background': background, 'feather': feather}, sort_keys=True)
+    layers = [MaskLayer(layer['mask_url'], layer['policy']) for layer in job.result['layers']]
+
+    def fill(path):
+        with contextlib.ExitStack() as stack:
+            spec = background
+            if not background.startswith('#'):
+                # Images and videos are fetched through the video cache
+                spec = stack.enter_context(cached_video(background))
+            rendered = composite_with_mask(job.input['url'], layers, spec, output_mode='mp4',
+                                           mask_interval=job.result.get('frame_interval', 1),
+                                           feather=feather)
+            shutil.move(rendered, path)
+
+    return render_cache.acquire(key, fill)
+
+@routes.route('/jobs/<job_id>/render')
+def render(job_id):
+    """Download a job's video over ?background=, with an optional ?feather= edge width."""
+    job = job_manager.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    if not job.result.get('layers'):
+        return jsonify({'error': 'Masks are not ready yet'}), 409
+    try:
+        background = parse_background(request.args.get('background'))
+        feather = max(0, int(request.args.get('feather', RENDER_FEATHER)))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    try:
+        path = render_job(job, background, feather)
+    except Exception as e:
+        print(f"Error rendering job {job_id}: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+    @after_this_request
+    def release_render(response):
+        # send_file already holds the file open
+        render_cache.release(path)
+        return response
+
+    return send_file(path, as_attachment=True, download_name=f'greenscreen_{job_id}.mp4',
+                     mimetype='video/mp4')
+
+@routes.route('/output/<path:filename>')
+def output_file(filename):
+    return send_from_directory(OUTPUT_DIR, filename, mimetype='video/mp4')
+
 def is_port_in_use(port):
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
         return s.connect_ex(('localhost', port)) == 0
 
-def download_video(url, save_path='temp_video.mp4'):
-    """Download video from URL"""
-    urllib.request.urlretrieve(url, save_path)
-    return save_path
+def setup(state_backend=None, job_backend=None, workers=None, stage_concurrency=None):
+    """Create the stores, caches and job manager that jobs and routes use.
+
+    Settings are read first, from the environment and .env (see
+    load_settings()). workers and stage_concurrency override JOB_WORKERS and
+    the per-stage limits of the job manager. Call once per process, after
+    forking, since the job manager starts threads.
+    """
+    global state, job_manager, result_cache, render_cache
+    load_settings()
+    state = make_state_store(state_backend)
+    result_cache = ResultCache()
+    # Absolute, since send_file resolves relative paths against the app's root, not the cwd
+    render_cache = FileCache(RENDER_CACHE_DIR, RENDER_CACHE_MAX_BYTES, suffix='.mp4')
+    metrics.register_cache('sam2_result', result_cache.stats)
+    metrics.register_cache('render', render_cache.stats)
+    job_manager = JobManager(JOB_STAGES, workers=workers, stage_concurrency=stage_concurrency,
+                             store=make_job_store(job_backend))
+    return job_manager
+
+def create_app(state_backend=None, job_backend=None):
+    """Build the Flask app, with the stores and job manager its routes use.
+
+    Backends default to STATE_BACKEND and JOB_BACKEND. Server processes
+    that share requests must all use 'sqlite' for both, so annotations and
+    jobs saved by one are seen by the others. Call once per process, after
+    forking, since the job manager starts threads.
+    """
+    setup(state_backend, job_backend)
+    app = Flask(__name__)
+    app.register_blueprint(routes)
+    return app
 
 def main():
     # Check if port 3002 is available
@@ -705,7 +1195,9 @@ def main():
         print("Error: Port 3002 is already in use")
         sys.exit(1)
 
-    # Start Flask server
+    # Start Flask's development server, see serve.py for production
+    import webbrowser
+    app = create_app()
     print("Starting server at http://localhost:3002")
     webbrowser.open('http://localhost:3002')
     app.run(port=3002)
@@ -0,0 +1,114 @@
+import os
+import threading
+import uuid
+
+from encoders import FFmpegEncoder
+from object_storage import get_storage
+
+
+def configure():
+    """Read the HLS settings from the environment."""
+    global HLS_SEGMENT_SECONDS, HLS_POLL_INTERVAL
+    # Length of each HLS segment in seconds
+    HLS_SEGMENT_SECONDS = float(os.getenv("HLS_SEGMENT_SECONDS", "4"))
+    # Seconds between checks for newly finished segments
+    HLS_POLL_INTERVAL = float(os.getenv("HLS_POLL_INTERVAL", "0.5"))
+
+
+configure()
+
+PLAYLIST_NAME = 'index.m3u8'
+
+
+def playlist_segments(playlist_path):
+    """Return the segment file names listed in an HLS playlist."""
+    try:
+        with open(playlist_path) as f:
+            return [line.strip() for line in f if line.strip() and not line.startswith('#')]
+    except FileNotFoundError:
+        return []
+
+
+class HLSWriter:
+    """Encode frames to HLS segments and upload each segment as soon as it is finished.
+
+    Has the write()/release() interface of cv2.VideoWriter so the compositing
+    pipeline can use it as its writer. Frames are piped to ffmpeg, which cuts
+    the stream into segments of HLS_SEGMENT_SECONDS. A watcher thread uploads
+    every segment the playlist lists, then the playlist itself, so the
+    playlist URL is playable while later frames are still being composited.
+    on_manifest(url) is called once the first segment is online.
+    """
+
+    def __init__(self, directory, fps, width, height, storage=None, prefix=None, on_manifest=None,
+                 audio_source=None):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.playlist_path = os.path.join(directory, PLAYLIST_NAME)
+        self.storage = storage or get_storage()
+        self.prefix = prefix or f"hls_{uuid.uuid4()}"
+        self.on_manifest = on_manifest
+        self.manifest_url = None
+        self._uploaded = set()
+        self._done = threading.Event()
+        self._error = None
+
+        gop = max(int(round(fps * HLS_SEGMENT_SECONDS)), 1)
+        self._encoder = FFmpegEncoder(
+            self.playlist_path, fps, width, height, audio_source=audio_source,
+            # A keyframe at every segment boundary so each segment plays on its own
+            extra_video_args=['-g', str(gop), '-keyint_min', str(gop), '-sc_threshold', '0'],
+            output_args=['-f', 'hls', '-hls_time', str(HLS_SEGMENT_SECONDS),
+                         '-hls_playlist_type', 'event', '-hls_flags', 'temp_file',
+                         '-hls_segment_filename', os.path.join(directory, 'segment_%05d.ts')],
+        )
+        self._watcher = threading.Thread(target=self._watch, daemon=True)
+        self._watcher.start()
+
+    def _name(self, filename):
+        return f"{self.prefix}/{filename}"
+
+    def _sync(self):
+        """Upload finished segments that are not online yet, then the playlist."""
+        segments = [name for name in playlist_segments(self.playlist_path) if name not in self._uploaded]
+        if not segments:
+            return
+        futures = [self.storage.upload_async(os.path.join(self.directory, name), self._name(name), 'video/mp2t')
+                   for name in segments]
+        for future in futures:
+            future.result()
+        self._uploaded.update(segments)
+        # Only publish a playlist whose segments are all online
+        url = self.storage.upload(self.playlist_path, self._name(PLAYLIST_NAME),
+                                  'application/vnd.apple.mpegurl', overwrite=True)
+        if self.manifest_url is None:
+            self.manifest_url = url
+            print(f"Stream available at {url}")
+            if self.on_manifest:
+                self.on_manifest(url)
+
+    def _watch(self):
+        try:
+            while not self._done.wait(HLS_POLL_INTERVAL):
+                self._sync()
+        except Exception as e:
+            self._error = e
+
+    def write(self, frame):
+        self._encoder.write(frame)
+
+    def release(self):
+        """Finish encoding, upload the remaining segments and the final playlist."""
+        try:
+            self._encoder.release()
+        finally:
+            self._done.set()
+            self._watcher.join()
+        if self._error is not None:
+            raise self._error
+        self._sync()
+        if not self._uploaded:
+            raise RuntimeError(f"No HLS segments were produced in {self.directory}")
+        # The final playlist carries EXT-X-ENDLIST, upload it even with no new segments
+        self.manifest_url = self.storage.upload(self.playlist_path, self._name(PLAYLIST_NAME),
+                                                'application/vnd.apple.mpegurl', overwrite=True)
@@ -0,0 +1,107 @@
+"""Production entry point: the web interface under a WSGI server.
+
+    python serve.py
+
+Runs SERVER_WORKERS processes of SERVER_THREADS threads each under
+gunicorn, or threads in a single process under waitress where gunicorn is
+not available (Windows). Neither opens a browser. With more than one
+worker, annotations and jobs are kept in SQLite (STATE_PATH and
+JOB_STORE_PATH) so every worker can answer for every job. The video, mask
+archive and render caches keep their sizes and pins in an index file in
+their directory, so workers share one byte budget and never evict a file
+another worker is reading; SAM2 results are shared through their SQLite
+file.
+
+gunicorn and waitress are optional dependencies:
+    pip install gunicorn    # or waitress
+"""
+import importlib.util
+import os
+
+from dotenv import load_dotenv
+
+
+def configure():
+    """Read the server settings from the environment."""
+    global SERVER_BIND, SERVER_WORKERS, SERVER_THREADS, SERVER_TIMEOUT, SERVER_BACKEND
+    # Address to listen on, host:port
+    SERVER_BIND = os.getenv("SERVER_BIND", "0.0.0.0:3002")
+    # Worker processes (0 uses every CPU) and request threads in each
+    SERVER_WORKERS = int(os.getenv("SERVER_WORKERS", "2"))
+    SERVER_THREADS = int(os.getenv("SERVER_THREADS", "8"))
+    # Seconds a request may take before its worker is restarted; renders and
+    # downloads composite whole videos, so this is generous
+    SERVER_TIMEOUT = int(os.getenv("SERVER_TIMEOUT", "600"))
+    # gunicorn, waitress or auto (gunicorn when installed)
+    SERVER_BACKEND = os.getenv("SERVER_BACKEND", "auto")
+
+
+configure()
+
+
+def app_builder(workers, setup=None):
+    """Return a function that builds the app with backends fit for workers processes."""
+    def build():
+        import run
+        backend = 'sqlite' if workers > 1 else None
+        app = run.create_app(state_backend=backend, job_backend=backend)
+        if setup is not None:
+            setup(run, app)
+        return app
+    return build
+
+
+def serve_gunicorn(build, bind, workers, threads, timeout):
+    from gunicorn.app.base import BaseApplication
+
+    class Application(BaseApplication):
+        def load_config(self):
+            self.cfg.set('bind', bind)
+            self.cfg.set('workers', workers)
+            self.cfg.set('threads', threads)
+            self.cfg.set('worker_class', 'gthread' if threads > 1 else 'sync')
+            self.cfg.set('timeout', timeout)
+            self.cfg.set('graceful_timeout', timeout)
+
+        def load(self):
+            # Each worker builds its own app after forking, job threads included
+            return build()
+
+    Application().run()
+
+
+def serve_waitress(build, bind, threads, timeout):
+    import waitress
+    waitress.serve(build(), listen=bind, threads=threads, channel_timeout=timeout)
+
+
+def serve(bind=None, workers=None, threads=None, timeout=None, backend=None, setup=None):
+    """Serve the app until interrupted.
+
+    setup(run, app) is called in every worker once its app is built, e.g.
+    to install offline stand-ins for a load test. Settings are read from
+    the environment and .env; the workers read them again as they build
+    their apps.
+    """
+    load_dotenv(os.path.join(os.path.dirname(os.path.abspath(__file__)), '.env'))
+    configure()
+    bind = bind or SERVER_BIND
+    workers = workers or SERVER_WORKERS or os.cpu_count()
+    threads = threads or SERVER_THREADS
+    timeout = timeout or SERVER_TIMEOUT
+    backend = backend or SERVER_BACKEND
+    if backend == 'auto':
+        backend = 'gunicorn' if importlib.util.find_spec('gunicorn') else 'waitress'
+
+    if backend == 'gunicorn':
+        print(f"Serving on {bind} with gunicorn, {workers} workers of {threads} threads")
+        serve_gunicorn(app_builder(workers, setup), bind, workers, threads, timeout)
+    elif backend == 'waitress':
+        print(f"Serving on {bind} with waitress, {threads} threads in one process")
+        serve_waitress(app_builder(1, setup), bind, threads, timeout)
+    else:
+        raise ValueError(f"Unknown server backend: {backend}")
+
+
+if __name__ == "__main__":
+    serve()
@@ -0,0 +1,189 @@
+import contextlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import cv2
+
+
+def configure():
+    """Read the state settings from the environment."""
+    global STATE_BACKEND, STATE_PATH, STATE_MAX_BYTES, STATE_TTL, PREVIEW_MAX_DIM, PREVIEW_JPEG_QUALITY
+    # Per-URL state (preview frames, annotations) is kept within a byte budget
+    # and forgotten after STATE_TTL seconds
+    STATE_BACKEND = os.getenv("STATE_BACKEND", "memory")
+    # Relative to the app's directory, so processes started from anywhere share it
+    STATE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              os.getenv("STATE_PATH", os.path.join("cache", "state.sqlite3")))
+    STATE_MAX_BYTES = int(os.getenv("STATE_MAX_BYTES", str(64 * 1024 * 1024)))
+    STATE_TTL = float(os.getenv("STATE_TTL", str(24 * 3600)))
+
+    # Preview frames are stored and sent to the page as JPEG, scaled down so the
+    # longest side is at most PREVIEW_MAX_DIM pixels (0 keeps full resolution)
+    PREVIEW_MAX_DIM = int(os.getenv("PREVIEW_MAX_DIM", "1920"))
+    PREVIEW_JPEG_QUALITY = int(os.getenv("PREVIEW_JPEG_QUALITY", "90"))
+
+
+configure()
+
+
+def encode_preview(frame, max_dim=None):
+    """Return JPEG bytes of frame scaled down to max_dim on its longest side."""
+    max_dim = PREVIEW_MAX_DIM if max_dim is None else max_dim
+    height, width = frame.shape[:2]
+    if max_dim and max(width, height) > max_dim:
+        scale = max_dim / max(width, height)
+        frame = cv2.resize(frame, (round(width * scale), round(height * scale)),
+                           interpolation=cv2.INTER_AREA)
+    ok, buffer = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, PREVIEW_JPEG_QUALITY])
+    if not ok:
+        raise ValueError("Failed to encode preview frame")
+    return buffer.tobytes()
+
+
+class StateStore:
+    """Interface shared by the state backends.
+
+    Values are bytes stored under a (namespace, key) pair. get_json() and
+    set_json() store JSON-serializable values.
+    """
+
+    def get(self, namespace, key):
+        raise NotImplementedError
+
+    def set(self, namespace, key, value):
+        raise NotImplementedError
+
+    def delete(self, namespace, key):
+        raise NotImplementedError
+
+    def get_json(self, namespace, key):
+        value = self.get(namespace, key)
+        return None if value is None else json.loads(value)
+
+    def set_json(self, namespace, key, value):
+        self.set(namespace, key, json.dumps(value).encode('utf-8'))
+
+
+class MemoryStateStore(StateStore):
+    """Thread-safe in-process store with a byte budget, TTL and LRU eviction."""
+
+    def __init__(self, max_bytes=None, ttl=None):
+        self.max_bytes = STATE_MAX_BYTES if max_bytes is None else max_bytes
+        self.ttl = STATE_TTL if ttl is None else ttl
+        self._entries = OrderedDict()
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+
+    def _remove(self, entry_key):
+        value, _ = self._entries.pop(entry_key)
+        self._total_bytes -= len(value)
+
+    def get(self, namespace, key):
+        entry_key = (namespace, key)
+        with self._lock:
+            entry = self._entries.get(entry_key)
+            if entry is None:
+                return None
+            value, created = entry
+            if self.ttl and time.time() - created > self.ttl:
+                self._remove(entry_key)
+                return None
+            self._entries.move_to_end(entry_key)
+            return value
+
+    def set(self, namespace, key, value):
+        entry_key = (namespace, key)
+        now = time.time()
+        with self._lock:
+            if entry_key in self._entries:
+                self._remove(entry_key)
+            self._entries[entry_key] = (value, now)
+            self._total_bytes += len(value)
+            # Expired entries go first, then the least recently used
+            for old_key, (_, created) in list(self._entries.items()):
+                if self.ttl and now - created > self.ttl:
+                    self._remove(old_key)
+            while self._total_bytes > self.max_bytes and len(self._entries) > 1:
+                self._remove(next(iter(self._entries)))
+
+    def delete(self, namespace, key):
+        with self._lock:
+            if (namespace, key) in self._entries:
+                self._remove((namespace, key))
+
+
+class SqliteStateStore(StateStore):
+    """On-disk store with the same limits, shared by every process using the file."""
+
+    def __init__(self, path=None, max_bytes=None, ttl=None):
+        self.path = path or STATE_PATH
+        self.max_bytes = STATE_MAX_BYTES if max_bytes is None else max_bytes
+        self.ttl = STATE_TTL if ttl is None else ttl
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connect() as db:
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('CREATE TABLE IF NOT EXISTS state ('
+                       'namespace TEXT NOT NULL, key TEXT NOT NULL, value BLOB NOT NULL, '
+                       'size INTEGER NOT NULL, created REAL NOT NULL, accessed REAL NOT NULL, '
+                       'PRIMARY KEY (namespace, key))')
+            db.execute('CREATE INDEX IF NOT EXISTS state_accessed ON state (accessed)')
+
+    @contextlib.contextmanager
+    def _connect(self):
+        db = sqlite3.connect(self.path, timeout=30)
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    def get(self, namespace, key):
+        now = time.time()
+        with self._connect() as db:
+            row = db.execute('SELECT value, created FROM state WHERE namespace = ? AND key = ?',
+                             (namespace, key)).fetchone()
+            if row is None:
+                return None
+            if self.ttl and now - row[1] > self.ttl:
+                db.execute('DELETE FROM state WHERE namespace = ? AND key = ?', (namespace, key))
+                return None
+            db.execute('UPDATE state SET accessed = ? WHERE namespace = ? AND key = ?',
+                       (now, namespace, key))
+        return bytes(row[0])
+
+    def set(self, namespace, key, value):
+        now = time.time()
+        with self._connect() as db:
+            db.execute('INSERT OR REPLACE INTO state (namespace, key, value, size, created, accessed) '
+                       'VALUES (?, ?, ?, ?, ?, ?)', (namespace, key, value, len(value), now, now))
+            if self.ttl:
+                db.execute('DELETE FROM state WHERE created < ?', (now - self.ttl,))
+            total = db.execute('SELECT COALESCE(SUM(size), 0) FROM state').fetchone()[0]
+            if total > self.max_bytes:
+                # Drop the least recently used rows until the rest fit the budget
+                rows = db.execute('SELECT namespace, key, size FROM state ORDER BY accessed').fetchall()
+                for old_namespace, old_key, size in rows[:-1]:
+                    if total <= self.max_bytes:
+                        break
+                    db.execute('DELETE FROM state WHERE namespace = ? AND key = ?', (old_namespace, old_key))
+                    total -= size
+
+    def delete(self, namespace, key):
+        with self._connect() as db:
+            db.execute('DELETE FROM state WHERE namespace = ? AND key = ?', (namespace, key))
+
+
+def make_state_store(backend=None):
+    """Create the state store selected by STATE_BACKEND ('memory' or 'sqlite')."""
+    backend = backend or STATE_BACKEND
+    if backend == 'memory':
+        return MemoryStateStore()
+    if backend == 'sqlite':
+        return SqliteStateStore()
+    raise ValueError(f"Unknown state backend: {backend}")
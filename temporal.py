@@ -0,0 +1,124 @@
+import math
+import os
+
+import cv2
+import numpy as np
+
+
+def configure():
+    """Read the sub-sampling settings from the environment."""
+    global SAM2_FRAME_INTERVAL, SAM2_TARGET_FPS, MASK_FILL, FLOW_SCALE
+    # SAM2 is asked for a mask every SAM2_FRAME_INTERVAL frames, or, when
+    # SAM2_TARGET_FPS is set, for about that many masks per second of video.
+    # The frames in between get masks filled in locally.
+    SAM2_FRAME_INTERVAL = int(os.getenv("SAM2_FRAME_INTERVAL", "1"))
+    SAM2_TARGET_FPS = float(os.getenv("SAM2_TARGET_FPS", "0"))
+
+    # How masks are filled in between model frames: 'hold' repeats the last mask,
+    # 'flow' moves it along the dense optical flow of the original video
+    MASK_FILL = os.getenv("MASK_FILL", "hold")
+    # Optical flow is computed on frames scaled down by this factor
+    FLOW_SCALE = float(os.getenv("FLOW_SCALE", "0.25"))
+
+
+configure()
+
+
+def frame_interval(source_fps, target_fps=None, interval=None):
+    """Number of original frames per model frame.
+
+    target_fps (if set) takes precedence over a fixed interval.
+    """
+    target_fps = SAM2_TARGET_FPS if target_fps is None else target_fps
+    if target_fps and source_fps:
+        return max(1, round(source_fps / target_fps))
+    return max(1, int(interval or SAM2_FRAME_INTERVAL))
+
+
+def mask_index(frame_index, interval):
+    """Index of the model mask frame at or before an original frame.
+
+    Mask frame k was taken at the timestamp of original frame k * interval.
+    """
+    return frame_index // interval
+
+
+def model_frames(frame_count, interval):
+    """Number of frames the model processes for a video of frame_count frames."""
+    return math.ceil(frame_count / interval)
+
+
+class MaskInterpolator:
+    """Produces a mask for every original frame from masks of every Nth frame.
+
+    key() is called with the frames that have a model mask, fill() with the
+    frames between them. Masks are kept as single-channel images the size of
+    the original frames, in buffers allocated once per video. Smaller model
+    masks are scaled up with upscaler (a compositing.MaskUpscaler) if given.
+    """
+
+    def __init__(self, width, height, method=None, flow_scale=None, upscaler=None):
+        self.method = method or MASK_FILL
+        if self.method not in ('hold', 'flow'):
+            raise ValueError(f"Unknown mask fill method: {self.method}")
+        self.width = width
+        self.height = height
+        self.flow_scale = flow_scale or FLOW_SCALE
+        self.upscaler = upscaler
+        self.has_mask = False
+        self._mask = np.empty((height, width), dtype=np.uint8)
+        self._warped = np.empty((height, width), dtype=np.uint8)
+        if self.method == 'flow':
+            small = (max(1, round(width * self.flow_scale)), max(1, round(height * self.flow_scale)))
+            self._small_size = small
+            self._gray = np.empty((height, width), dtype=np.uint8)
+            self._previous = np.empty((small[1], small[0]), dtype=np.uint8)
+            self._current = np.empty((small[1], small[0]), dtype=np.uint8)
+            grid_x, grid_y = np.meshgrid(np.arange(width, dtype=np.float32),
+                                         np.arange(height, dtype=np.float32))
+            self._grid_x = grid_x
+            self._grid_y = grid_y
+            self._map_x = np.empty((height, width), dtype=np.float32)
+            self._map_y = np.empty((height, width), dtype=np.float32)
+            self._flow = np.empty((height, width, 2), dtype=np.float32)
+
+    def _small_gray(self, frame, out):
+        cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY, dst=self._gray)
+        cv2.resize(self._gray, self._small_size, dst=out, interpolation=cv2.INTER_AREA)
+
+    def key(self, frame, mask_frame):
+        """Take the model mask of frame and return it as the current mask."""
+        if mask_frame.ndim == 3:
+            mask_frame = cv2.cvtColor(mask_frame, cv2.COLOR_BGR2GRAY)
+        if mask_frame.shape != self._mask.shape and self.upscaler is not None:
+            np.copyto(self._mask, self.upscaler.upscale(mask_frame, frame))
+        elif mask_frame.shape != self._mask.shape:
+            cv2.resize(mask_frame, (self.width, self.height), dst=self._mask,
+                       interpolation=cv2.INTER_LINEAR)
+        else:
+            np.copyto(self._mask, mask_frame)
+        if self.method == 'flow':
+            self._small_gray(frame, self._previous)
+        self.has_mask = True
+        return self._mask
+
+    def fill(self, frame):
+        """Return the mask of a frame without a model mask."""
+        if self.method == 'hold':
+            return self._mask
+
+        # Flow from this frame back to the previous one tells where each
+        # pixel came from, so the previous mask can be pulled into place
+        self._small_gray(frame, self._current)
+        flow = cv2.calcOpticalFlowFarneback(self._current, self._previous, None,
+                                            0.5, 3, 15, 3, 5, 1.2, 0)
+        flow = cv2.resize(flow, (self.width, self.height), dst=self._flow, interpolation=cv2.INTER_LINEAR)
+        np.multiply(flow[..., 0], 1 / self.flow_scale, out=self._map_x)
+        np.add(self._map_x, self._grid_x, out=self._map_x)
+        np.multiply(flow[..., 1], 1 / self.flow_scale, out=self._map_y)
+        np.add(self._map_y, self._grid_y, out=self._map_y)
+        cv2.remap(self._mask, self._map_x, self._map_y, cv2.INTER_LINEAR, dst=self._warped,
+                  borderMode=cv2.BORDER_REPLICATE)
+        self._mask, self._warped = self._warped, self._mask
+        self._previous, self._current = self._current, self._previous
+        return self._mask
@@ -0,0 +1,136 @@
+"""Shared fixtures. Modules read their settings when imported, so every
+cache, store and output directory is pointed at a temporary directory here,
+before the tests import them."""
+import os
+import shutil
+import sys
+import tempfile
+
+import cv2
+import numpy as np
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+_work = tempfile.mkdtemp(prefix='sam2_tests_')
+os.environ.update({
+    'REPLICATE_API_TOKEN': 'offline',
+    'VIDEO_CACHE_DIR': os.path.join(_work, 'video_cache'),
+    'MASK_ARCHIVE_DIR': os.path.join(_work, 'mask_archives'),
+    'RESULT_CACHE_PATH': os.path.join(_work, 'results.sqlite3'),
+    'RENDER_CACHE_DIR': os.path.join(_work, 'renders'),
+    'OUTPUT_DIR': os.path.join(_work, 'output'),
+    'JOB_STORE_PATH': os.path.join(_work, 'jobs.sqlite3'),
+    'STATE_BACKEND': 'memory',
+    'JOB_BACKEND': 'memory',
+    'STORAGE_BACKEND': 'local',
+    'LOCAL_STORAGE_DIR': os.path.join(_work, 'uploads'),
+    'ENCODER': 'opencv',
+    'PIPELINE_REPORT_TIMINGS': '0',
+    'PREFETCH_ON_PREVIEW': '0',
+})
+
+import segmented  # noqa: E402
+from fakes import LocalHTTPServer  # noqa: E402
+
+
+def pytest_sessionfinish(session, exitstatus):
+    shutil.rmtree(_work, ignore_errors=True)
+
+
+def write_videos(directory, frames=30, width=160, height=120, mask_frames=None, extension='.mp4'):
+    """Write a textured original and a mask of a moving disc; returns their paths.
+
+    .avi files are written with FFV1, so their frames decode exactly.
+    """
+    fourcc = cv2.VideoWriter_fourcc(*('FFV1' if extension == '.avi' else 'mp4v'))
+    original_path = os.path.join(directory, 'original' + extension)
+    mask_path = os.path.join(directory, 'mask' + extension)
+    original = cv2.VideoWriter(original_path, fourcc, 25, (width, height))
+    mask = cv2.VideoWriter(mask_path, fourcc, 25, (width, height))
+    texture = np.random.default_rng(0).integers(0, 256, (height, width, 3), dtype=np.uint8)
+    for index in range(frames):
+        original.write(np.roll(texture, index * 3, axis=1))
+        if index < (frames if mask_frames is None else mask_frames):
+            frame = np.zeros((height, width, 3), dtype=np.uint8)
+            cv2.circle(frame, (width // 4 + index * 2, height // 2), height // 4, (255, 255, 255), -1)
+            mask.write(frame)
+    original.release()
+    mask.release()
+    return original_path, mask_path
+
+
+def read_frames(path):
+    cap = cv2.VideoCapture(path)
+    frames = []
+    while True:
+        ret, frame = cap.read()
+        if not ret:
+            break
+        frames.append(frame)
+    cap.release()
+    return frames
+
+
+@pytest.fixture
+def http_server(tmp_path):
+    """A local server of tmp_path with range, ETag and Last-Modified support."""
+    with LocalHTTPServer(str(tmp_path)) as server:
+        yield server
+
+
+class FakeHLSEncoder:
+    """Stands in for ffmpeg's HLS muxer: every -g frames become a segment named
+    after -hls_segment_filename, listed in the playlist once it is written.
+
+    Segments hold the raw frames. No playlist is written without frames.
+    """
+
+    def __init__(self, path, fps, width, height, audio_source=None, extra_video_args=(), output_args=()):
+        extra_video_args = list(extra_video_args)
+        output_args = list(output_args)
+        self.playlist_path = path
+        self.segment_frames = int(extra_video_args[extra_video_args.index('-g') + 1])
+        self.segment_pattern = output_args[output_args.index('-hls_segment_filename') + 1]
+        self.duration = self.segment_frames / fps
+        self.segments = []
+        self._frames = []
+
+    def _write_playlist(self, ended=False):
+        lines = ['#EXTM3U', '#EXT-X-PLAYLIST-TYPE:EVENT']
+        for name in self.segments:
+            lines += [f'#EXTINF:{self.duration:.6f},', name]
+        if ended:
+            lines.append('#EXT-X-ENDLIST')
+        # Replaced in one step, as with -hls_flags temp_file
+        with open(self.playlist_path + '.tmp', 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(self.playlist_path + '.tmp', self.playlist_path)
+
+    def _cut(self):
+        path = self.segment_pattern % len(self.segments)
+        with open(path, 'wb') as f:
+            for frame in self._frames:
+                f.write(frame.tobytes())
+        self._frames = []
+        self.segments.append(os.path.basename(path))
+        self._write_playlist()
+
+    def write(self, frame):
+        self._frames.append(frame.copy())
+        if len(self._frames) == self.segment_frames:
+            self._cut()
+
+    def release(self):
+        if self._frames:
+            self._cut()
+        if self.segments:
+            self._write_playlist(ended=True)
+
+
+@pytest.fixture
+def fake_hls_encoder(monkeypatch):
+    """Make HLSWriter encode with FakeHLSEncoder, so HLS output needs no ffmpeg."""
+    monkeypatch.setattr(segmented, 'FFmpegEncoder', FakeHLSEncoder)
+    return FakeHLSEncoder
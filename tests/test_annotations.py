@@ -0,0 +1,78 @@
+import pytest
+
+import run
+import temporal
+from jobs import Job
+
+
+def job_input(**data):
+    return run.annotation_job_input(dict({'url': 'http://example.com/video.mp4',
+                                          'points': [{'x': 10, 'y': 20}]}, **data))
+
+
+@pytest.fixture
+def server_defaults(monkeypatch):
+    monkeypatch.setattr(temporal, 'SAM2_FRAME_INTERVAL', 3)
+    monkeypatch.setattr(temporal, 'SAM2_TARGET_FPS', 5.0)
+
+
+@pytest.mark.parametrize('data, interval, target_fps', [
+    ({}, 3, 5.0),
+    ({'frame_interval': 2}, 2, 0.0),
+    ({'target_fps': 10}, 3, 10.0),
+    ({'frame_interval': 2, 'target_fps': 10}, 3, 10.0),
+], ids=['server_defaults', 'request_interval', 'request_fps', 'request_fps_over_interval'])
+def test_request_sampling_wins_over_server_defaults(server_defaults, data, interval, target_fps):
+    result = job_input(**data)
+    assert result['sam2_input']['output_frame_interval'] == interval
+    assert result['target_fps'] == target_fps
+
+
+def test_mixed_policies_need_per_object_masks(monkeypatch):
+    data = {'points': [{'x': 10, 'y': 20, 'object': 'a'}, {'x': 30, 'y': 40, 'object': 'b'}],
+            'objects': {'a': 'keep', 'b': 'replace'}}
+    monkeypatch.setattr(run, 'SAM2_PER_OBJECT_MASKS', False)
+    with pytest.raises(ValueError):
+        job_input(**data)
+    monkeypatch.setattr(run, 'SAM2_PER_OBJECT_MASKS', True)
+    assert job_input(**data)['policies'] == {'a': 'keep', 'b': 'replace'}
+
+
+def test_unknown_output_mode_is_rejected():
+    assert job_input(output_mode='hls')['output_mode'] == 'hls'
+    assert job_input(output_mode='')['output_mode'] is None
+    with pytest.raises(ValueError, match='Unknown output mode'):
+        job_input(output_mode='webm')
+
+
+def test_hls_job_without_segments_fails(tmp_path, monkeypatch):
+    # The writer never published a playlist, so on_manifest was not called
+    monkeypatch.setattr(run, 'composite_with_mask', lambda *args, **kwargs: str(tmp_path))
+    job = Job({'url': 'http://example.com/video.mp4', 'output_mode': 'hls'})
+    job.result['layers'] = [{'mask_url': 'http://example.com/mask.mp4', 'policy': 'keep'}]
+    with pytest.raises(RuntimeError, match='No HLS segments'):
+        run.run_compositing(job)
+
+
+def test_each_object_mask_gets_its_own_policy():
+    layers = run.output_layers(['http://example.com/a.mp4', 'http://example.com/b.mp4', 'http://example.com/c.mp4'],
+                               ['a', 'b', 'c'], {'a': 'keep', 'b': 'replace'})
+    assert layers == [
+        {'object': 'a', 'mask_url': 'http://example.com/a.mp4', 'policy': 'keep'},
+        {'object': 'b', 'mask_url': 'http://example.com/b.mp4', 'policy': 'replace'},
+        # Objects without a policy are kept
+        {'object': 'c', 'mask_url': 'http://example.com/c.mp4', 'policy': 'keep'},
+    ]
+
+
+def test_one_mask_for_all_objects_shares_their_policy():
+    output = ['http://example.com/all.mp4']
+    layers = run.output_layers(output, ['a', 'b'], {'a': 'replace', 'b': 'replace'})
+    assert layers == [{'object': 'a,b', 'mask_url': 'http://example.com/all.mp4', 'policy': 'replace'}]
+    with pytest.raises(ValueError, match='single mask'):
+        run.output_layers(output, ['a', 'b'], {'a': 'keep', 'b': 'replace'})
+
+
+def test_unknown_policy_is_rejected():
+    with pytest.raises(ValueError, match='Unknown policy for a'):
+        job_input(points=[{'x': 10, 'y': 20, 'object': 'a'}], objects={'a': 'blur'})
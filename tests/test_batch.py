@@ -0,0 +1,129 @@
+import json
+import os
+
+import pytest
+
+import batch
+import run
+from conftest import write_videos
+from fakes import FakePredictor
+
+
+@pytest.fixture
+def manifest(http_server, tmp_path):
+    """A JSONL manifest of three items on a local video, with their SAM2 predictions faked."""
+    write_videos(str(tmp_path), frames=10)
+    path = tmp_path / 'manifest.jsonl'
+    with open(path, 'w') as f:
+        for index in range(3):
+            f.write(json.dumps({'id': f'item_{index}', 'url': http_server.url('original.mp4'),
+                                'points': [{'x': 40 + index, 'y': 60}]}) + '\n')
+    return str(path)
+
+
+@pytest.fixture
+def predictor(http_server, monkeypatch):
+    predictor = FakePredictor(http_server.url('mask.mp4'))
+    monkeypatch.setattr(run, 'predictor', predictor)
+    return predictor
+
+
+def checkpoint_records(manifest):
+    with open(manifest + '.checkpoint.jsonl') as f:
+        return [json.loads(line) for line in f]
+
+
+def test_resumed_batch_skips_finished_items(manifest, predictor, capsys):
+    assert batch.main([manifest]) == 0
+    records = checkpoint_records(manifest)
+    assert sorted(record['id'] for record in records) == ['item_0', 'item_1', 'item_2']
+    assert all(record['status'] == 'done' and record['greenscreen_url'] for record in records)
+    calls = len(predictor.calls)
+    assert calls == 3
+
+    assert batch.main([manifest]) == 0
+    assert '3 already done, 0 to process' in capsys.readouterr().out
+    assert len(predictor.calls) == calls
+    assert len(checkpoint_records(manifest)) == 3
+
+
+def test_failed_and_cut_off_items_run_again(manifest, predictor):
+    mask_url = predictor.mask_url
+
+    def flaky(input):
+        if input['click_coordinates'] == '[41,60]':
+            raise RuntimeError('prediction failed')
+        return mask_url
+
+    predictor.mask_url = flaky
+    assert batch.main([manifest]) == 1
+    statuses = {record['id']: record['status'] for record in checkpoint_records(manifest)}
+    assert statuses == {'item_0': 'done', 'item_1': 'failed', 'item_2': 'done'}
+
+    # A line cut off by an interrupted write counts as not done
+    with open(manifest + '.checkpoint.jsonl', 'a') as f:
+        f.write('{"id": "item_1", "status": "do')
+    assert batch.Checkpoint(manifest + '.checkpoint.jsonl').done() == {'item_0', 'item_2'}
+
+    predictor.mask_url = mask_url
+    calls = len(predictor.calls)
+    assert batch.main([manifest]) == 0
+    # Only item_1 ran again
+    assert len(predictor.calls) == calls + 1
+    assert predictor.calls[-1][1]['click_coordinates'] == '[41,60]'
+    assert batch.Checkpoint(manifest + '.checkpoint.jsonl').done() == {'item_0', 'item_1', 'item_2'}
+
+
+def test_hls_items_leave_no_segment_directory(manifest, predictor, fake_hls_encoder, tmp_path, monkeypatch):
+    output_dir = tmp_path / 'output'
+    monkeypatch.setenv('OUTPUT_DIR', str(output_dir))
+    with open(manifest) as f:
+        requests = [json.loads(line) for line in f]
+    # An HLS item between two mp4 items, which still run after it
+    requests[1]['output_mode'] = 'hls'
+    with open(manifest, 'w') as f:
+        f.writelines(json.dumps(request) + '\n' for request in requests)
+    try:
+        assert batch.main([manifest]) == 0
+        urls = {record['id']: record['greenscreen_url'] for record in checkpoint_records(manifest)}
+        assert sorted(urls) == ['item_0', 'item_1', 'item_2']
+        assert urls['item_1'].endswith('/index.m3u8')
+        assert os.listdir(output_dir) == []
+    finally:
+        monkeypatch.undo()
+        run.configure()
+
+
+def test_manifest_errors_are_reported_with_line_numbers(tmp_path):
+    path = tmp_path / 'manifest.jsonl'
+    path.write_text('\n'.join([
+        json.dumps({'url': 'http://example.com/a.mp4', 'points': [{'x': 1, 'y': 2}]}),
+        'not json',
+        json.dumps({'url': 'http://example.com/b.mp4'}),
+        json.dumps(['a list']),
+        json.dumps({'url': 'http://example.com/a.mp4', 'points': [{'x': 1, 'y': 2}]}),
+    ]) + '\n')
+    with pytest.raises(ValueError) as error:
+        batch.read_manifest(str(path))
+    message = str(error.value)
+    assert 'line 1:' not in message
+    for number in (2, 3, 4, 5):
+        assert f'line {number}:' in message
+
+
+def test_csv_rows_of_one_id_are_one_item(tmp_path):
+    path = tmp_path / 'manifest.csv'
+    path.write_text('id,url,x,y,label\n'
+                    'a,http://example.com/a.mp4,10,20,1\n'
+                    'a,http://example.com/a.mp4,30,40,0\n'
+                    'b,http://example.com/b.mp4,,20,1\n')
+    with pytest.raises(ValueError, match='line 4: empty x'):
+        batch.read_manifest(str(path))
+
+    path.write_text('id,url,x,y,label\n'
+                    'a,http://example.com/a.mp4,10,20,1\n'
+                    'a,http://example.com/a.mp4,30,40,0\n')
+    (item_id, job_input), = batch.read_manifest(str(path))
+    assert item_id == 'a'
+    assert job_input['coordinates'] == [[10, 20], [30, 40]]
+    assert job_input['sam2_input']['click_labels'] == '1,0'
@@ -0,0 +1,60 @@
+import random
+import threading
+import time
+
+import pytest
+
+from chunking import chunk_length, predict_chunks, split_video
+from conftest import read_frames, write_videos
+from media import frame_count
+
+
+@pytest.mark.parametrize('chunk_frames, interval, expected', [
+    (900, 1, 900),
+    (900, 4, 900),
+    (900, 7, 903),
+    (10, 3, 9),
+    (2, 5, 5),
+])
+def test_chunk_length_is_a_multiple_of_the_interval(chunk_frames, interval, expected):
+    assert chunk_length(chunk_frames, interval) == expected
+
+
+def test_split_video_covers_every_frame(tmp_path):
+    original, _ = write_videos(str(tmp_path), frames=30)
+    chunks = split_video(original, str(tmp_path), 12, [[40, 60], [100, 30]])
+
+    assert [frame_count(path) for path, _ in chunks] == [12, 12, 6]
+    assert sum(len(read_frames(path)) for path, _ in chunks) == 30
+    # The first chunk gets the clicks as they were made
+    assert chunks[0][1] == [[40, 60], [100, 30]]
+    for _, points in chunks:
+        assert len(points) == 2
+        assert all(0 <= x < 160 and 0 <= y < 120 for x, y in points)
+
+
+def test_split_video_follows_the_subject(tmp_path):
+    # The texture moves 3 pixels right per frame
+    original, _ = write_videos(str(tmp_path), frames=20)
+    chunks = split_video(original, str(tmp_path), 10, [[60, 60]])
+    x, y = chunks[1][1][0]
+    assert abs(x - 90) <= 2 and abs(y - 60) <= 2
+
+
+def test_predict_chunks_keeps_chunk_order(tmp_path):
+    lock = threading.Lock()
+    running = {'now': 0, 'most': 0}
+
+    def predict(path, points):
+        with lock:
+            running['now'] += 1
+            running['most'] = max(running['most'], running['now'])
+        time.sleep(random.uniform(0, 0.05))
+        with lock:
+            running['now'] -= 1
+        return [f'{path}.mask.mp4']
+
+    chunks = [(f'chunk_{index}', [[index, index]]) for index in range(8)]
+    outputs = predict_chunks(chunks, predict, concurrency=3)
+    assert outputs == [[f'chunk_{index}.mask.mp4'] for index in range(8)]
+    assert running['most'] <= 3
@@ -0,0 +1,108 @@
+import cv2
+import numpy as np
+import pytest
+
+from compositing import Compositor
+
+WIDTH, HEIGHT = 96, 64
+
+
+def frames(count):
+    texture = np.random.default_rng(1).integers(0, 256, (HEIGHT, WIDTH, 3), dtype=np.uint8)
+    return [np.roll(texture, index * 3, axis=1) for index in range(count)]
+
+
+def disc(x, y=HEIGHT // 2, radius=12):
+    mask = np.zeros((HEIGHT, WIDTH, 3), dtype=np.uint8)
+    cv2.circle(mask, (x, y), radius, (255, 255, 255), -1)
+    return mask
+
+
+def empty():
+    return np.zeros((HEIGHT, WIDTH, 3), dtype=np.uint8)
+
+
+def full():
+    return np.full((HEIGHT, WIDTH, 3), 255, dtype=np.uint8)
+
+
+def composite_all(masks, roi, buffers=3, **options):
+    """Composite a frame per mask, cycling through a pool of output buffers like the pipeline."""
+    compositor = Compositor(WIDTH, HEIGHT, roi=roi, **options)
+    pool = [np.empty((HEIGHT, WIDTH, 3), dtype=np.uint8) for _ in range(buffers)]
+    outputs = []
+    for index, (frame, mask) in enumerate(zip(frames(len(masks)), masks)):
+        outputs.append(compositor.composite(frame, mask, pool[index % buffers]).copy())
+    return outputs
+
+
+MASKS = {
+    'moving': [disc(16 + index * 2) for index in range(24)],
+    # Held masks reach each buffer of the pool several times, after other masks
+    'held': [disc(20)] * 7 + [disc(40)] * 5 + [disc(20)] * 7 + [empty()] * 2 + [disc(20)] * 4,
+    'empty': [empty()] * 4 + [disc(30)] + [empty()] * 5,
+    # Large changing masks make the compositor fall back to whole frames for a while
+    'full': [full()] * 4 + [full() if index % 2 else disc(48, radius=30) for index in range(20)] + [full()] * 4,
+}
+
+
+@pytest.mark.parametrize('name', list(MASKS))
+@pytest.mark.parametrize('feather', [0, 3])
+def test_roi_matches_whole_frames(name, feather):
+    masks = MASKS[name]
+    expected = composite_all(masks, roi=False, feather=feather)
+    actual = composite_all(masks, roi=True, feather=feather)
+    for index, (a, b) in enumerate(zip(expected, actual)):
+        assert np.array_equal(a, b), f"frame {index} differs"
+
+
+def test_whole_frame_composite_keeps_the_subject():
+    frame = frames(1)[0]
+    mask = disc(40)
+    out = Compositor(WIDTH, HEIGHT, roi=False).composite(frame, mask)
+    inside = mask[..., 0] > 0
+    assert np.array_equal(out[inside], frame[inside])
+    assert (out[~inside] == (0, 255, 0)).all()
+
+
+def blend(frame, mask, feather, background=(0, 255, 0)):
+    """Reference composite: frame over background with a float alpha ramp across the outline."""
+    size = 2 * feather + 1
+    alpha = cv2.blur(mask, (size, size), borderType=cv2.BORDER_REPLICATE).astype(np.float64) / 255
+    background = np.array(background, dtype=np.float64)
+    return background + (frame.astype(np.float64) - background) * alpha[..., None]
+
+
+@pytest.mark.parametrize('roi', [False, True], ids=['whole_frame', 'roi'])
+@pytest.mark.parametrize('feather', [1, 4])
+def test_feather_matches_a_float_blend(roi, feather):
+    frame = frames(1)[0]
+    # Touching the left edge of the frame too
+    mask = disc(8, radius=16)[..., 0]
+    out = Compositor(WIDTH, HEIGHT, roi=roi, feather=feather).composite(frame, mask)
+    difference = np.abs(out.astype(np.float64) - blend(frame, mask, feather))
+    assert difference.max() <= 1
+
+
+@pytest.mark.parametrize('order', [('keep', 'replace'), ('replace', 'keep')])
+def test_replace_layers_cover_keep_layers_in_any_order(order):
+    frame = frames(1)[0]
+    kept = disc(40, radius=20)
+    replaced = disc(56, radius=10)
+    masks = {'keep': kept, 'replace': replaced}
+    out = Compositor(WIDTH, HEIGHT, roi=True, feather=2).composite_layers(
+        frame, [(masks[policy], policy) for policy in order])
+    # The subject is what is kept and not replaced, whichever layer comes first
+    subject = cv2.subtract(kept[..., 0], replaced[..., 0])
+    difference = np.abs(out.astype(np.float64) - blend(frame, subject, 2))
+    assert difference.max() <= 1
+
+
+
+def test_replace_layers_alone_keep_the_rest_of_the_frame():
+    frame = frames(1)[0]
+    replaced = disc(40)
+    out = Compositor(WIDTH, HEIGHT, roi=False).composite_layers(frame, [(replaced, 'replace')])
+    inside = replaced[..., 0] > 0
+    assert (out[inside] == (0, 255, 0)).all()
+    assert np.array_equal(out[~inside], frame[~inside])
@@ -0,0 +1,148 @@
+import hashlib
+import os
+import socket
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+import urllib3
+
+import downloads
+
+
+@pytest.fixture
+def payload(tmp_path):
+    data = os.urandom(1024 * 1024 + 123)
+    (tmp_path / 'video.bin').write_bytes(data)
+    return hashlib.sha256(data).hexdigest()
+
+
+@pytest.fixture
+def small_parts(monkeypatch):
+    monkeypatch.setattr(downloads, 'RANGED_MIN_SIZE', 1)
+    monkeypatch.setattr(downloads, 'RANGED_PART_SIZE', 100 * 1024)
+    monkeypatch.setattr(downloads, 'RANGED_CONNECTIONS', 4)
+
+
+def digest(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def test_probe_reads_size_ranges_and_validator(http_server, payload, tmp_path):
+    info = downloads.probe(http_server.url('video.bin'))
+    assert info.size == (tmp_path / 'video.bin').stat().st_size
+    assert info.accepts_ranges
+    assert info.validator
+
+
+def test_probe_of_missing_file_reports_nothing(http_server):
+    assert downloads.probe(http_server.url('missing.bin')) == downloads.RemoteInfo(None, False, None)
+
+
+def test_ranged_download_is_byte_identical(http_server, payload, small_parts, tmp_path, monkeypatch):
+    parts = []
+    download_range = downloads._download_range
+
+    def recording_range(url, path, start, end, chunk_size):
+        parts.append((start, end))
+        return download_range(url, path, start, end, chunk_size)
+
+    monkeypatch.setattr(downloads, '_download_range', recording_range)
+    path = str(tmp_path / 'copy.bin')
+    downloads.download_to_file(http_server.url('video.bin'), path)
+
+    assert digest(path) == payload
+    # Parts cover the file exactly once
+    assert len(parts) == 11
+    assert sorted(parts)[0][0] == 0 and sorted(parts)[-1][1] == os.path.getsize(path) - 1
+
+
+def test_server_without_ranges_falls_back_to_one_stream(http_server, payload, small_parts, tmp_path):
+    info = downloads.RemoteInfo(size=None, accepts_ranges=False, validator=None)
+    path = str(tmp_path / 'copy.bin')
+    downloads.download_to_file(http_server.url('video.bin'), path, info=info)
+    assert digest(path) == payload
+
+
+def test_cached_video_downloads_each_version_once(http_server, payload, tmp_path, monkeypatch):
+    calls = []
+    download = downloads.download_to_file
+
+    def recording_download(url, path, **kwargs):
+        calls.append(url)
+        return download(url, path, **kwargs)
+
+    monkeypatch.setattr(downloads, 'download_to_file', recording_download)
+    url = http_server.url('video.bin')
+    for _ in range(2):
+        with downloads.cached_video(url) as path:
+            assert digest(path) == payload
+    assert len(calls) == 1
+
+
+@pytest.fixture
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(downloads, 'DOWNLOAD_RETRIES', 3)
+    monkeypatch.setattr(downloads, 'DOWNLOAD_BACKOFF', 0)
+
+
+def test_connection_errors_are_retried_by_one_layer(no_backoff, tmp_path, monkeypatch):
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+    attempts = []
+    create_connection = urllib3.util.connection.create_connection
+
+    def counting_connection(*args, **kwargs):
+        attempts.append(args[0])
+        return create_connection(*args, **kwargs)
+
+    monkeypatch.setattr(urllib3.util.connection, 'create_connection', counting_connection)
+    info = downloads.RemoteInfo(None, False, None)
+    with pytest.raises(requests.ConnectionError):
+        downloads.download_to_file(f'http://127.0.0.1:{port}/video.bin', str(tmp_path / 'copy.bin'), info=info)
+    assert len(attempts) == 4
+
+
+class FlakyHandler(BaseHTTPRequestHandler):
+    """Answers 503 to the first failures requests, then a small body."""
+
+    def do_GET(self):
+        server = self.server
+        server.requests += 1
+        if server.requests <= server.failures:
+            self.send_response(503)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Length', '5')
+        self.end_headers()
+        self.wfile.write(b'video')
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.mark.parametrize('failures, succeeds', [(3, True), (4, False)])
+def test_unavailable_responses_are_retried(no_backoff, tmp_path, failures, succeeds):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FlakyHandler)
+    server.requests, server.failures = 0, failures
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        url = f'http://127.0.0.1:{server.server_address[1]}/video.bin'
+        path = str(tmp_path / 'copy.bin')
+        info = downloads.RemoteInfo(None, False, None)
+        if succeeds:
+            downloads.download_to_file(url, path, info=info)
+            assert open(path, 'rb').read() == b'video'
+        else:
+            with pytest.raises(requests.HTTPError):
+                downloads.download_to_file(url, path, info=info)
+        assert server.requests == 4
+    finally:
+        server.shutdown()
+        server.server_close()
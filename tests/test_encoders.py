@@ -0,0 +1,25 @@
+import pytest
+
+from encoders import frame_rate
+
+
+@pytest.mark.parametrize('fps, expected', [
+    (23.976, '24000/1001'),
+    (23.98, '24000/1001'),
+    (29.97, '30000/1001'),
+    (30000 / 1001, '30000/1001'),
+    (59.94, '60000/1001'),
+    (24, '24/1'),
+    (25.0, '25/1'),
+    (30, '30/1'),
+    (12.5, '25/2'),
+    (0.5, '1/2'),
+])
+def test_frame_rate(fps, expected):
+    assert frame_rate(fps) == expected
+
+
+@pytest.mark.parametrize('fps', [0, 0.0, -25, float('nan')])
+def test_frame_rate_rejects_invalid_rates(fps):
+    with pytest.raises(ValueError, match='Invalid frame rate'):
+        frame_rate(fps)
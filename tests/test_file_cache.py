@@ -0,0 +1,131 @@
+import multiprocessing
+import os
+import threading
+import time
+
+from file_cache import FileCache
+
+
+def writer(data):
+    def fill(path):
+        with open(path, 'wb') as f:
+            f.write(data)
+    return fill
+
+
+def test_least_recently_used_is_evicted(tmp_path):
+    cache = FileCache(str(tmp_path), max_bytes=250)
+    for key in ('a', 'b'):
+        with cache.get(key, writer(b'x' * 100)):
+            pass
+    # Using 'a' again makes 'b' the oldest
+    with cache.get('a', writer(b'')):
+        pass
+    with cache.get('c', writer(b'x' * 100)):
+        pass
+
+    assert os.path.exists(cache.path('a'))
+    assert not os.path.exists(cache.path('b'))
+    assert os.path.exists(cache.path('c'))
+    stats = cache.stats()
+    assert (stats['entries'], stats['bytes'], stats['evictions']) == (2, 200, 1)
+    assert (stats['hits'], stats['misses']) == (1, 3)
+
+
+def test_pinned_files_outlive_the_budget_until_released(tmp_path):
+    cache = FileCache(str(tmp_path), max_bytes=150)
+    pinned = cache.acquire('pinned', writer(b'x' * 100))
+    with cache.get('other', writer(b'x' * 100)) as other:
+        assert os.path.exists(pinned)
+    # Releasing 'other' evicted it, as 'pinned' was still in use
+    assert not os.path.exists(other)
+    assert os.path.exists(pinned)
+
+    cache.release(pinned)
+    with cache.get('third', writer(b'x' * 100)):
+        pass
+    assert not os.path.exists(pinned)
+
+
+def test_concurrent_acquires_fill_once(tmp_path):
+    cache = FileCache(str(tmp_path), max_bytes=10 ** 6)
+    fills = []
+
+    def slow_fill(path):
+        fills.append(path)
+        time.sleep(0.2)
+        writer(b'data')(path)
+
+    paths = []
+
+    def use():
+        with cache.get('key', slow_fill) as path:
+            with open(path, 'rb') as f:
+                paths.append(f.read())
+
+    threads = [threading.Thread(target=use) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(fills) == 1
+    assert paths == [b'data'] * 4
+
+
+def test_failed_fill_leaves_nothing_behind(tmp_path):
+    cache = FileCache(str(tmp_path), max_bytes=10 ** 6)
+
+    def failing_fill(path):
+        writer(b'partial')(path)
+        raise RuntimeError('download failed')
+
+    try:
+        cache.acquire('key', failing_fill)
+    except RuntimeError:
+        pass
+    assert cache.lookup('key') is None
+    assert not [name for name in os.listdir(tmp_path) if not name.startswith('.')]
+
+
+def test_existing_files_are_indexed_on_open(tmp_path):
+    cache = FileCache(str(tmp_path), max_bytes=10 ** 6, suffix='.mp4')
+    with cache.get('key', writer(b'x' * 10)):
+        pass
+    os.unlink(os.path.join(tmp_path, '.index.sqlite3'))
+
+    reopened = FileCache(str(tmp_path), max_bytes=10 ** 6, suffix='.mp4')
+    assert reopened.stats()['entries'] == 1
+    path = reopened.lookup('key')
+    assert path == cache.path('key')
+    reopened.release(path)
+
+
+def _pin_and_wait(directory, pinned, done):
+    cache = FileCache(directory, max_bytes=150)
+    cache.acquire('shared', writer(b'x' * 100))
+    pinned.set()
+    done.wait(30)
+
+
+def test_pins_are_shared_between_processes(tmp_path):
+    directory = str(tmp_path)
+    context = multiprocessing.get_context('spawn')
+    pinned, done = context.Event(), context.Event()
+    process = context.Process(target=_pin_and_wait, args=(directory, pinned, done))
+    process.start()
+    try:
+        assert pinned.wait(30)
+        cache = FileCache(directory, max_bytes=150)
+        with cache.get('local', writer(b'x' * 100)):
+            pass
+        # The other process's pin kept its file; ours was evicted instead
+        assert os.path.exists(cache.path('shared'))
+        assert not os.path.exists(cache.path('local'))
+    finally:
+        done.set()
+        process.join(30)
+
+    # The pin of the process that exited no longer blocks eviction
+    with cache.get('after', writer(b'x' * 100)):
+        pass
+    assert not os.path.exists(cache.path('shared'))
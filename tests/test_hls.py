@@ -0,0 +1,75 @@
+import os
+
+import numpy as np
+import pytest
+
+import segmented
+from object_storage import LocalStorage
+from segmented import HLSWriter, playlist_segments
+
+
+@pytest.fixture
+def storage(tmp_path):
+    return LocalStorage(str(tmp_path / 'uploads'))
+
+
+@pytest.fixture(autouse=True)
+def short_segments(monkeypatch, fake_hls_encoder):
+    # 5 frames per segment at 10 fps
+    monkeypatch.setattr(segmented, 'HLS_SEGMENT_SECONDS', 0.5)
+    monkeypatch.setattr(segmented, 'HLS_POLL_INTERVAL', 0.01)
+
+
+def frames(count, width=32, height=24):
+    for index in range(count):
+        yield np.full((height, width, 3), index, dtype=np.uint8)
+
+
+def test_segments_and_playlist_are_uploaded(tmp_path, storage):
+    published = []
+
+    def on_manifest(url):
+        # The playlist only goes online once every segment it lists is there
+        playlist = os.path.join(storage.directory, 'stream', 'index.m3u8')
+        segments = playlist_segments(playlist)
+        assert segments
+        assert all(os.path.exists(os.path.join(storage.directory, 'stream', name)) for name in segments)
+        published.append(url)
+
+    writer = HLSWriter(str(tmp_path / 'hls'), 10, 32, 24, storage=storage, prefix='stream',
+                       on_manifest=on_manifest)
+    for frame in frames(12):
+        writer.write(frame)
+    writer.release()
+
+    names = ['segment_00000.ts', 'segment_00001.ts', 'segment_00002.ts']
+    assert sorted(os.listdir(os.path.join(storage.directory, 'stream'))) == ['index.m3u8'] + names
+    assert published == [storage.public_url('stream/index.m3u8')]
+    assert writer.manifest_url == published[0]
+    playlist = os.path.join(storage.directory, 'stream', 'index.m3u8')
+    assert playlist_segments(playlist) == names
+    with open(playlist) as f:
+        assert f.read().rstrip().endswith('#EXT-X-ENDLIST')
+    # The last segment holds the 2 frames left over
+    assert os.path.getsize(os.path.join(storage.directory, 'stream', names[-1])) == 2 * 32 * 24 * 3
+
+
+def test_prefix_defaults_to_a_unique_name(tmp_path, storage):
+    writers = [HLSWriter(str(tmp_path / f'hls_{index}'), 10, 32, 24, storage=storage) for index in range(2)]
+    for writer in writers:
+        writer.write(next(frames(1)))
+        writer.release()
+    prefixes = {writer.prefix for writer in writers}
+    assert len(prefixes) == 2
+    assert all(prefix.startswith('hls_') for prefix in prefixes)
+    assert sorted(os.listdir(storage.directory)) == sorted(prefixes)
+
+
+def test_writer_without_frames_fails(tmp_path, storage):
+    published = []
+    writer = HLSWriter(str(tmp_path / 'hls'), 10, 32, 24, storage=storage, prefix='stream',
+                       on_manifest=published.append)
+    with pytest.raises(RuntimeError, match='No HLS segments'):
+        writer.release()
+    assert not published
+    assert not os.path.exists(os.path.join(storage.directory, 'stream'))
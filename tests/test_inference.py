@@ -0,0 +1,55 @@
+import os
+
+import pytest
+
+import chunking
+import proxy
+import run
+from conftest import write_videos
+from fakes import FakePredictor
+from object_storage import LocalStorage, set_storage
+
+
+@pytest.fixture
+def storage(tmp_path):
+    storage = LocalStorage(str(tmp_path / 'uploads'))
+    set_storage(storage)
+    yield storage
+    set_storage(None)
+
+
+@pytest.mark.parametrize('chunk_min_frames', [0, 10], ids=['proxy', 'chunks'])
+def test_uploaded_inputs_are_deleted_after_prediction(http_server, storage, tmp_path, monkeypatch,
+                                                      chunk_min_frames):
+    write_videos(str(tmp_path), frames=24)
+    predictor = FakePredictor(http_server.url('mask.mp4'))
+    monkeypatch.setattr(run, 'predictor', predictor)
+    monkeypatch.setattr(proxy, 'PROXY_MAX_DIM', 80)
+    monkeypatch.setattr(chunking, 'CHUNK_MIN_FRAMES', chunk_min_frames)
+    monkeypatch.setattr(chunking, 'CHUNK_FRAMES', 12)
+
+    sam2_input = run.build_sam2_input(http_server.url('original.mp4'), [[40, 60]])
+    outputs = run.predict_sam2_local(sam2_input, [[40, 60]])
+
+    assert len(outputs) == len(predictor.calls) == (2 if chunk_min_frames else 1)
+    inputs = [input['input_video'] for _, input in predictor.calls]
+    assert all(url.startswith('file://') for url in inputs)
+    # The model got the copies while it ran; none is left afterwards
+    assert not os.listdir(storage.directory)
+
+
+def test_uploaded_input_is_deleted_when_prediction_fails(http_server, storage, tmp_path, monkeypatch):
+    write_videos(str(tmp_path), frames=12)
+
+    def failing(model, input):
+        assert os.path.exists(input['input_video'][len('file://'):])
+        raise RuntimeError('prediction failed')
+
+    monkeypatch.setattr(run, 'predictor', failing)
+    monkeypatch.setattr(proxy, 'PROXY_MAX_DIM', 80)
+    monkeypatch.setattr(chunking, 'CHUNK_MIN_FRAMES', 0)
+
+    sam2_input = run.build_sam2_input(http_server.url('original.mp4'), [[40, 60]])
+    with pytest.raises(RuntimeError):
+        run.predict_sam2_local(sam2_input, [[40, 60]])
+    assert not os.listdir(storage.directory)
@@ -0,0 +1,113 @@
+import threading
+import time
+
+import pytest
+
+from jobs import DONE, FAILED, JobManager, SqliteJobStore
+
+
+@pytest.fixture
+def managers():
+    created = []
+
+    def make(*args, **kwargs):
+        manager = JobManager(*args, **kwargs)
+        created.append(manager)
+        return manager
+
+    yield make
+    for manager in created:
+        manager.shutdown()
+
+
+def test_stages_run_in_order_and_share_results(managers):
+    def first(job):
+        job.result['first'] = job.input['value'] * 2
+
+    def second(job):
+        job.result['second'] = job.result['first'] + 1
+
+    manager = managers([('first', first), ('second', second)], workers=2)
+    job = manager.wait(manager.submit({'value': 20}), timeout=10)
+    assert job.status == DONE
+    assert job.result == {'first': 40, 'second': 41}
+    assert list(job.timings) == ['first', 'second']
+
+
+def test_failed_stage_fails_the_job(managers):
+    ran = []
+
+    def broken(job):
+        raise RuntimeError('model unavailable')
+
+    manager = managers([('inference', broken), ('uploading', ran.append)], workers=1)
+    job = manager.wait(manager.submit({}), timeout=10)
+    assert job.status == FAILED
+    assert job.error == 'model unavailable'
+    assert not ran
+
+
+def test_stage_concurrency_is_limited(managers):
+    lock = threading.Lock()
+    running = {'now': 0, 'most': 0, 'waiting_most': 0, 'waiting': 0}
+
+    def waiting(job):
+        with lock:
+            running['waiting'] += 1
+            running['waiting_most'] = max(running['waiting_most'], running['waiting'])
+        time.sleep(0.1)
+        with lock:
+            running['waiting'] -= 1
+
+    def compositing(job):
+        with lock:
+            running['now'] += 1
+            running['most'] = max(running['most'], running['now'])
+        time.sleep(0.05)
+        with lock:
+            running['now'] -= 1
+
+    manager = managers([('inference', waiting), ('compositing', compositing)], workers=6,
+                       stage_concurrency={'inference': 6, 'compositing': 1})
+    jobs = [manager.submit({}) for _ in range(6)]
+    for job in jobs:
+        assert manager.wait(job, timeout=10).status == DONE
+    assert running['waiting_most'] > 1
+    assert running['most'] == 1
+    assert manager.limits == {'inference': 6, 'compositing': 1}
+
+
+def test_sqlite_store_shares_jobs_between_managers(managers, tmp_path):
+    path = str(tmp_path / 'jobs.sqlite3')
+    release = threading.Event()
+
+    def inference(job):
+        release.wait(10)
+        job.result['mask_url'] = 'http://example.com/mask.mp4'
+
+    runner = managers([('inference', inference)], workers=1, store=SqliteJobStore(path))
+    other = managers([('inference', inference)], workers=1, store=SqliteJobStore(path))
+    job = runner.submit({'url': 'http://example.com/video.mp4'})
+
+    deadline = time.time() + 10
+    while other.get(job.id).status != 'inference' and time.time() < deadline:
+        time.sleep(0.01)
+    snapshot = other.get(job.id)
+    assert snapshot.status == 'inference'
+    assert snapshot.input == job.input
+
+    release.set()
+    runner.wait(job, timeout=10)
+    snapshot = other.get(job.id)
+    assert snapshot.status == DONE
+    assert snapshot.result == {'mask_url': 'http://example.com/mask.mp4'}
+    assert [listed.id for listed in other.list()] == [job.id]
+    assert other.get('missing') is None
+
+
+def test_store_forgets_the_oldest_finished_jobs(managers, tmp_path):
+    store = SqliteJobStore(str(tmp_path / 'jobs.sqlite3'), history=2)
+    manager = managers([('inference', lambda job: None)], workers=1, store=store)
+    jobs = [manager.wait(manager.submit({'index': index}), timeout=10) for index in range(4)]
+    assert [job.input['index'] for job in store.list()] == [2, 3]
+    assert store.load(jobs[0].id) is None
@@ -0,0 +1,88 @@
+import cv2
+import numpy as np
+import pytest
+
+import mask_archive
+from compositing import MASK_THRESHOLD
+from conftest import read_frames, write_videos
+from mask_archive import MaskArchive, MaskArchiveWriter
+
+
+def random_masks(frames=12, width=37, height=21):
+    # Odd sizes, so packed rows do not end on a byte boundary
+    rng = np.random.default_rng(1)
+    return [np.where(rng.random((height, width)) < 0.3, 255, 0).astype(np.uint8) for _ in range(frames)]
+
+
+@pytest.mark.parametrize('compression', [0, 6], ids=['stored', 'zlib'])
+def test_archive_round_trip(tmp_path, compression):
+    masks = random_masks()
+    path = str(tmp_path / 'masks.masks')
+    writer = MaskArchiveWriter(path, 37, 21, 24.0, compression=compression)
+    for mask in masks:
+        writer.write(mask)
+    writer.release()
+
+    archive = MaskArchive(path)
+    assert len(archive) == len(masks)
+    assert (archive.width, archive.height, archive.fps) == (37, 21, 24.0)
+    assert archive.compressed == bool(compression)
+    # Random access, in any order
+    for index in (7, 0, 11, 3):
+        assert np.array_equal(archive.frame(index), masks[index])
+    # Sequential reads, as the pipeline does with a mask video
+    archive.set(cv2.CAP_PROP_POS_FRAMES, 0)
+    read = []
+    while True:
+        ret, frame = archive.read()
+        if not ret:
+            break
+        read.append(frame.copy())
+    assert len(read) == len(masks)
+    assert all(np.array_equal(a, b) for a, b in zip(read, masks))
+    with pytest.raises(IndexError):
+        archive.frame(len(masks))
+    archive.release()
+
+
+def test_writer_rejects_masks_of_another_size(tmp_path):
+    writer = MaskArchiveWriter(str(tmp_path / 'masks.masks'), 37, 21, 24.0)
+    with pytest.raises(ValueError):
+        writer.write(np.zeros((20, 37), dtype=np.uint8))
+    writer.release()
+
+
+def test_convert_masks_matches_thresholded_video(tmp_path):
+    _, mask = write_videos(str(tmp_path), frames=20)
+    path = str(tmp_path / 'masks.masks')
+    assert mask_archive.convert_masks([mask, mask], path) == 40
+    assert mask_archive.is_mask_archive(path)
+    assert not mask_archive.is_mask_archive(mask)
+
+    expected = [np.where(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) >= MASK_THRESHOLD, 255, 0)
+                for frame in read_frames(mask)] * 2
+    archive = mask_archive.open_mask_video(path)
+    assert isinstance(archive, MaskArchive)
+    for index, frame in enumerate(expected):
+        assert np.array_equal(archive.frame(index), frame), f"frame {index} differs"
+    archive.release()
+
+
+def test_archives_are_cached_by_url(http_server, tmp_path, monkeypatch):
+    write_videos(str(tmp_path), frames=10)
+    conversions = []
+    convert = mask_archive.convert_masks
+
+    def recording_convert(sources, path, **kwargs):
+        conversions.append(sources)
+        return convert(sources, path, **kwargs)
+
+    monkeypatch.setattr(mask_archive, 'convert_masks', recording_convert)
+    url = http_server.url('mask.mp4')
+    for _ in range(2):
+        path = mask_archive.acquire_mask_archive(url)
+        try:
+            assert len(MaskArchive(path)) == 10
+        finally:
+            mask_archive.release_mask_archive(path)
+    assert len(conversions) == 1
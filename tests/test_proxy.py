@@ -0,0 +1,67 @@
+import cv2
+import numpy as np
+import pytest
+
+from compositing import MaskUpscaler
+from proxy import proxy_size, scale_coordinates
+
+WIDTH, HEIGHT = 320, 240
+
+
+@pytest.mark.parametrize('size, max_dim, expected', [
+    ((1920, 1080), 0, None),
+    ((1920, 1080), 1920, None),
+    ((1920, 1080), 640, (640, 360)),
+    ((1080, 1920), 640, (360, 640)),
+    # Odd sizes are rounded to even ones
+    ((1000, 563), 500, (500, 282)),
+])
+def test_proxy_size(size, max_dim, expected):
+    assert proxy_size(*size, max_dim=max_dim) == expected
+
+
+def test_coordinates_stay_inside_the_frame():
+    assert scale_coordinates([[0, 0], [1919, 1079], [960, 540]], (1920, 1080), (640, 360)) == \
+        [[0, 0], [639, 359], [320, 180]]
+
+
+@pytest.fixture
+def subject():
+    """A bright disc on a dark, slightly noisy frame, its exact mask, and the
+    blocky mask a model would return for a proxy at a quarter of the size."""
+    truth = np.zeros((HEIGHT, WIDTH), dtype=np.uint8)
+    cv2.circle(truth, (161, 117), 50, 255, -1)
+    noise = np.random.default_rng(0).integers(0, 10, (HEIGHT, WIDTH, 3), dtype=np.uint8)
+    frame = np.where(truth[..., None] > 0, 200, 40).astype(np.uint8) + noise
+    small = cv2.resize(truth, (WIDTH // 4, HEIGHT // 4), interpolation=cv2.INTER_AREA)
+    small = np.where(small >= 128, 255, 0).astype(np.uint8)
+    return frame, truth, small
+
+
+def test_guided_upscale_snaps_to_the_edges_of_the_frame(subject):
+    frame, truth, small = subject
+    guided = MaskUpscaler(WIDTH, HEIGHT, 'guided').upscale(small, frame)
+    linear = MaskUpscaler(WIDTH, HEIGHT, 'linear').upscale(small, frame)
+    for mask in (guided, linear):
+        assert mask.shape == (HEIGHT, WIDTH)
+        assert set(np.unique(mask)) == {0, 255}
+    # The guided edge follows the picture, the linear one the blocks of the small mask
+    assert np.count_nonzero(guided != truth) <= 10
+    assert np.count_nonzero(linear != truth) > 10 * max(1, np.count_nonzero(guided != truth))
+
+
+def test_guided_upscale_without_a_frame_falls_back_to_linear(subject):
+    _, _, small = subject
+    guided = MaskUpscaler(WIDTH, HEIGHT, 'guided').upscale(small)
+    linear = MaskUpscaler(WIDTH, HEIGHT, 'linear').upscale(small)
+    assert np.array_equal(guided, linear)
+
+
+def test_upscale_ignores_compression_noise(subject):
+    frame, truth, small = subject
+    noisy = small.copy()
+    # Dark noise outside the subject, as left by a lossy mask video
+    noisy[noisy == 0] = np.random.default_rng(1).integers(0, 10, np.count_nonzero(noisy == 0))
+    upscaler = MaskUpscaler(WIDTH, HEIGHT, 'guided')
+    expected = MaskUpscaler(WIDTH, HEIGHT, 'guided').upscale(small, frame)
+    assert np.array_equal(upscaler.upscale(noisy, frame), expected)
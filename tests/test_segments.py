@@ -0,0 +1,29 @@
+import cv2
+import numpy as np
+import pytest
+
+from conftest import read_frames, write_videos
+from pipeline import composite_video
+
+
+def open_lossless_writer(path, fps, width, height, audio_source=None):
+    return cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'FFV1'), fps, (width, height))
+
+
+@pytest.mark.parametrize('mask_frames', [None, 25], ids=['full_mask', 'short_mask'])
+def test_segment_mode_matches_serial(tmp_path, mask_frames):
+    original, mask = write_videos(str(tmp_path), frames=40, mask_frames=mask_frames, extension='.avi')
+    serial_path = str(tmp_path / 'serial.avi')
+    parallel_path = str(tmp_path / 'parallel.avi')
+
+    serial = composite_video(original, mask, serial_path, parallel=False,
+                             writer_factory=open_lossless_writer, report_timings=False)
+    parallel = composite_video(original, mask, parallel_path, parallel=True,
+                               writer_factory=open_lossless_writer, workers=2, segment_frames=12)
+
+    assert parallel['frames'] == serial['frames']
+    serial_frames = read_frames(serial_path)
+    parallel_frames = read_frames(parallel_path)
+    assert len(parallel_frames) == len(serial_frames) == serial['frames']
+    for index, (a, b) in enumerate(zip(serial_frames, parallel_frames)):
+        assert np.array_equal(a, b), f"frame {index} differs"
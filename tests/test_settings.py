@@ -0,0 +1,37 @@
+import os
+
+import chunking
+import run
+
+
+def test_create_app_reads_dotenv_after_import(tmp_path, monkeypatch):
+    env_path = tmp_path / '.env'
+    env_path.write_text('CHUNK_FRAMES=123\nOUTPUT_MODE=hls\nRENDER_FEATHER=7\n')
+    monkeypatch.setattr(run, 'ENV_PATH', str(env_path))
+    names = ('CHUNK_FRAMES', 'OUTPUT_MODE', 'RENDER_FEATHER')
+    assert not any(name in os.environ for name in names)
+    try:
+        run.create_app()
+        assert chunking.CHUNK_FRAMES == 123
+        assert run.OUTPUT_MODE == 'hls'
+        assert run.RENDER_FEATHER == 7
+    finally:
+        run.job_manager.shutdown()
+        for name in names:
+            os.environ.pop(name, None)
+        chunking.configure()
+        run.configure()
+    assert chunking.CHUNK_FRAMES == 900
+
+
+def test_environment_wins_over_dotenv(tmp_path, monkeypatch):
+    env_path = tmp_path / '.env'
+    env_path.write_text('CHUNK_FRAMES=123\n')
+    monkeypatch.setattr(run, 'ENV_PATH', str(env_path))
+    monkeypatch.setenv('CHUNK_FRAMES', '456')
+    try:
+        run.load_settings()
+        assert chunking.CHUNK_FRAMES == 456
+    finally:
+        monkeypatch.undo()
+        chunking.configure()
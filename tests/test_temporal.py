@@ -0,0 +1,92 @@
+import cv2
+import numpy as np
+import pytest
+
+from compositing import MaskUpscaler
+from temporal import MaskInterpolator, frame_interval, mask_index, model_frames
+
+WIDTH, HEIGHT = 160, 120
+
+
+def frame(index):
+    """A smooth texture moving 3 pixels right per frame."""
+    texture = cv2.GaussianBlur(np.random.default_rng(0).integers(0, 256, (HEIGHT, WIDTH, 3), dtype=np.uint8),
+                               (0, 0), 3)
+    texture = cv2.normalize(texture, None, 0, 255, cv2.NORM_MINMAX)
+    return np.roll(texture, index * 3, axis=1)
+
+
+def disc(x, y=HEIGHT // 2, radius=25, width=WIDTH, height=HEIGHT):
+    mask = np.zeros((height, width), dtype=np.uint8)
+    cv2.circle(mask, (x, y), radius, 255, -1)
+    return mask
+
+
+def center(mask):
+    moments = cv2.moments((mask >= 128).astype(np.uint8), binaryImage=True)
+    return moments['m10'] / moments['m00'], moments['m01'] / moments['m00']
+
+
+@pytest.mark.parametrize('source_fps, target_fps, interval, expected', [
+    (30, 0, 1, 1),
+    (30, 0, 4, 4),
+    (30, 10, 4, 3),
+    (29.97, 5, 1, 6),
+    (24, 60, 1, 1),
+    (0, 10, 2, 2),
+])
+def test_frame_interval(source_fps, target_fps, interval, expected):
+    assert frame_interval(source_fps, target_fps, interval) == expected
+
+
+def test_every_frame_maps_to_the_mask_at_or_before_it():
+    interval = 3
+    assert [mask_index(index, interval) for index in range(7)] == [0, 0, 0, 1, 1, 1, 2]
+    # The last frames still get a model frame of their own
+    assert model_frames(7, interval) == 3
+    assert model_frames(6, interval) == 2
+
+
+def test_hold_repeats_the_last_keyframe():
+    interpolator = MaskInterpolator(WIDTH, HEIGHT, method='hold')
+    assert not interpolator.has_mask
+    first = disc(60)
+    assert np.array_equal(interpolator.key(frame(0), first), first)
+    for index in (1, 2):
+        assert np.array_equal(interpolator.fill(frame(index)), first)
+    # A BGR mask frame of the next keyframe replaces it
+    second = disc(90)
+    interpolator.key(frame(3), cv2.cvtColor(second, cv2.COLOR_GRAY2BGR))
+    assert interpolator.has_mask
+    assert np.array_equal(interpolator.fill(frame(4)), second)
+
+
+def test_flow_moves_the_mask_with_the_picture():
+    interpolator = MaskInterpolator(WIDTH, HEIGHT, method='flow', flow_scale=0.25)
+    interpolator.key(frame(0), disc(60))
+    for index in (1, 2, 3):
+        x, y = center(interpolator.fill(frame(index)))
+        assert abs(x - (60 + 3 * index)) <= 0.5 and abs(y - HEIGHT // 2) <= 0.5
+    # The next keyframe starts over from the model mask
+    assert np.array_equal(interpolator.key(frame(4), disc(100)), disc(100))
+    x, _ = center(interpolator.fill(frame(5)))
+    assert abs(x - 103) <= 0.5
+
+
+def test_small_keyframes_are_scaled_to_the_frame():
+    small = disc(30, 30, 12, width=80, height=60)
+    interpolator = MaskInterpolator(WIDTH, HEIGHT, method='hold')
+    mask = interpolator.key(frame(0), small)
+    assert mask.shape == (HEIGHT, WIDTH)
+    x, y = center(mask)
+    assert abs(x - 60.5) <= 1 and abs(y - 60.5) <= 1
+
+    upscaled = MaskInterpolator(WIDTH, HEIGHT, method='hold', upscaler=MaskUpscaler(WIDTH, HEIGHT, 'linear'))
+    mask = upscaled.key(frame(0), small)
+    assert set(np.unique(mask)) <= {0, 255}
+    assert np.array_equal(upscaled.fill(frame(1)), mask)
+
+
+def test_unknown_fill_method_is_rejected():
+    with pytest.raises(ValueError, match='Unknown mask fill method'):
+        MaskInterpolator(WIDTH, HEIGHT, method='nearest')